@@ -0,0 +1,42 @@
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+logger = logging.getLogger(__name__)
+
+#
+# read-through caching of the values shown by views.index(), using Django's cache framework (backed by Redis - see
+# settings.CACHES). entries are invalidated by the writes that change them (see the invalidate_*() callers) and also
+# expire after settings.INDEX_CACHE_TIMEOUT seconds as a backstop
+#
+
+INDEX_COUNTER_CACHE_KEY = 'forecast_app:index:counter'
+INDEX_UPLOAD_FILE_JOBS_CACHE_KEY = 'forecast_app:index:upload_file_jobs'
+
+
+def cached_count_and_last_update(count_and_last_update_fcn):
+    """
+    :param count_and_last_update_fcn: a function of no args that returns (count, last_update). called on a cache miss
+    :return: a 2-tuple: (count, last_update)
+    """
+    return cache.get_or_set(INDEX_COUNTER_CACHE_KEY, count_and_last_update_fcn, settings.INDEX_CACHE_TIMEOUT)
+
+
+def cached_upload_file_jobs_summary(upload_file_jobs_summary_fcn):
+    """
+    :param upload_file_jobs_summary_fcn: a function of no args that returns a summary of recent UploadFileJobs (the
+        rendered HTML and anything else the page needs). called on a cache miss
+    :return: the summary
+    """
+    return cache.get_or_set(INDEX_UPLOAD_FILE_JOBS_CACHE_KEY, upload_file_jobs_summary_fcn,
+                            settings.INDEX_CACHE_TIMEOUT)
+
+
+def invalidate_counter_cache():
+    cache.delete(INDEX_COUNTER_CACHE_KEY)
+
+
+def invalidate_upload_file_jobs_cache():
+    cache.delete(INDEX_UPLOAD_FILE_JOBS_CACHE_KEY)
@@ -0,0 +1,267 @@
+import json
+import logging
+
+import django_rq
+from django.conf import settings
+from django.shortcuts import get_object_or_404
+from rq import get_current_job
+
+from forecast_app.compression import COMPRESSION_NONE
+from forecast_app.models import UploadFileJob
+from forecast_app.models.upload_file_job import S3_FILE_MODE_STREAM, upload_file_job_s3_file, \
+    upload_file_job_s3_file_range
+from forecast_app.prefetch import no_prefetch
+from forecast_app.progress import ProgressReporter
+from forecast_app.result_cache import put_cached_result
+from forecast_app.rq_utils import RQ_QUEUE_FAST, enqueue_many, upload_file_job_queue_name_and_timeout
+from forecast_app.storage import get_storage
+
+
+logger = logging.getLogger(__name__)
+
+#
+# fan-out/fan-in processing of large upload files. process_upload_file_job_chunked() splits an UploadFileJob's file at
+# line boundaries into byte ranges and enqueues one chunk job per range, which run map_fcn on their range in parallel
+# across workers. the last chunk job to finish enqueues a reduce job that merges their results into output_json.
+# progress is tracked in a Redis hash and a set of finished chunk indexes per UploadFileJob - see chunked_progress().
+# both expire if no chunk job finishes for settings.CHUNKED_STALL_TIMEOUT seconds (e.g., b/c a worker crashed
+# mid-chunk, so the reduce job is never enqueued), after which reap_stalled_chunked_jobs() fails the UploadFileJob
+#
+
+CHUNKED_PROGRESS_KEY = 'forecast_app:chunked:{}'  # format()ted with the UploadFileJob pk
+CHUNKED_FINISHED_KEY = 'forecast_app:chunked:{}:finished'  # ditto. a set, so a re-run chunk job is counted once
+CHUNKED_JOBS_KEY = 'forecast_app:chunked:jobs'  # set of the pks of UploadFileJobs being processed in chunks
+
+CHUNK_BOUNDARY_SCAN_SIZE = 64 * 1024  # bytes read at a time when looking for the line break after a split point
+
+
+def process_upload_file_job_chunked(upload_file_job_pk, map_fcn, reduce_fcn):
+    """
+    The body of a process_upload_file_job_fcn (see views._upload_file()) that processes the file in parallel chunks.
+    Files smaller than 2 * settings.CHUNKED_MIN_CHUNK_SIZE, and compressed files (which can't be read by byte range),
+    are processed in this job as a single chunk.
+
+    NB: The process_upload_file_job_fcn should be decorated with prefetch.no_prefetch() b/c large files are read by the
+    chunk jobs, not this one.
+
+    :param upload_file_job_pk: PK of the UploadFileJob to process
+    :param map_fcn: a function of two args (upload_file_job, fp) that processes one chunk and returns a JSON-
+        serializable result. fp is a binary stream of whole lines, as with S3_FILE_MODE_STREAM. must be importable
+        (i.e., module-level) so that RQ can pickle it
+    :param reduce_fcn: a function of two args (upload_file_job, results) that returns output_json given the list of
+        map_fcn results in file order. ditto importable
+    """
+    upload_file_job = get_object_or_404(UploadFileJob, pk=upload_file_job_pk)
+    try:
+        file_size = get_storage().size(upload_file_job.s3_key())
+        num_chunks = min(settings.CHUNKED_MAX_CHUNKS, file_size // settings.CHUNKED_MIN_CHUNK_SIZE)
+        byte_ranges = []
+        if (num_chunks > 1) and (upload_file_job.compression == COMPRESSION_NONE):
+            byte_ranges = _chunk_byte_ranges(upload_file_job, file_size, num_chunks)
+        if len(byte_ranges) > 1:  # claim it, as upload_file_job_s3_file() does
+            if not upload_file_job.transition([UploadFileJob.S3_FILE_UPLOADED, UploadFileJob.QUEUED],
+                                              UploadFileJob.S3_FILE_DOWNLOADED):
+                logger.debug("process_upload_file_job_chunked(): Not awaiting processing. upload_file_job={}"
+                             .format(upload_file_job))
+                return
+
+            _enqueue_chunk_jobs(upload_file_job, byte_ranges, map_fcn, reduce_fcn)
+    except Exception as exc:
+        failure_message = "process_upload_file_job_chunked(): Error splitting the file: {}. upload_file_job={}" \
+            .format(exc, upload_file_job)
+        upload_file_job.fail(failure_message)
+        upload_file_job.delete_s3_object()
+        logger.debug(failure_message)
+        return
+
+    if len(byte_ranges) > 1:
+        logger.debug("process_upload_file_job_chunked(): Enqueued {} chunk jobs. upload_file_job={}"
+                     .format(len(byte_ranges), upload_file_job))
+        return
+
+    # small, compressed, or too few line breaks to split: one chunk, here
+    with upload_file_job_s3_file(upload_file_job_pk, mode=S3_FILE_MODE_STREAM) as (upload_file_job, s3_file_fp):
+        upload_file_job.output_json = reduce_fcn(upload_file_job, [map_fcn(upload_file_job, s3_file_fp)])
+        upload_file_job.save(update_fields=['output_json', 'updated_at'])
+
+
+def chunked_progress(upload_file_job_pk):
+    """
+    :return: a dict with 'num_chunks', 'num_finished', and 'failure_message' (None if none failed) for an UploadFileJob
+        being processed in chunks, or None if it isn't (not chunked, not yet split, or already reduced)
+    """
+    with django_rq.get_connection().pipeline(transaction=False) as pipe:
+        pipe.hmget(CHUNKED_PROGRESS_KEY.format(upload_file_job_pk), ['num_chunks', 'failure_message'])
+        pipe.scard(CHUNKED_FINISHED_KEY.format(upload_file_job_pk))
+        (num_chunks, failure_message), num_finished = pipe.execute()
+    if num_chunks is None:
+        return None
+
+    return {'num_chunks': int(num_chunks),
+            'num_finished': num_finished,
+            'failure_message': failure_message.decode('utf-8') if failure_message else None}
+
+
+def _chunk_byte_ranges(upload_file_job, file_size, num_chunks):
+    """
+    :return: a list of up to num_chunks (first_byte, last_byte) 2-tuples (inclusive) covering upload_file_job's file,
+        each starting at a line start. fewer if lines are long relative to chunks
+    """
+    storage = get_storage()
+    s3_key = upload_file_job.s3_key()
+    boundaries = [0]  # chunk start offsets
+    for chunk_idx in range(1, num_chunks):
+        offset = max(chunk_idx * file_size // num_chunks, boundaries[-1])
+        while offset < file_size:  # find the first line break at or after offset
+            last_byte = min(offset + CHUNK_BOUNDARY_SCAN_SIZE, file_size) - 1
+            stream = storage.open_stream(s3_key, (offset, last_byte))
+            try:
+                newline_idx = stream.read().find(b'\n')
+            finally:
+                stream.close()
+            if newline_idx != -1:
+                offset += newline_idx + 1
+                break
+
+            offset = last_byte + 1
+        if offset >= file_size:
+            break
+
+        if offset > boundaries[-1]:
+            boundaries.append(offset)
+    return [(first_byte, next_first_byte - 1)
+            for first_byte, next_first_byte in zip(boundaries, boundaries[1:] + [file_size])]
+
+
+def _enqueue_chunk_jobs(upload_file_job, byte_ranges, map_fcn, reduce_fcn):
+    """
+    Initializes upload_file_job's progress keys and enqueues one process_upload_file_job_chunk() per byte range, in one
+    Redis pipeline per queue. The reduce job goes to this (the splitting) job's queue.
+    """
+    current_job = get_current_job()
+    reduce_queue_name = current_job.origin if current_job else RQ_QUEUE_FAST
+    conn = django_rq.get_connection()
+    progress_key = CHUNKED_PROGRESS_KEY.format(upload_file_job.pk)
+    with conn.pipeline() as pipe:
+        pipe.delete(progress_key, CHUNKED_FINISHED_KEY.format(upload_file_job.pk))
+        pipe.hset(progress_key, 'num_chunks', len(byte_ranges))
+        pipe.expire(progress_key, settings.CHUNKED_STALL_TIMEOUT)
+        pipe.sadd(CHUNKED_JOBS_KEY, upload_file_job.pk)
+        pipe.execute()
+
+    queue_name_to_enqueue_items = {}
+    for chunk_idx, byte_range in enumerate(byte_ranges):
+        queue_name, timeout = upload_file_job_queue_name_and_timeout(byte_range[1] - byte_range[0] + 1)
+        args = (upload_file_job.pk, chunk_idx, byte_range, len(byte_ranges), map_fcn, reduce_fcn, reduce_queue_name)
+        job_id = '{}-chunk-{}'.format(upload_file_job.rq_job_id(), chunk_idx)
+        queue_name_to_enqueue_items.setdefault(queue_name, []).append((args, job_id, timeout))
+    for queue_name, enqueue_items in queue_name_to_enqueue_items.items():
+        enqueue_many(django_rq.get_queue(queue_name), process_upload_file_job_chunk, enqueue_items)
+
+
+@no_prefetch
+def process_upload_file_job_chunk(upload_file_job_pk, chunk_idx, byte_range, num_chunks, map_fcn, reduce_fcn,
+                                  reduce_queue_name):
+    """
+    A chunk job enqueued by process_upload_file_job_chunked(): runs map_fcn on byte_range and saves the result in the
+    progress hash. Skips the work if another chunk already failed. Each finished chunk adds its index to the finished
+    set and renews both keys' expiry, and the one that completes the set enqueues reduce_upload_file_job_chunks(). NB: a
+    chunk job that's run again (e.g., requeued after its worker was killed) doesn't count twice.
+    """
+    conn = django_rq.get_connection()
+    progress_key = CHUNKED_PROGRESS_KEY.format(upload_file_job_pk)
+    finished_key = CHUNKED_FINISHED_KEY.format(upload_file_job_pk)
+    try:
+        if not conn.hexists(progress_key, 'failure_message'):
+            upload_file_job = UploadFileJob.objects.get(pk=upload_file_job_pk)
+            with upload_file_job_s3_file_range(upload_file_job, byte_range) as s3_file_fp:
+                result = map_fcn(upload_file_job, s3_file_fp)
+            conn.hset(progress_key, 'result:{}'.format(chunk_idx), json.dumps(result))
+    except Exception as exc:
+        failure_message = "process_upload_file_job_chunk(): Error processing chunk {} of {}: {}" \
+            .format(chunk_idx, num_chunks, exc)
+        conn.hsetnx(progress_key, 'failure_message', failure_message)
+        logger.debug("{}. upload_file_job_pk={}".format(failure_message, upload_file_job_pk))
+    finally:
+        with conn.pipeline() as pipe:
+            pipe.sadd(finished_key, chunk_idx)
+            pipe.scard(finished_key)
+            pipe.expire(progress_key, settings.CHUNKED_STALL_TIMEOUT)
+            pipe.expire(finished_key, settings.CHUNKED_STALL_TIMEOUT)
+            num_added, num_finished, _, _ = pipe.execute()
+        ProgressReporter(upload_file_job_pk).update(phase='processing chunks', is_force=True, num_chunks=num_chunks,
+                                                    num_finished=num_finished)
+        if num_added and (num_finished == num_chunks):  # exactly one chunk job sees this
+            django_rq.get_queue(reduce_queue_name).enqueue(reduce_upload_file_job_chunks, upload_file_job_pk,
+                                                           num_chunks, reduce_fcn,
+                                                           job_id='{}-reduce'.format(upload_file_job_pk))
+
+
+@no_prefetch
+def reduce_upload_file_job_chunks(upload_file_job_pk, num_chunks, reduce_fcn):
+    """
+    The reduce job enqueued by the last process_upload_file_job_chunk(): sets the UploadFileJob's output_json from
+    reduce_fcn and its status to SUCCESS, or marks it failed if any chunk failed. Then deletes the file and the
+    progress keys.
+    """
+    conn = django_rq.get_connection()
+    progress_key = CHUNKED_PROGRESS_KEY.format(upload_file_job_pk)
+    upload_file_job = get_object_or_404(UploadFileJob, pk=upload_file_job_pk)
+    try:
+        result_fields = ['result:{}'.format(chunk_idx) for chunk_idx in range(num_chunks)]
+        failure_message, *results = conn.hmget(progress_key, ['failure_message'] + result_fields)
+        if failure_message:
+            raise RuntimeError(failure_message.decode('utf-8'))
+        elif None in results:
+            raise RuntimeError("missing chunk results")
+
+        output_json = reduce_fcn(upload_file_job, [json.loads(result.decode('utf-8')) for result in results])
+        is_success = upload_file_job.transition(UploadFileJob.S3_FILE_DOWNLOADED, UploadFileJob.SUCCESS,
+                                                output_json=output_json)
+        if is_success and upload_file_job.content_digest:
+            put_cached_result(upload_file_job.content_digest, upload_file_job.input_json, upload_file_job.output_json)
+        logger.debug("reduce_upload_file_job_chunks(): Done. upload_file_job={}".format(upload_file_job))
+    except Exception as exc:
+        failure_message = "reduce_upload_file_job_chunks(): FAILED_PROCESS_FILE: Error: {}. upload_file_job={}" \
+            .format(exc, upload_file_job)
+        upload_file_job.fail(failure_message)
+        logger.debug(failure_message)
+    finally:
+        upload_file_job.delete_s3_object()
+        with conn.pipeline() as pipe:
+            pipe.delete(progress_key, CHUNKED_FINISHED_KEY.format(upload_file_job_pk))
+            pipe.srem(CHUNKED_JOBS_KEY, upload_file_job_pk)
+            pipe.execute()
+
+
+def reap_stalled_chunked_jobs():
+    """
+    Fails the UploadFileJobs being processed in chunks whose progress hash expired, i.e., for which no chunk job
+    finished in settings.CHUNKED_STALL_TIMEOUT seconds. Without this they'd stay S3_FILE_DOWNLOADED forever. Intended
+    to be run on a schedule - see the reap_chunked_jobs management command.
+
+    :return: the number of UploadFileJobs failed
+    """
+    conn = django_rq.get_connection()
+    upload_file_job_pks = [int(upload_file_job_pk) for upload_file_job_pk in conn.smembers(CHUNKED_JOBS_KEY)]
+    with conn.pipeline(transaction=False) as pipe:
+        for upload_file_job_pk in upload_file_job_pks:
+            pipe.exists(CHUNKED_PROGRESS_KEY.format(upload_file_job_pk))
+        stalled_pks = [upload_file_job_pk for upload_file_job_pk, is_exists in zip(upload_file_job_pks, pipe.execute())
+                       if not is_exists]
+    if not stalled_pks:
+        return 0
+
+    # NB: reduce_upload_file_job_chunks() removes its job from CHUNKED_JOBS_KEY after deleting the hash, so only jobs
+    # that are still S3_FILE_DOWNLOADED are stalled
+    stalled_jobs = list(UploadFileJob.objects.filter(pk__in=stalled_pks, status=UploadFileJob.S3_FILE_DOWNLOADED,
+                                                     is_failed=False))
+    for upload_file_job in stalled_jobs:
+        failure_message = "reap_stalled_chunked_jobs(): FAILED_PROCESS_FILE: No chunk job finished for {} seconds, " \
+                          "e.g., b/c a worker crashed. upload_file_job={}" \
+            .format(settings.CHUNKED_STALL_TIMEOUT, upload_file_job)
+        upload_file_job.fail(failure_message)
+        upload_file_job.delete_s3_object()
+        logger.debug(failure_message)
+    conn.srem(CHUNKED_JOBS_KEY, *stalled_pks)
+    return len(stalled_jobs)
@@ -0,0 +1,115 @@
+import gzip
+import zlib
+
+
+#
+# optional compression of uploaded files in storage. settings.UPLOAD_COMPRESSION selects the codec for new uploads;
+# each UploadFileJob records the one its file was stored with. COMPRESSION_ZSTD requires the optional `zstandard`
+# package
+#
+
+COMPRESSION_NONE = ''
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_ZSTD = 'zstd'
+
+COMPRESSION_CHOICES = (
+    (COMPRESSION_NONE, 'none'),
+    (COMPRESSION_GZIP, 'gzip'),
+    (COMPRESSION_ZSTD, 'zstd'),
+)
+
+COMPRESSION_EXTENSIONS = {COMPRESSION_NONE: '', COMPRESSION_GZIP: '.gz', COMPRESSION_ZSTD: '.zst'}
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def compressor(compression):
+    """
+    :return: an incremental compressor for compression, with compress(data) and flush() methods that each return
+        compressed bytes
+    """
+    if compression == COMPRESSION_GZIP:
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # 16+: gzip header and trailer
+    elif compression == COMPRESSION_ZSTD:
+        return _zstandard().ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    else:
+        raise ValueError("invalid compression: {!r}".format(compression))
+
+
+def decompressing_reader(fp, compression):
+    """
+    :param fp: a binary stream with read(n). need not be seekable
+    :return: a binary stream with read(n) and close() over fp's decompressed contents. closing it closes fp. fp itself
+        if compression is COMPRESSION_NONE
+    """
+    if compression == COMPRESSION_NONE:
+        return fp
+    elif compression == COMPRESSION_GZIP:
+        return _DecompressingReader(gzip.GzipFile(fileobj=fp, mode='rb'), fp)
+    elif compression == COMPRESSION_ZSTD:
+        return _DecompressingReader(_zstandard().ZstdDecompressor().stream_reader(fp), fp)
+    else:
+        raise ValueError("invalid compression: {!r}".format(compression))
+
+
+class _DecompressingReader:
+    """
+    decompressing_reader() helper that closes the underlying stream too, which GzipFile(fileobj=...) doesn't.
+    """
+
+
+    def __init__(self, reader, fp):
+        self._reader = reader
+        self._fp = fp
+
+
+    def read(self, size=-1):
+        return self._reader.read(size)
+
+
+    def close(self):
+        try:
+            self._reader.close()
+        finally:
+            self._fp.close()
+
+
+class CompressingReader:
+    """
+    A binary stream with read(n) that returns fp's contents compressed, compressing as it goes. Tracks the compressed
+    bytes returned so far in compressed_size.
+    """
+
+
+    def __init__(self, fp, compression, chunk_size=1024 * 1024):
+        self._fp = fp
+        self._compressor = compressor(compression)
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._is_eof = False
+        self.compressed_size = 0
+
+
+    def read(self, size=-1):
+        while (not self._is_eof) and ((size is None) or (size < 0) or (len(self._buffer) < size)):
+            data = self._fp.read(self._chunk_size)
+            if data:
+                self._buffer.extend(self._compressor.compress(data))
+            else:
+                self._buffer.extend(self._compressor.flush())
+                self._is_eof = True
+        if (size is None) or (size < 0):
+            size = len(self._buffer)
+        compressed_data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self.compressed_size += len(compressed_data)
+        return compressed_data
+
+
+def _zstandard():
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        raise ImportError("zstd compression requires the `zstandard` package")
@@ -0,0 +1,78 @@
+import json
+import logging
+
+import django_rq
+
+from forecast_app.progress import EVENT_STATUS, JOB_EVENTS_CHANNEL
+
+
+logger = logging.getLogger(__name__)
+
+#
+# a compact JSON status record per UploadFileJob, kept in Redis for views.upload_file_job_status() and
+# upload_file_job_statuses(). records are written whenever an UploadFileJob changes (post_save, transition(), fail(),
+# and the views' bulk updates), so polling is served without touching the database. they're stored as JSON strings so
+# that they can be returned as is. each write is also published as a 'status' event - see forecast_app.progress
+#
+
+JOB_STATUS_KEY = 'forecast_app:job_status:{}'  # format()ted with the UploadFileJob pk
+JOB_STATUS_TTL = 24 * 60 * 60  # seconds. expired records are re-read from the database on demand
+
+JOB_STATUS_DELETE_BATCH_SIZE = 1000  # max keys per DEL in delete_job_statuses()
+
+
+def job_status_record(upload_file_job):
+    """
+    :return: upload_file_job's status record: a dict with 'id', 'status' (name), 'is_failed', 'failure_message',
+        'updated_at' (ISO 8601), and 'output_json'
+    """
+    return {'id': upload_file_job.pk,
+            'status': upload_file_job.status_as_str(),
+            'is_failed': upload_file_job.is_failed,
+            'failure_message': upload_file_job.failure_message,
+            'updated_at': upload_file_job.updated_at.isoformat() if upload_file_job.updated_at else None,
+            'output_json': upload_file_job.output_json}
+
+
+def cache_job_statuses(upload_file_jobs):
+    """
+    Writes the status records of upload_file_jobs (in-memory, i.e., as the caller last set them) and publishes them as
+    'status' events, in one Redis pipeline. Errors are logged rather than raised b/c the database is the source of
+    truth.
+    """
+    try:
+        with django_rq.get_connection().pipeline(transaction=False) as pipe:
+            for upload_file_job in upload_file_jobs:
+                status_record = job_status_record(upload_file_job)
+                pipe.set(JOB_STATUS_KEY.format(upload_file_job.pk), json.dumps(status_record), ex=JOB_STATUS_TTL)
+                pipe.publish(JOB_EVENTS_CHANNEL.format(upload_file_job.pk),
+                             json.dumps({'event': EVENT_STATUS, 'data': status_record}))
+            pipe.execute()
+    except Exception as exc:
+        logger.error("cache_job_statuses(): Error: {}".format(exc))
+
+
+def delete_job_statuses(upload_file_job_pks):
+    """
+    Deletes the status records of upload_file_job_pks in one Redis pipeline, JOB_STATUS_DELETE_BATCH_SIZE keys per DEL.
+    Errors are logged rather than raised.
+    """
+    keys = [JOB_STATUS_KEY.format(upload_file_job_pk) for upload_file_job_pk in upload_file_job_pks]
+    try:
+        with django_rq.get_connection().pipeline(transaction=False) as pipe:
+            for start in range(0, len(keys), JOB_STATUS_DELETE_BATCH_SIZE):
+                pipe.delete(*keys[start:start + JOB_STATUS_DELETE_BATCH_SIZE])
+            pipe.execute()
+    except Exception as exc:
+        logger.error("delete_job_statuses(): Error: {}. {} upload_file_job_pks".format(exc, len(keys)))
+
+
+def cached_job_status_jsons(upload_file_job_pks):
+    """
+    :return: a dict that maps each of upload_file_job_pks to its cached status record as a JSON string, or to None if
+        there isn't one
+    """
+    keys = [JOB_STATUS_KEY.format(upload_file_job_pk) for upload_file_job_pk in upload_file_job_pks]
+    values = django_rq.get_connection().mget(keys) if keys else []
+    return {upload_file_job_pk: value.decode('utf-8') if value is not None else None
+            for upload_file_job_pk, value in zip(upload_file_job_pks, values)}
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from forecast_app.models import Counter
+
+
+class Command(BaseCommand):
+    """
+    Flushes increments pending in Redis to the Counter singleton row. Only meaningful when
+    settings.COUNTER_BACKEND = 'redis'. Intended to be run on a schedule, e.g., by the Heroku Scheduler add-on, so that
+    the row catches up even when traffic is too low to trigger a flush.
+    """
+    help = "Flushes increments pending in Redis to the Counter singleton row"
+
+
+    def handle(self, *args, **options):
+        flushed = Counter.flush_pending_count()
+        self.stdout.write("flush_counter: flushed={}".format(flushed))
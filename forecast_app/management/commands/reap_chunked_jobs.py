@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from forecast_app.chunked import reap_stalled_chunked_jobs
+
+
+class Command(BaseCommand):
+    """
+    Fails UploadFileJobs being processed in chunks that stalled, e.g., b/c a worker crashed while running a chunk job -
+    see forecast_app.chunked.reap_stalled_chunked_jobs(). Intended to be run on a schedule, e.g., by the Heroku
+    Scheduler add-on.
+    """
+    help = "Fails chunked UploadFileJobs for which no chunk job finished in settings.CHUNKED_STALL_TIMEOUT seconds"
+
+
+    def handle(self, *args, **options):
+        num_failed = reap_stalled_chunked_jobs()
+        self.stdout.write("reap_chunked_jobs: failed={}".format(num_failed))
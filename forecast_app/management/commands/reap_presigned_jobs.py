@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from forecast_app.views import PRESIGNED_UPLOAD_REAP_AFTER, reap_expired_presigned_jobs
+
+
+class Command(BaseCommand):
+    """
+    Fails direct-to-S3 UploadFileJobs whose clients never completed their uploads - see
+    forecast_app.views.reap_expired_presigned_jobs(). Intended to be run on a schedule, e.g., by the Heroku Scheduler
+    add-on.
+    """
+    help = "Fails direct-to-S3 UploadFileJobs that are still PENDING {} seconds after being created" \
+        .format(PRESIGNED_UPLOAD_REAP_AFTER)
+
+
+    def handle(self, *args, **options):
+        num_failed = reap_expired_presigned_jobs()
+        self.stdout.write("reap_presigned_jobs: failed={}".format(num_failed))
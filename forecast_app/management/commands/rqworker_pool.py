@@ -0,0 +1,52 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from forecast_app.worker_pool import PrefetchingWorker, PrewarmedWorker, WorkerPool
+
+
+class Command(BaseCommand):
+    """
+    Runs a pool of long-lived, non-forking, pre-warmed RQ workers - see forecast_app.worker_pool. Queues are passed
+    either by name or via --role (see settings.RQ_WORKER_QUEUES). Passing --max-workers greater than --workers makes
+    the pool scale between the two based on the queues' lengths and wait times. --prefetch makes each worker download
+    upcoming upload jobs' files while it processes the current one.
+    """
+    help = "Runs a pool of long-lived, non-forking, pre-warmed RQ workers"
+
+
+    def add_arguments(self, parser):
+        parser.add_argument('queues', nargs='*', help="Queue names, in priority order")
+        parser.add_argument('--role', help="Use the queues listed for this key in settings.RQ_WORKER_QUEUES")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Number of worker processes (the minimum if autoscaling). default: the number of CPUs")
+        parser.add_argument('--max-workers', type=int,
+                            help="Autoscale up to this many worker processes. default: --workers, i.e., don't scale")
+        parser.add_argument('--max-jobs', type=int, default=1000,
+                            help="Jobs after which a worker process is replaced, to limit memory leaks. 0: never")
+        parser.add_argument('--prefetch', action='store_true',
+                            help="Download upcoming upload jobs' files in the background. see settings.PREFETCH_*")
+
+
+    def handle(self, *args, **options):
+        queue_names = _queue_names(options)
+        max_workers = options['max_workers'] or options['workers']
+        worker_class = PrefetchingWorker if options['prefetch'] else PrewarmedWorker
+        WorkerPool(queue_names, options['workers'], max_workers, options['max_jobs'], worker_class=worker_class).run()
+
+
+def _queue_names(options):
+    """
+    :return: the queue names from the command's queues and --role options
+    """
+    if options['role']:
+        if options['role'] not in settings.RQ_WORKER_QUEUES:
+            raise CommandError("unknown role: {!r}. choices: {}"
+                               .format(options['role'], sorted(settings.RQ_WORKER_QUEUES)))
+
+        return settings.RQ_WORKER_QUEUES[options['role']]
+    elif options['queues']:
+        return options['queues']
+    else:
+        raise CommandError("pass either queue names or --role")
@@ -0,0 +1,129 @@
+import logging
+
+import django_rq
+
+
+logger = logging.getLogger(__name__)
+
+#
+# upload pipeline metrics. each finished UploadFileJob adds its per-stage durations and byte counts to Redis hashes (one
+# HINCRBY per value, all in one pipeline), so reporting them is a few HGETALLs rather than a table scan.
+# prometheus_text() renders them for views.metrics()
+#
+
+METRICS_STAGE_KEY = 'forecast_app:metrics:stage:{}'  # format()ted with the stage name. a histogram hash
+METRICS_OUTCOMES_KEY = 'forecast_app:metrics:outcomes'  # outcome -> number of UploadFileJobs
+
+OUTCOME_SUCCESS = 'success'
+OUTCOME_FAILURE = 'failure'
+
+# histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+# (stage, start field, end field, bytes function) for each measured stage. bytes function is None if the stage has no
+# meaningful byte count
+UPLOAD_STAGES = (
+    ('upload', 'created_at', 'uploaded_at', lambda upload_file_job: upload_file_job.file_size),
+    ('queue_wait', 'queued_at', 'started_at', None),
+    ('download', 'started_at', 'downloaded_at',
+     lambda upload_file_job: upload_file_job.compressed_size or upload_file_job.file_size),
+    ('process', 'downloaded_at', 'finished_at', lambda upload_file_job: upload_file_job.file_size),
+    ('total', 'created_at', 'finished_at', None),
+)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def record_upload_file_jobs_metrics(upload_file_jobs, outcome):
+    """
+    Adds each of upload_file_jobs' stage durations - those whose start and end are both known - and byte counts to the
+    stage histograms, and counts them under outcome, in one Redis pipeline. Called by UploadFileJob.transition_many()
+    and fail_many() when they finish. Errors are logged rather than raised b/c metrics shouldn't fail jobs.
+
+    :param outcome: OUTCOME_SUCCESS or OUTCOME_FAILURE
+    """
+    try:
+        with django_rq.get_connection().pipeline(transaction=False) as pipe:
+            for upload_file_job in upload_file_jobs:
+                for stage, start_field, end_field, bytes_fcn in UPLOAD_STAGES:
+                    start, end = getattr(upload_file_job, start_field), getattr(upload_file_job, end_field)
+                    if (start is None) or (end is None):
+                        continue
+
+                    seconds = max((end - start).total_seconds(), 0)
+                    stage_key = METRICS_STAGE_KEY.format(stage)
+                    pipe.hincrby(stage_key, _bucket_field(seconds), 1)
+                    pipe.hincrby(stage_key, 'count', 1)
+                    pipe.hincrbyfloat(stage_key, 'sum', seconds)
+                    num_bytes = bytes_fcn(upload_file_job) if bytes_fcn else None
+                    if num_bytes:
+                        pipe.hincrby(stage_key, 'bytes', num_bytes)
+            pipe.hincrby(METRICS_OUTCOMES_KEY, outcome, len(upload_file_jobs))
+            pipe.execute()
+    except Exception as exc:
+        logger.error("record_upload_file_jobs_metrics(): Error: {}. upload_file_jobs={}".format(exc, upload_file_jobs))
+
+
+def _bucket_field(seconds):
+    for bucket in LATENCY_BUCKETS:
+        if seconds <= bucket:
+            return 'le:{}'.format(bucket)
+
+    return 'le:+Inf'
+
+
+def upload_stage_metrics():
+    """
+    :return: a 2-tuple: (stage_to_histogram, outcome_to_count). stage_to_histogram maps each UPLOAD_STAGES stage to a
+        dict with 'buckets' (a list of (upper bound, cumulative count) 2-tuples ending with ('+Inf', count)), 'count',
+        'sum' (seconds), and 'bytes'
+    """
+    with django_rq.get_connection().pipeline(transaction=False) as pipe:
+        for stage, _, _, _ in UPLOAD_STAGES:
+            pipe.hgetall(METRICS_STAGE_KEY.format(stage))
+        pipe.hgetall(METRICS_OUTCOMES_KEY)
+        results = pipe.execute()
+
+    stage_to_histogram = {}
+    for (stage, _, _, _), stage_hash in zip(UPLOAD_STAGES, results):
+        stage_hash = {field.decode('utf-8'): value for field, value in stage_hash.items()}
+        buckets, cumulative_count = [], 0
+        for bucket in LATENCY_BUCKETS:
+            cumulative_count += int(stage_hash.get('le:{}'.format(bucket), 0))
+            buckets.append((bucket, cumulative_count))
+        count = int(stage_hash.get('count', 0))
+        buckets.append(('+Inf', count))
+        stage_to_histogram[stage] = {'buckets': buckets, 'count': count, 'sum': float(stage_hash.get('sum', 0)),
+                                     'bytes': int(stage_hash.get('bytes', 0))}
+    outcome_to_count = {outcome.decode('utf-8'): int(count) for outcome, count in results[-1].items()}
+    return stage_to_histogram, outcome_to_count
+
+
+def prometheus_text():
+    """
+    :return: upload_stage_metrics() in the Prometheus text exposition format
+    """
+    stage_to_histogram, outcome_to_count = upload_stage_metrics()
+    lines = ['# HELP forecast_app_upload_stage_seconds Upload pipeline stage latency.',
+             '# TYPE forecast_app_upload_stage_seconds histogram']
+    for stage, _, _, _ in UPLOAD_STAGES:
+        histogram = stage_to_histogram[stage]
+        for bucket, cumulative_count in histogram['buckets']:
+            lines.append('forecast_app_upload_stage_seconds_bucket{{stage="{}",le="{}"}} {}'
+                         .format(stage, bucket, cumulative_count))
+        lines.append('forecast_app_upload_stage_seconds_sum{{stage="{}"}} {}'.format(stage, histogram['sum']))
+        lines.append('forecast_app_upload_stage_seconds_count{{stage="{}"}} {}'.format(stage, histogram['count']))
+
+    lines.extend(['# HELP forecast_app_upload_stage_bytes_total Bytes moved or processed by upload pipeline stage.',
+                  '# TYPE forecast_app_upload_stage_bytes_total counter'])
+    for stage, _, _, bytes_fcn in UPLOAD_STAGES:
+        if bytes_fcn:
+            lines.append('forecast_app_upload_stage_bytes_total{{stage="{}"}} {}'
+                         .format(stage, stage_to_histogram[stage]['bytes']))
+
+    lines.extend(['# HELP forecast_app_upload_file_jobs_total Finished UploadFileJobs by outcome.',
+                  '# TYPE forecast_app_upload_file_jobs_total counter'])
+    for outcome in (OUTCOME_SUCCESS, OUTCOME_FAILURE):
+        lines.append('forecast_app_upload_file_jobs_total{{outcome="{}"}} {}'
+                     .format(outcome, outcome_to_count.get(outcome, 0)))
+    return '\n'.join(lines) + '\n'
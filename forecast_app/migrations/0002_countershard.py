@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forecast_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CounterShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.IntegerField(help_text="This shard's index, 0 <= shard < COUNTER_NUM_SHARDS.", unique=True)),
+                ('count', models.IntegerField(default=0, help_text="This shard's part of the count.")),
+                ('last_update', models.DateTimeField(auto_now=True, help_text='Last time this shard was updated.')),
+            ],
+        ),
+    ]
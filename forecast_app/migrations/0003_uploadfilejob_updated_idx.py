@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forecast_app', '0002_countershard'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='uploadfilejob',
+            index=models.Index(fields=['updated_at', 'id'], name='upload_file_job_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forecast_app', '0003_uploadfilejob_updated_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadfilejob',
+            name='content_digest',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+            preserve_default=False,
+        ),
+    ]
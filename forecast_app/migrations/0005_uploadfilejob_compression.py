@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forecast_app', '0004_uploadfilejob_content_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadfilejob',
+            name='compression',
+            field=models.CharField(blank=True, choices=[('', 'none'), ('gzip', 'gzip'), ('zstd', 'zstd')], default='', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='uploadfilejob',
+            name='compressed_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forecast_app', '0005_uploadfilejob_compression'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadfilejob',
+            name='file_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='uploadfilejob',
+            name='uploaded_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='uploadfilejob',
+            name='queued_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='uploadfilejob',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='uploadfilejob',
+            name='downloaded_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='uploadfilejob',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
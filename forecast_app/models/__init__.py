@@ -1,7 +1,7 @@
 # per https://docs.djangoproject.com/en/1.11/topics/db/models/#organizing-models-in-a-package
 
 
-from .counter import Counter
+from .counter import Counter, CounterShard
 from .upload_file_job import UploadFileJob
 
 # __all__ = ['Article', 'Publication']
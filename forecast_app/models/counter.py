@@ -1,7 +1,15 @@
 import logging
+import random
 import time
 
+import django_rq
+from django.conf import settings
 from django.db import models
+from django.db.models import F, Max, Sum
+from django.utils import timezone
+
+from forecast_app.caching import invalidate_counter_cache
+from forecast_app.rq_utils import RQ_QUEUE_FAST
 
 
 logger = logging.getLogger(__name__)
@@ -14,6 +22,35 @@ def basic_str(obj):
     return obj.__class__.__name__ + ': ' + obj.__repr__()
 
 
+#
+# Counter backends. settings.COUNTER_BACKEND selects how Counter.increment_count() records increments:
+# - COUNTER_BACKEND_DB: read-modify-write the singleton row (the original, simulated long-running job)
+# - COUNTER_BACKEND_REDIS: atomic INCRBY on a Redis key, flushed to the singleton row (write-behind) when
+#   COUNTER_FLUSH_THRESHOLD increments are pending or COUNTER_FLUSH_INTERVAL seconds have passed since the last flush
+# - COUNTER_BACKEND_SHARDED: atomic `count = count + N` UPDATE on one of COUNTER_NUM_SHARDS randomly-chosen CounterShard
+#   rows, so that concurrent workers don't serialize on a single row lock
+#
+
+COUNTER_BACKEND_DB = 'db'
+COUNTER_BACKEND_REDIS = 'redis'
+COUNTER_BACKEND_SHARDED = 'sharded'
+
+REDIS_PENDING_COUNT_KEY = 'forecast_app:counter:pending'  # increments not yet flushed to the singleton row
+REDIS_FLUSH_INTERVAL_KEY = 'forecast_app:counter:flush_interval'  # exists (with a TTL) until the next flush is due
+
+#
+# Coalesced increment jobs. Counter.enqueue_increment_count() adds to a pending delta in Redis and enqueues an
+# apply_coalesced_increments() job only if none is already waiting, so a burst of N increments costs one job
+#
+
+REDIS_COALESCED_DELTA_KEY = 'forecast_app:counter:coalesced_delta'  # increments waiting for the coalesced job
+REDIS_COALESCED_JOB_KEY = 'forecast_app:counter:coalesced_job'  # exists while a coalesced job is waiting
+
+
+def counter_backend():
+    return getattr(settings, 'COUNTER_BACKEND', COUNTER_BACKEND_DB)
+
+
 class Counter(models.Model):
     """
     A simple model that's used as a singleton.
@@ -34,25 +71,196 @@ class Counter(models.Model):
 
     @classmethod
     def get_count_and_last_update(cls):
+        """
+        :return: a 2-tuple: (count, last_update). for COUNTER_BACKEND_REDIS the count includes increments that have not
+            been flushed yet, and last_update is the time of the last flush. NB: that count is approximate b/c the
+            pending count and the row can't be read atomically. the pending count is read first so that a
+            flush_pending_count() that lands between the two reads makes the count briefly too high by the flushed
+            amount rather than too low
+        """
+        if counter_backend() == COUNTER_BACKEND_SHARDED:
+            return CounterShard.get_count_and_last_update()
+
+        pending = 0
+        if counter_backend() == COUNTER_BACKEND_REDIS:
+            pending = int(django_rq.get_connection().get(REDIS_PENDING_COUNT_KEY) or 0)
         singleton = cls._get_singleton_record()
-        return singleton.count, singleton.last_update
+        return singleton.count + pending, singleton.last_update
+
+
+    @classmethod
+    def increment_count(cls, by=1):
+        """
+        enqueue() helper function. Increments the count by `by` using the backend selected by settings.COUNTER_BACKEND.
+        """
+        backend = counter_backend()
+        if backend == COUNTER_BACKEND_REDIS:
+            cls._increment_count_redis(by)
+        elif backend == COUNTER_BACKEND_SHARDED:
+            CounterShard.increment_count(by)
+        else:
+            cls._increment_count_db(by)
+        invalidate_counter_cache()
 
 
     @classmethod
-    def increment_count(cls):
+    def enqueue_increment_count(cls, by=1):
         """
-        enqueue() helper function. simulates a long-running operation
+        A coalescing alternative to django_rq.enqueue(Counter.increment_count). Adds `by` to the pending delta and, if
+        no apply_coalesced_increments() job is waiting, enqueues one. The SET NX marker expires after
+        settings.COUNTER_COALESCED_JOB_TTL seconds so that a lost job (e.g., an emptied queue) can't stall increments
+        forever.
+
+        :return: the newly-enqueued RQ job, or None if the increment was folded into an already-waiting job
+        """
+        conn = django_rq.get_connection()  # name='default'
+        conn.incrby(REDIS_COALESCED_DELTA_KEY, by)
+        if not conn.set(REDIS_COALESCED_JOB_KEY, 1, ex=settings.COUNTER_COALESCED_JOB_TTL, nx=True):
+            return None
+
+        try:
+            return django_rq.get_queue(RQ_QUEUE_FAST).enqueue(cls.apply_coalesced_increments)
+        except Exception:
+            conn.delete(REDIS_COALESCED_JOB_KEY)  # let the next caller enqueue. the delta stays pending
+            raise
+
+
+    @classmethod
+    def apply_coalesced_increments(cls):
+        """
+        enqueue() helper function. Applies the whole pending delta in one increment_count() call. The marker is removed
+        *before* claiming the delta so that any increment that arrives after the claim enqueues a new job, i.e., none
+        are stranded. (A new job that finds the delta already claimed is a no-op.)
+        """
+        conn = django_rq.get_connection()  # name='default'
+        conn.delete(REDIS_COALESCED_JOB_KEY)
+        delta = int(conn.getset(REDIS_COALESCED_DELTA_KEY, 0) or 0)
+        logger.debug("apply_coalesced_increments(): delta={}".format(delta))
+        if not delta:
+            return
+
+        try:
+            cls.increment_count(by=delta)
+        except Exception:
+            conn.incrby(REDIS_COALESCED_DELTA_KEY, delta)  # picked up by the next enqueued job
+            raise
+
+
+    @classmethod
+    def forget_coalesced_job(cls):
+        """
+        Removes the waiting-job marker, e.g., after the queue was emptied, so that the next enqueue_increment_count()
+        enqueues a new job to apply the pending delta.
+        """
+        django_rq.get_connection().delete(REDIS_COALESCED_JOB_KEY)
+
+
+    @classmethod
+    def _increment_count_db(cls, by):
+        """
+        Simulates a long-running operation. NB: concurrent calls can lose updates b/c of the read-modify-write.
         """
         singleton = cls._get_singleton_record()
         logger.debug("increment_count(): started. singleton={}".format(singleton))
         time.sleep(2)
         logger.debug("increment_count(): back awake".format())
-        singleton.count += 1
+        singleton.count += by
         singleton.save()  # updates updated_at via auto_now
         logger.debug("increment_count(): done. singleton={}".format(singleton))
 
 
+    @classmethod
+    def _increment_count_redis(cls, by):
+        """
+        Atomically adds `by` to the pending count in Redis, flushing it to the singleton row if it's time to.
+        """
+        conn = django_rq.get_connection()  # name='default'
+        pending = conn.incrby(REDIS_PENDING_COUNT_KEY, by)
+        # NB: the SET NX doubles as a lock so that only one caller per interval does the time-based flush
+        if (pending >= settings.COUNTER_FLUSH_THRESHOLD) \
+                or conn.set(REDIS_FLUSH_INTERVAL_KEY, 1, ex=settings.COUNTER_FLUSH_INTERVAL, nx=True):
+            cls.flush_pending_count()
+
+
+    @classmethod
+    def flush_pending_count(cls):
+        """
+        Moves the pending count from Redis to the singleton row. Safe to call concurrently: GETSET atomically claims the
+        pending increments, and the row is updated with a single `count = count + N` UPDATE. If the UPDATE fails then
+        the claimed increments are put back so that they are not lost.
+
+        :return: the number of increments flushed
+        """
+        conn = django_rq.get_connection()  # name='default'
+        pending = int(conn.getset(REDIS_PENDING_COUNT_KEY, 0) or 0)
+        if not pending:
+            return 0
+
+        try:
+            cls._get_singleton_record()  # make sure the row exists before the UPDATE
+            cls.objects.filter(pk=1).update(count=F('count') + pending, last_update=timezone.now())
+        except Exception as exc:
+            conn.incrby(REDIS_PENDING_COUNT_KEY, pending)
+            logger.error("flush_pending_count(): Failed. restored pending={}: {}".format(pending, exc))
+            raise
+
+        invalidate_counter_cache()  # last_update changed
+        logger.debug("flush_pending_count(): flushed={}".format(pending))
+        return pending
+
+
     @classmethod
     def _get_singleton_record(cls):
         obj, created = cls.objects.get_or_create(pk=1)
         return obj
+
+
+class CounterShard(models.Model):
+    """
+    One of settings.COUNTER_NUM_SHARDS rows whose counts sum to the counter's value. Used by COUNTER_BACKEND_SHARDED.
+    Rows are created on demand.
+    """
+    shard = models.IntegerField(help_text="This shard's index, 0 <= shard < COUNTER_NUM_SHARDS.", unique=True)
+
+    count = models.IntegerField(help_text="This shard's part of the count.", default=0)
+
+    last_update = models.DateTimeField(help_text="Last time this shard was updated.", auto_now=True)
+
+
+    def __repr__(self):
+        return str((self.pk, self.shard, self.count, self.last_update))
+
+
+    def __str__(self):  # todo
+        return basic_str(self)
+
+
+    @classmethod
+    def get_count_and_last_update(cls):
+        """
+        :return: a 2-tuple: (sum of all shards' counts, most recent shard last_update). last_update is None if no shard
+            has been incremented yet
+        """
+        aggregate = cls.objects.aggregate(count=Sum('count'), last_update=Max('last_update'))
+        return aggregate['count'] or 0, aggregate['last_update']
+
+
+    @classmethod
+    def increment_count(cls, by=1):
+        """
+        Adds `by` to a randomly-chosen shard with a single atomic UPDATE, creating the shard row the first time it's
+        hit.
+        """
+        shard = random.randrange(settings.COUNTER_NUM_SHARDS)
+        if not cls._increment_shard(shard, by):
+            cls.objects.get_or_create(shard=shard)
+            cls._increment_shard(shard, by)
+
+
+    @classmethod
+    def _increment_shard(cls, shard, by):
+        """
+        :return: True if the shard row existed (and was incremented)
+        """
+        # NB: update() bypasses auto_now, so set last_update explicitly
+        return cls.objects.filter(shard=shard).update(count=F('count') + by, last_update=timezone.now()) > 0
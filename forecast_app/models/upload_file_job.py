@@ -1,22 +1,36 @@
+import io
+import json
 import logging
+import mmap
+import shutil
 import tempfile
-from contextlib import contextmanager
+import threading
+from collections import OrderedDict
+from contextlib import closing, contextmanager
 
-import boto3
-from django.db import models
-from django.db.models import BooleanField
-from django.db.models.signals import pre_delete
+from django.db import connection, models
+from django.db.models import BooleanField, Q
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from jsonfield import JSONField
 
+from forecast_app.caching import invalidate_upload_file_jobs_cache
+from forecast_app.compression import COMPRESSION_CHOICES, COMPRESSION_EXTENSIONS, COMPRESSION_NONE, \
+    decompressing_reader
+from forecast_app.job_status import cache_job_statuses, delete_job_statuses
+from forecast_app.metrics import OUTCOME_FAILURE, OUTCOME_SUCCESS, record_upload_file_jobs_metrics
 from forecast_app.models.counter import basic_str
+from forecast_app.prefetch import take_prefetched_file
+from forecast_app.progress import ProgressReporter
+from forecast_app.result_cache import get_cached_results, put_cached_result
+from forecast_app.storage import get_storage
 
 
 logger = logging.getLogger(__name__)
 
-S3_UPLOAD_BUCKET_NAME = 'mc.zoltarapp.sandbox'
-
 
 class UploadFileJob(models.Model):
     """
@@ -38,6 +52,14 @@ class UploadFileJob(models.Model):
     )
     status = models.IntegerField(default=PENDING, choices=STATUS_CHOICES)
 
+    # the field that transition() sets to the current time when transitioning to each status
+    STATUS_TIMESTAMP_FIELDS = {
+        S3_FILE_UPLOADED: 'uploaded_at',
+        QUEUED: 'queued_at',
+        S3_FILE_DOWNLOADED: 'started_at',
+        SUCCESS: 'finished_at',
+    }
+
     # user = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True)  # user who submitted
 
     created_at = models.DateTimeField(auto_now_add=True)  # when this instance was created. basically the submit date
@@ -56,6 +78,34 @@ class UploadFileJob(models.Model):
     # app-specific results from a successful completion of the upload. ex: 'forecast_pk':
     output_json = JSONField(null=True, blank=True)
 
+    # hex SHA-256 of the uploaded file's bytes, computed while it streamed in. empty if unknown. see s3_key()
+    content_digest = models.CharField(max_length=64, blank=True, db_index=True)
+
+    # how the uploaded file is compressed in storage (see forecast_app.compression), and its size there if compressed.
+    # upload_file_job_s3_file() decompresses transparently
+    compression = models.CharField(max_length=10, choices=COMPRESSION_CHOICES, default=COMPRESSION_NONE, blank=True)
+
+    compressed_size = models.BigIntegerField(null=True, blank=True)
+
+    # per-stage timing, for forecast_app.metrics. the *_at fields are set by transition() (see STATUS_TIMESTAMP_FIELDS)
+    # except downloaded_at (when the worker had read the whole file) and finished_at, which is also set by fail().
+    # stages: upload = created_at -> uploaded_at, queue wait = queued_at -> started_at, download = started_at ->
+    # downloaded_at, process = downloaded_at -> finished_at. NB: with S3_FILE_MODE_STREAM, processing overlaps the
+    # download, so download includes that processing and process is just what's left after the last byte was read
+    file_size = models.BigIntegerField(null=True, blank=True)  # uncompressed bytes uploaded
+    uploaded_at = models.DateTimeField(null=True, blank=True)
+    queued_at = models.DateTimeField(null=True, blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    downloaded_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+
+    class Meta:
+        indexes = [
+            # supports upload_file_jobs_page()'s keyset pagination on (updated_at, id)
+            models.Index(fields=['updated_at', 'id'], name='upload_file_job_updated_idx'),
+        ]
+
 
     def __repr__(self):
         return str((self.pk, self.created_at, self.updated_at, self.filename, self.status_as_str(),
@@ -78,6 +128,105 @@ class UploadFileJob(models.Model):
         return self.updated_at - self.created_at
 
 
+    def transition(self, from_status, to_status, **fields):
+        """
+        A compare-and-set status change: sets my status to to_status (plus any passed fields) with one UPDATE of just
+        those columns that applies only if I'm not failed and my status in the database is from_status. Unlike save()
+        this doesn't rewrite every column (including the JSON ones), and the web process and workers can't overwrite
+        each other's status. This instance is updated only if the transition applied.
+
+        :param from_status: the expected current status, or a list of them
+        :param to_status: the new status
+        :param fields: other fields to set, e.g., output_json=...
+        :return: True if the transition applied, False otherwise (e.g., another job got there first)
+        """
+        return bool(UploadFileJob.transition_many([self], from_status, to_status, **fields))
+
+
+    @classmethod
+    def transition_many(cls, upload_file_jobs, from_status, to_status, **fields):
+        """
+        transition() for a batch of UploadFileJobs: one UPDATE, one status-record pipeline, and one metrics pipeline.
+
+        :return: the list of upload_file_jobs that were transitioned, i.e., those that weren't failed and were
+            from_status. only those are updated in memory (and the caller should only continue with those)
+        """
+        from_statuses = from_status if isinstance(from_status, (list, tuple)) else [from_status]
+        now = timezone.now()
+        fields = dict(fields, status=to_status, updated_at=now)  # NB: update() bypasses auto_now
+        if to_status in UploadFileJob.STATUS_TIMESTAMP_FIELDS:
+            fields.setdefault(UploadFileJob.STATUS_TIMESTAMP_FIELDS[to_status], now)
+        upload_file_job_pks = [upload_file_job.pk for upload_file_job in upload_file_jobs]
+        num_updated = cls.objects.filter(pk__in=upload_file_job_pks, status__in=from_statuses, is_failed=False) \
+            .update(**fields)
+        if num_updated == len(upload_file_jobs):
+            transitioned_jobs = list(upload_file_jobs)
+        elif num_updated == 0:
+            transitioned_jobs = []
+        else:  # re-select the rows this UPDATE changed, which are the ones with its updated_at
+            transitioned_pks = set(cls.objects.filter(pk__in=upload_file_job_pks, status=to_status, is_failed=False,
+                                                      updated_at=now)
+                                   .values_list('id', flat=True))
+            transitioned_jobs = [upload_file_job for upload_file_job in upload_file_jobs
+                                 if upload_file_job.pk in transitioned_pks]
+        if len(transitioned_jobs) < len(upload_file_jobs):
+            logger.debug("transition_many(): Not applied to {} of {} jobs: {} -> {}. upload_file_jobs={}"
+                         .format(len(upload_file_jobs) - len(transitioned_jobs), len(upload_file_jobs),
+                                 from_statuses, to_status, upload_file_jobs))
+        if not transitioned_jobs:
+            return []
+
+        for upload_file_job in transitioned_jobs:
+            for field_name, value in fields.items():
+                setattr(upload_file_job, field_name, value)
+        invalidate_upload_file_jobs_cache()  # NB: update() doesn't send post_save
+        cache_job_statuses(transitioned_jobs)
+        if to_status == UploadFileJob.SUCCESS:
+            record_upload_file_jobs_metrics(transitioned_jobs, OUTCOME_SUCCESS)
+        return transitioned_jobs
+
+
+    def fail(self, failure_message, **fields):
+        """
+        Marks me failed with one UPDATE of just is_failed, failure_message, finished_at, and any passed fields (e.g.,
+        downloaded_at), regardless of my status.
+        """
+        UploadFileJob.fail_many([self], failure_message, **fields)
+
+
+    @classmethod
+    def fail_many(cls, upload_file_jobs, failure_message, **fields):
+        """
+        fail() for a batch of UploadFileJobs: one UPDATE, one status-record pipeline, and one metrics pipeline.
+        """
+        fields.update(is_failed=True, updated_at=timezone.now(),
+                      failure_message=failure_message[:cls._meta.get_field('failure_message').max_length])
+        fields.setdefault('finished_at', fields['updated_at'])
+        cls.objects.filter(pk__in=[upload_file_job.pk for upload_file_job in upload_file_jobs]).update(**fields)
+        for upload_file_job in upload_file_jobs:
+            for field_name, value in fields.items():
+                setattr(upload_file_job, field_name, value)
+        invalidate_upload_file_jobs_cache()
+        cache_job_statuses(upload_file_jobs)
+        record_upload_file_jobs_metrics(upload_file_jobs, OUTCOME_FAILURE)
+
+
+    @classmethod
+    def approximate_count(cls):
+        """
+        :return: the number of UploadFileJobs, cheaply. On Postgres this is the planner's estimate (pg_class.reltuples)
+            unless that's small enough that an exact COUNT(*) is also cheap. Other databases get an exact count
+        """
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = %s", [cls._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] > APPROXIMATE_COUNT_MIN:  # reltuples is 0 or -1 until the table is first analyzed
+                return row[0]
+
+        return cls.objects.count()
+
+
     #
     # S3 and RQ service-specific keys/ids
     #
@@ -86,9 +235,14 @@ class UploadFileJob(models.Model):
 
     def s3_key(self):
         """
-        :return: the S3 key in S3_UPLOAD_BUCKET_NAME corresponding to me
+        :return: the storage (see get_storage()) key corresponding to me. this is content-addressed once content_digest
+            is known, so UploadFileJobs with identical files share one object. before that (e.g., while a streaming
+            upload is in progress, or for direct-to-S3 uploads) it's specific to me
         """
-        return str(self.pk)
+        if self.content_digest:  # NB: the same content compressed differently is a different object
+            return CONTENT_ADDRESSED_KEY_PREFIX + self.content_digest + COMPRESSION_EXTENSIONS[self.compression]
+        else:
+            return str(self.pk)
 
 
     def rq_job_id(self):
@@ -105,71 +259,428 @@ class UploadFileJob(models.Model):
         delete would fail but everything preceding it would succeed...
 
         Apps can infer this condition by looking for non-deleted S3 objects whose status != SUCCESS .
+
+        A content-addressed object is left alone if another UploadFileJob that's still in progress shares it. NB: this
+        is best-effort - a job that starts sharing the object between the check and the delete will fail to find it.
         """
+        if self.content_digest and UploadFileJob.objects \
+                .filter(content_digest=self.content_digest, is_failed=False, status__lt=UploadFileJob.SUCCESS) \
+                .exclude(pk=self.pk).exists():
+            logger.debug("delete_s3_object(): Skipped - shared with an in-progress UploadFileJob: {}".format(self))
+            return
+
         try:
             logger.debug("delete_s3_object(): Started: {}".format(self))
-            s3 = boto3.resource('s3')
-            s3.Object(S3_UPLOAD_BUCKET_NAME, self.s3_key()).delete()
+            get_storage().delete(self.s3_key())
             logger.debug("delete_s3_object(): Done: {}".format(self))
         except Exception as exc:
             logger.debug("delete_s3_object(): Failed: {}, {}".format(exc, self))
 
 
+#
+# content-addressed storage and result memoisation. uploads whose content_digest is known are stored under
+# CONTENT_ADDRESSED_KEY_PREFIX + content_digest, and successful results are cached by (content_digest, input_json) - see
+# forecast_app.result_cache
+#
+
+CONTENT_ADDRESSED_KEY_PREFIX = 'sha256-'
+
+
+def store_content_addressed(upload_file_job, content_digest):
+    """
+    Moves upload_file_job's uploaded object from its per-job key to its content-addressed one, or just deletes it if an
+    identical object is already stored there. Saves content_digest first so that the shared object counts as in use by
+    upload_file_job (see delete_s3_object()).
+
+    If the move fails and nothing was stored at the content-addressed key then upload_file_job falls back to its per-job
+    object, i.e., its content_digest is cleared and it's processed without deduplication or a result-cache lookup. If
+    deleting the per-job object fails then that's logged and the object is left behind - see delete_s3_object().
+    """
+    staging_key = upload_file_job.s3_key()
+    upload_file_job.content_digest = content_digest
+    upload_file_job.save(update_fields=['content_digest', 'updated_at'])
+    storage = get_storage()
+    try:
+        if not storage.exists(upload_file_job.s3_key()):
+            storage.move(staging_key, upload_file_job.s3_key())
+            return
+
+        logger.debug("store_content_addressed(): Duplicate content. upload_file_job={}".format(upload_file_job))
+    except Exception as exc:
+        if not _is_stored(storage, upload_file_job.s3_key()):  # NB: S3 may have failed after the move's copy
+            logger.warning("store_content_addressed(): Error moving the file. Keeping the per-job object: {}. "
+                           "upload_file_job={}".format(exc, upload_file_job))
+            upload_file_job.content_digest = ''
+            upload_file_job.save(update_fields=['content_digest', 'updated_at'])
+            return
+
+    try:
+        storage.delete(staging_key)
+    except Exception as exc:
+        logger.warning("store_content_addressed(): Error deleting the per-job object: {}. staging_key={}, "
+                       "upload_file_job={}".format(exc, staging_key, upload_file_job))
+
+
+def _is_stored(storage, key):
+    """
+    :return: True if key's object exists in storage, or False if it doesn't or that couldn't be determined
+    """
+    try:
+        return storage.exists(key)
+    except Exception as exc:
+        logger.warning("_is_stored(): Error: {}. key={}".format(exc, key))
+        return False
+
+
+def complete_from_result_cache(upload_file_job):
+    """
+    If a result is cached for upload_file_job's content_digest and input_json, completes it with that output_json
+    (status SUCCESS) and deletes its S3 object, i.e., it doesn't need to be processed.
+
+    :return: True if upload_file_job was completed, False if it needs to be processed
+    """
+    return bool(complete_many_from_result_cache([upload_file_job]))
+
+
+def complete_many_from_result_cache(upload_file_jobs):
+    """
+    complete_from_result_cache() for a batch of S3_FILE_UPLOADED UploadFileJobs: one HMGET for their cached results,
+    and one UPDATE per distinct cached result, i.e., per distinct file if they share input_json.
+
+    :return: the list of upload_file_jobs that were completed. the others need to be processed
+    """
+    upload_file_jobs = [upload_file_job for upload_file_job in upload_file_jobs if upload_file_job.content_digest]
+    cached_results = get_cached_results([(upload_file_job.content_digest, upload_file_job.input_json)
+                                         for upload_file_job in upload_file_jobs])
+    result_key_to_hit_jobs = OrderedDict()  # jobs with the same content_digest and input_json share a cached result
+    for upload_file_job, (is_hit, output_json) in zip(upload_file_jobs, cached_results):
+        if is_hit:
+            result_key = (upload_file_job.content_digest, json.dumps(upload_file_job.input_json, sort_keys=True))
+            result_key_to_hit_jobs.setdefault(result_key, (output_json, []))[1].append(upload_file_job)
+
+    completed_jobs = []
+    for output_json, hit_jobs in result_key_to_hit_jobs.values():
+        hit_jobs = UploadFileJob.transition_many(hit_jobs, UploadFileJob.S3_FILE_UPLOADED, UploadFileJob.SUCCESS,
+                                                 output_json=output_json)
+        # one delete per object. NB: jobs sharing an object don't block its delete b/c they're no longer in progress
+        for upload_file_job in OrderedDict((hit_job.s3_key(), hit_job) for hit_job in hit_jobs).values():
+            upload_file_job.delete_s3_object()
+        completed_jobs.extend(hit_jobs)
+    if completed_jobs:
+        logger.debug("complete_many_from_result_cache(): Completed {} jobs. upload_file_jobs={}"
+                     .format(len(completed_jobs), completed_jobs))
+    return completed_jobs
+
+
+#
+# keyset (cursor) pagination of UploadFileJobs, newest first. cursors are "<updated_at ISO 8601>,<pk>" strings, so a
+# page is one index range scan regardless of how many rows precede it
+#
+
+APPROXIMATE_COUNT_MIN = 10000  # approximate_count() does an exact count below this many estimated rows
+
+# the only columns shown in listings. in particular this defers the potentially large input_json and output_json
+UPLOAD_FILE_JOB_LIST_FIELDS = ('id', 'created_at', 'updated_at', 'filename', 'status', 'is_failed', 'failure_message')
+
+
+def upload_file_jobs_page(cursor=None, page_size=50):
+    """
+    :param cursor: None for the first page, or a next_cursor returned by a previous call
+    :param page_size: max number of UploadFileJobs to return
+    :return: a 2-tuple: (list of UploadFileJobs ordered by descending (updated_at, pk), next_cursor). next_cursor is
+        None if this is the last page. the UploadFileJobs have only UPLOAD_FILE_JOB_LIST_FIELDS loaded
+    :raises ValueError: if cursor is malformed
+    """
+    upload_file_jobs = UploadFileJob.objects.only(*UPLOAD_FILE_JOB_LIST_FIELDS).order_by('-updated_at', '-id')
+    if cursor:
+        updated_at, pk = parse_upload_file_jobs_cursor(cursor)
+        upload_file_jobs = upload_file_jobs.filter(Q(updated_at__lt=updated_at) | Q(updated_at=updated_at, id__lt=pk))
+    upload_file_jobs = list(upload_file_jobs[:page_size + 1])  # the extra row tells us whether there's a next page
+    if len(upload_file_jobs) <= page_size:
+        return upload_file_jobs, None
+
+    upload_file_jobs = upload_file_jobs[:page_size]
+    last_upload_file_job = upload_file_jobs[-1]
+    return upload_file_jobs, '{},{}'.format(last_upload_file_job.updated_at.isoformat(), last_upload_file_job.pk)
+
+
+def parse_upload_file_jobs_cursor(cursor):
+    """
+    :return: a 2-tuple: (updated_at, pk) parsed from a cursor returned by upload_file_jobs_page()
+    :raises ValueError: if cursor is malformed
+    """
+    updated_at_str, _, pk_str = cursor.rpartition(',')
+    updated_at = parse_datetime(updated_at_str)
+    if not updated_at:
+        raise ValueError("invalid cursor: {!r}".format(cursor))
+
+    return updated_at, int(pk_str)
+
+
 #
 # the context manager for use by django_rq.enqueue() calls by views._upload_file()
 #
 
+# modes for upload_file_job_s3_file()'s s3_file_fp
+S3_FILE_MODE_TEMPFILE = 'tempfile'  # the whole object downloaded to a seekable temporary file
+S3_FILE_MODE_STREAM = 'stream'  # a buffered binary reader over the S3 GET response. processing starts immediately
+S3_FILE_MODE_MMAP = 'mmap'  # the whole object downloaded to a temporary file and memory-mapped read-only
+
+S3_STREAM_BUFFER_SIZE = 1024 * 1024  # read size for S3_FILE_MODE_STREAM
+
+
 @contextmanager
-def upload_file_job_s3_file(upload_file_job_pk):
+def upload_file_job_s3_file(upload_file_job_pk, mode=S3_FILE_MODE_TEMPFILE, byte_range=None, is_report_progress=False):
     """
     A context manager for use by django_rq.enqueue() calls by views._upload_file().
 
     Does the following setup:
-    - get the UploadFileJob for upload_file_job_pk
-    - download the corresponding S3 object/file data into a temporary file, setting the UploadFileJob's status to
-      S3_FILE_DOWNLOADED
-    - pass the temporary file's fp to this context's caller
+    - get the UploadFileJob for upload_file_job_pk and claim it by transitioning its status from S3_FILE_UPLOADED or
+      QUEUED to S3_FILE_DOWNLOADED (see UploadFileJob.transition()). raises RuntimeError if that doesn't apply, e.g.,
+      b/c another job already claimed it
+    - make the corresponding S3 object/file data available according to `mode`
+    - pass the resulting fp to this context's caller (plus a ProgressReporter if is_report_progress)
     - set the UploadFileJob's status to SUCCESS
 
     Does this cleanup:
     - delete the S3 object, regardless of success or failure
 
     :param upload_file_job_pk: PK of the corresponding UploadFileJob instance
+    :param mode: how the data is passed to the caller. one of:
+        - S3_FILE_MODE_TEMPFILE: a seekable temporary file containing the whole object
+        - S3_FILE_MODE_STREAM: an io.BufferedReader that reads from S3 as it goes. iterate over it for lines, or call
+          read(n) for chunks. not seekable. use this for one pass over large files: there's no download to wait for,
+          and memory use is bounded by S3_STREAM_BUFFER_SIZE
+        - S3_FILE_MODE_MMAP: a read-only mmap.mmap of a temporary file containing the whole object, for cheap random
+          access (slicing, find(), seek() + readline()). NB: an empty object is passed as an (empty) temporary file
+          b/c zero-length files can't be mapped
+    :param byte_range: optional 2-tuple (first_byte, last_byte), both inclusive as in the HTTP Range header (last_byte
+        may be None for "to the end"). if passed then only that part of the object is fetched. not supported for
+        compressed files
+    :param is_report_progress: True to pass a 3-tuple (upload_file_job, s3_file_fp, progress) rather than a 2-tuple,
+        where progress is a forecast_app.progress.ProgressReporter whose update() the caller should call as it goes,
+        e.g., progress.update(num_bytes=..., num_lines=...). its phase is 'downloading' and then 'processing'
+
+    In all modes the file is decompressed transparently if it was stored compressed (see UploadFileJob.compression).
+    If a worker_pool.PrefetchingWorker already downloaded the file (see forecast_app.prefetch) then that copy is used.
     """
     # __enter__()
     upload_file_job = get_object_or_404(UploadFileJob, pk=upload_file_job_pk)
-    logger.debug("upload_file_job_s3_file(): Started. upload_file_job={}".format(upload_file_job))
-    with tempfile.TemporaryFile() as s3_file_fp:
-        try:
-            logger.debug("upload_file_job_s3_file(): Downloading from S3: {}, {}. upload_file_job={}"
-                         .format(S3_UPLOAD_BUCKET_NAME, upload_file_job.s3_key(), upload_file_job))
-            s3 = boto3.client('s3')  # using client here instead of higher-level resource b/c want to save to a fp
-            s3.download_fileobj(S3_UPLOAD_BUCKET_NAME, upload_file_job.s3_key(), s3_file_fp)
-            upload_file_job.status = UploadFileJob.S3_FILE_DOWNLOADED
-            upload_file_job.save()
-
+    logger.debug("upload_file_job_s3_file(): Started. upload_file_job={}, mode={}, byte_range={}"
+                 .format(upload_file_job, mode, byte_range))
+    if not upload_file_job.transition([UploadFileJob.S3_FILE_UPLOADED, UploadFileJob.QUEUED],
+                                      UploadFileJob.S3_FILE_DOWNLOADED):  # claim it
+        raise RuntimeError("upload_file_job_s3_file(): UploadFileJob is not awaiting processing, e.g., another job is "
+                           "processing it or it failed. upload_file_job={}".format(upload_file_job))
+
+    downloaded_at = None  # NB: saved with the final transition, to save a write
+    is_success = False
+
+    def set_downloaded_at():
+        nonlocal downloaded_at
+        downloaded_at = timezone.now()
+
+    progress = ProgressReporter(upload_file_job.pk, upload_file_job.file_size) if is_report_progress else None
+    try:
+        if progress:
+            progress.update(phase='downloading')
+        prefetched_fp = None if byte_range \
+            else take_prefetched_file(upload_file_job.rq_job_id(), upload_file_job.s3_key())
+        logger.debug("upload_file_job_s3_file(): Downloading from storage: {}, {}, prefetched={}. upload_file_job={}"
+                     .format(get_storage(), upload_file_job.s3_key(), prefetched_fp is not None, upload_file_job))
+        with _s3_file_fp(upload_file_job.s3_key(), mode, byte_range, upload_file_job.compression, prefetched_fp,
+                         set_downloaded_at) as s3_file_fp:
             # make the context call
-            yield upload_file_job, s3_file_fp
+            if progress:
+                progress.update(phase='processing', num_bytes=0)
+                yield upload_file_job, s3_file_fp, progress
+            else:
+                yield upload_file_job, s3_file_fp
+        if downloaded_at is None:  # a stream that the caller didn't read to the end
+            set_downloaded_at()
+
+        # __exit__()
+        is_success = upload_file_job.transition(UploadFileJob.S3_FILE_DOWNLOADED, UploadFileJob.SUCCESS,  # yay!
+                                                downloaded_at=downloaded_at)
+        logger.debug("upload_file_job_s3_file(): Done. upload_file_job={}".format(upload_file_job))
+    except Exception as exc:
+        failure_message = "upload_file_job_s3_file(): FAILED_PROCESS_FILE: Error: {}. upload_file_job={}" \
+            .format(exc, upload_file_job)
+        upload_file_job.fail(failure_message, downloaded_at=downloaded_at)
+        logger.debug(failure_message)
+    finally:
+        upload_file_job.delete_s3_object()  # NB: in current thread
+
+    # memoise the result. NB: outside the try so that it can't fail a job that already succeeded, and a partial read
+    # isn't the whole file's result
+    if is_success and upload_file_job.content_digest and (byte_range is None):
+        put_cached_result(upload_file_job.content_digest, upload_file_job.input_json, upload_file_job.output_json)
 
-            # __exit__()
-            upload_file_job.status = UploadFileJob.SUCCESS  # yay!
-            upload_file_job.save()
-            logger.debug("upload_file_job_s3_file(): Done. upload_file_job={}".format(upload_file_job))
-        except Exception as exc:
-            failure_message = "upload_file_job_s3_file(): FAILED_PROCESS_FILE: Error: {}. upload_file_job={}" \
-                .format(exc, upload_file_job)
-            upload_file_job.is_failed = True
-            upload_file_job.failure_message = failure_message
-            upload_file_job.save()
-            logger.debug(failure_message)
-        finally:
-            upload_file_job.delete_s3_object()  # NB: in current thread
+
+@contextmanager
+def upload_file_job_s3_file_range(upload_file_job, byte_range, mode=S3_FILE_MODE_STREAM):
+    """
+    A context manager that yields an fp for byte_range of upload_file_job's S3 object as upload_file_job_s3_file()
+    does, but without its status changes or cleanup. Used by chunk jobs - see forecast_app.chunked.
+    """
+    with _s3_file_fp(upload_file_job.s3_key(), mode, byte_range, upload_file_job.compression) as s3_file_fp:
+        yield s3_file_fp
+
+
+@contextmanager
+def _s3_file_fp(s3_key, mode, byte_range, compression, prefetched_fp=None, on_downloaded=None):
+    """
+    upload_file_job_s3_file() helper that yields an fp for s3_key according to mode and byte_range, decompressing it
+    according to compression. If prefetched_fp is passed (a local file with s3_key's object as stored - see
+    forecast_app.prefetch) then it's read instead of storage, and closed when done. NB: it's the whole object, so
+    byte_range must be None. If on_downloaded is passed then it's called with no args once the data has all been read
+    from storage: before yielding, or for S3_FILE_MODE_STREAM when the caller reads to the end of the stream.
+    """
+    if mode not in (S3_FILE_MODE_TEMPFILE, S3_FILE_MODE_STREAM, S3_FILE_MODE_MMAP):
+        raise ValueError("invalid mode: {!r}".format(mode))
+    elif byte_range and (compression != COMPRESSION_NONE):
+        raise ValueError("byte_range is not supported for compressed files. compression={!r}".format(compression))
+
+    storage = get_storage()
+    if mode == S3_FILE_MODE_STREAM:
+        stream = decompressing_reader(prefetched_fp or storage.open_stream(s3_key, byte_range), compression)
+        with io.BufferedReader(_RawStreamIO(stream, on_downloaded), buffer_size=S3_STREAM_BUFFER_SIZE) as s3_file_fp:
+            yield s3_file_fp
+        return
+
+    is_use_prefetched = prefetched_fp and (compression == COMPRESSION_NONE)  # already a local copy of the whole object
+    with (prefetched_fp if is_use_prefetched else tempfile.TemporaryFile()) as s3_file_fp:
+        if is_use_prefetched:
+            s3_file_fp.seek(0, io.SEEK_END)
+        elif prefetched_fp or byte_range or (compression != COMPRESSION_NONE):
+            stream = decompressing_reader(prefetched_fp or storage.open_stream(s3_key, byte_range), compression)
+            with closing(stream):
+                shutil.copyfileobj(stream, s3_file_fp, S3_STREAM_BUFFER_SIZE)
+        else:
+            storage.download_fileobj(s3_key, s3_file_fp)
+        s3_file_fp.flush()
+        if on_downloaded:
+            on_downloaded()
+        if (mode == S3_FILE_MODE_TEMPFILE) or (s3_file_fp.tell() == 0):
+            s3_file_fp.seek(0)
+            yield s3_file_fp
+        else:
+            with mmap.mmap(s3_file_fp.fileno(), 0, access=mmap.ACCESS_READ) as s3_file_mmap:
+                yield s3_file_mmap
+
+
+class _RawStreamIO(io.RawIOBase):
+    """
+    Adapts a read(n)/close() stream from Storage.open_stream() (e.g., a botocore StreamingBody) to io.RawIOBase so that
+    io.BufferedReader can provide readline(), line iteration, etc. on top of it. on_eof, if passed, is called with no
+    args the first time the stream is read to its end.
+    """
+
+
+    def __init__(self, stream, on_eof=None):
+        super().__init__()
+        self._stream = stream
+        self._on_eof = on_eof
+
+
+    def readable(self):
+        return True
+
+
+    def readinto(self, buffer):
+        data = self._stream.read(len(buffer))
+        buffer[:len(data)] = data
+        if not data and buffer and self._on_eof:
+            self._on_eof()
+            self._on_eof = None
+        return len(data)
+
+
+    def close(self):
+        if not self.closed:
+            self._stream.close()
+        super().close()
 
 
 #
-# set up a signal to try to delete an UploadFileJob's S3 object before deleting the UploadFileJob
+# set up a signal to try to delete an UploadFileJob's S3 object before deleting the UploadFileJob. within
+# deferred_upload_file_job_deletes() the keys are collected instead, so that they can be deleted in bulk, as are the pks
+# so that the post_delete Redis cleanup below can be done in bulk
 #
 
+_deferred_deletes = threading.local()
+
+
+def _is_deferring_deletes():
+    return getattr(_deferred_deletes, 's3_keys', None) is not None
+
+
 @receiver(pre_delete, sender=UploadFileJob)
 def delete_s3_obj_for_upload_file_job(sender, instance, using, **kwargs):
-    instance.delete_s3_object()
+    if _is_deferring_deletes():
+        _deferred_deletes.s3_keys.append(instance.s3_key())
+        _deferred_deletes.pks.append(instance.pk)
+    else:
+        instance.delete_s3_object()
+
+
+@contextmanager
+def deferred_upload_file_job_deletes():
+    """
+    A context manager that yields a 2-tuple of lists (s3_keys, pks) to which the S3 keys and pks of UploadFileJobs
+    deleted in the current thread are appended. Within it, deleting an UploadFileJob doesn't delete its S3 object or do
+    its post_delete Redis cleanup (one or two round trips per row). The caller is responsible for both, e.g., via
+    forecast_app.storage.delete_storage_objects() and as delete_upload_file_jobs() does.
+    """
+    _deferred_deletes.s3_keys = []
+    _deferred_deletes.pks = []
+    try:
+        yield _deferred_deletes.s3_keys, _deferred_deletes.pks
+    finally:
+        del _deferred_deletes.s3_keys
+        del _deferred_deletes.pks
+
+
+# the columns that delete_upload_file_jobs() loads: pre_delete makes Django load each row, and s3_key() reads these. any
+# others would be loaded lazily, one query per row
+UPLOAD_FILE_JOB_DELETE_FIELDS = ('id', 'content_digest', 'compression')
+
+
+def delete_upload_file_jobs(upload_file_jobs):
+    """
+    Deletes the UploadFileJobs in the passed QuerySet but not their S3 objects. Their cache invalidation and status
+    records are handled in bulk - one Redis round trip each - rather than per row.
+
+    :return: the deleted UploadFileJobs' distinct S3 keys (content-addressed ones can be shared), e.g., to pass to
+        forecast_app.storage.delete_storage_objects()
+    """
+    with deferred_upload_file_job_deletes() as (s3_keys, upload_file_job_pks):
+        upload_file_jobs.only(*UPLOAD_FILE_JOB_DELETE_FIELDS).delete()
+    if upload_file_job_pks:
+        invalidate_upload_file_jobs_cache()
+        delete_job_statuses(upload_file_job_pks)
+    return list(OrderedDict.fromkeys(s3_keys))
+
+
+#
+# set up signals to invalidate the cached index page job summary and update the job's status record (see
+# forecast_app.job_status) whenever an UploadFileJob is saved or deleted. NB: UploadFileJob.transition() and fail() use
+# update(), which doesn't send signals, so they do both themselves. deletes within deferred_upload_file_job_deletes()
+# are left to its caller
+#
+
+@receiver(post_save, sender=UploadFileJob)
+def invalidate_cache_for_upload_file_job(sender, instance, **kwargs):
+    invalidate_upload_file_jobs_cache()
+
+
+@receiver(post_save, sender=UploadFileJob)
+def cache_status_for_upload_file_job(sender, instance, **kwargs):
+    cache_job_statuses([instance])
+
+
+@receiver(post_delete, sender=UploadFileJob)
+def clean_up_deleted_upload_file_job(sender, instance, **kwargs):
+    if not _is_deferring_deletes():
+        invalidate_upload_file_jobs_cache()
+        delete_job_statuses([instance.pk])
@@ -0,0 +1,231 @@
+import logging
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+
+from django.db import close_old_connections, connections
+from rq.utils import import_attribute
+
+from forecast_app.storage import get_storage
+
+
+logger = logging.getLogger(__name__)
+
+#
+# prefetching of upload files. a Prefetcher runs a background thread in a worker process (see
+# worker_pool.PrefetchingWorker) that downloads the stored objects of the jobs the worker has reserved to run next to
+# local temporary files while the current job runs, so that download and processing overlap. upload_file_job_s3_file()
+# then takes the job's file via take_prefetched_file() rather than downloading it. jobs that don't read their whole file
+# that way are skipped - see no_prefetch()
+#
+
+# a downloaded object. fp is a temporary file containing the object as stored, i.e., possibly compressed
+_PrefetchedFile = namedtuple('_PrefetchedFile', ['s3_key', 'fp', 'size'])
+
+_prefetcher = None  # this process's running Prefetcher, if any. set by Prefetcher.start()
+
+
+def take_prefetched_file(job_id, s3_key):
+    """
+    Called by upload_file_job_s3_file() to get a job's prefetched file. If the file is being downloaded then waits for
+    the download to finish.
+
+    :param job_id: the RQ job id of the job whose file is wanted
+    :param s3_key: its storage key. a file prefetched under a different key is discarded
+    :return: an open temporary file containing s3_key's object as stored, positioned at the start, or None if it wasn't
+        prefetched. the caller must close it
+    """
+    prefetcher = _prefetcher
+    return prefetcher.take(job_id, s3_key) if prefetcher else None
+
+
+def no_prefetch(fcn):
+    """
+    A decorator for RQ job functions whose jobs shouldn't have their files prefetched b/c they don't read the whole file
+    via upload_file_job_s3_file(), e.g., ones that call chunked.process_upload_file_job_chunked(), whose chunk jobs read
+    byte ranges. Otherwise each such job would hold a prefetch slot for a download that's never used.
+    """
+    fcn.is_no_prefetch = True
+    return fcn
+
+
+def is_prefetchable(func_name, kwargs):
+    """
+    :param func_name: an RQ job's function name (dotted path)
+    :param kwargs: its keyword arguments
+    :return: True if the job's file should be prefetched, i.e., its function isn't marked with no_prefetch() (and can
+        be imported) and it wasn't passed a byte_range
+    """
+    return ('byte_range' not in kwargs) and _is_prefetchable_func(func_name)
+
+
+@lru_cache(maxsize=64)
+def _is_prefetchable_func(func_name):
+    try:
+        return not getattr(import_attribute(func_name), 'is_no_prefetch', False)
+    except Exception:  # e.g., an instance method, or a function from a newer deploy
+        return False
+
+
+class Prefetcher:
+    """
+    Downloads the objects for upcoming jobs, in queue order, keeping at most max_files of them and max_bytes in total.
+    Objects larger than max_bytes are never prefetched.
+    """
+
+
+    def __init__(self, upcoming_jobs_fcn, max_files, max_bytes, poll_interval=0.5):
+        """
+        :param upcoming_jobs_fcn: a function of one arg (max_jobs) that returns a list of up to max_jobs 2-tuples:
+            (job_id, s3_key) for the next jobs that will need a file, in the order they'll run. called from the
+            background thread
+        """
+        self.upcoming_jobs_fcn = upcoming_jobs_fcn
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.poll_interval = poll_interval
+        self._condition = threading.Condition()
+        self._job_id_to_file = OrderedDict()  # job_id -> _PrefetchedFile
+        self._num_bytes = 0
+        self._downloading_job_id = None
+        self._current_job_id = None  # the job running in the worker, whose file is kept even though it's been dequeued
+        self._failed_job_ids = set()  # upcoming jobs whose files couldn't be fetched. left to the worker
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='Prefetcher', daemon=True)
+
+
+    def start(self):
+        global _prefetcher
+        _prefetcher = self
+        self._thread.start()
+
+
+    def stop(self):
+        global _prefetcher
+        _prefetcher = None
+        self._stop_event.set()
+        self._thread.join()
+        with self._condition:
+            for prefetched_file in self._job_id_to_file.values():
+                prefetched_file.fp.close()
+            self._job_id_to_file.clear()
+            self._num_bytes = 0
+
+
+    def set_current_job_id(self, job_id):
+        """
+        Called by the worker before (job_id) and after (None) each job. A file left for the finished job (e.g., one
+        that failed before taking it) is discarded.
+        """
+        with self._condition:
+            if self._current_job_id is not None:
+                self._discard(self._current_job_id)
+            self._current_job_id = job_id
+
+
+    def take(self, job_id, s3_key):
+        """
+        :return: see take_prefetched_file()
+        """
+        with self._condition:
+            while self._downloading_job_id == job_id:
+                self._condition.wait()
+            prefetched_file = self._job_id_to_file.pop(job_id, None)
+            if not prefetched_file:
+                return None
+
+            self._num_bytes -= prefetched_file.size
+            if prefetched_file.s3_key != s3_key:  # e.g., moved to its content-addressed key after prefetching
+                prefetched_file.fp.close()
+                return None
+
+        logger.debug("Prefetcher.take(): Hit. job_id={}, s3_key={}".format(job_id, s3_key))
+        prefetched_file.fp.seek(0)
+        return prefetched_file.fp
+
+
+    def _discard(self, job_id):
+        # NB: caller must hold self._condition
+        prefetched_file = self._job_id_to_file.pop(job_id, None)
+        if prefetched_file:
+            self._num_bytes -= prefetched_file.size
+            prefetched_file.fp.close()
+
+
+    def _log_failure(self, exc, job_id, s3_key):
+        logger.error("Prefetcher._prefetch_next(): Error fetching: {}. job_id={}, s3_key={}"
+                     .format(exc, job_id, s3_key))
+        with self._condition:
+            self._failed_job_ids.add(job_id)
+
+
+    def _run(self):
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    is_downloaded = self._prefetch_next()
+                except Exception as exc:
+                    logger.error("Prefetcher._run(): Error: {}".format(exc))
+                    close_old_connections()
+                    is_downloaded = False
+                if not is_downloaded:
+                    self._stop_event.wait(self.poll_interval)
+        finally:
+            connections.close_all()  # this thread's
+
+
+    def _prefetch_next(self):
+        """
+        Discards files for jobs no longer upcoming (e.g., their UploadFileJob failed) and downloads the first upcoming
+        one that isn't yet prefetched, if it fits.
+
+        :return: True if a file was downloaded
+        """
+        upcoming_jobs = self.upcoming_jobs_fcn(self.max_files)
+        with self._condition:
+            upcoming_job_ids = {job_id for job_id, _ in upcoming_jobs}
+            # NB: between jobs, a job missing from upcoming_jobs may be the one the worker just dequeued but hasn't
+            # passed to set_current_job_id() yet, so files are only discarded while a job is running
+            for job_id in list(self._job_id_to_file) if self._current_job_id is not None else []:
+                if (job_id not in upcoming_job_ids) and (job_id != self._current_job_id):
+                    self._discard(job_id)
+            self._failed_job_ids &= upcoming_job_ids
+            upcoming_jobs = [(job_id, s3_key) for job_id, s3_key in upcoming_jobs
+                             if (job_id not in self._job_id_to_file) and (job_id not in self._failed_job_ids)]
+        if not upcoming_jobs:
+            return False
+
+        storage = get_storage()
+        for job_id, s3_key in upcoming_jobs:
+            try:
+                size = storage.size(s3_key)
+            except Exception as exc:
+                self._log_failure(exc, job_id, s3_key)
+                continue
+
+            if size > self.max_bytes:
+                continue  # would never fit
+
+            with self._condition:
+                if (len(self._job_id_to_file) >= self.max_files) or (self._num_bytes + size > self.max_bytes):
+                    return False  # full. NB: later jobs aren't considered so that files arrive in queue order
+
+                self._downloading_job_id = job_id
+            fp = tempfile.TemporaryFile()
+            try:
+                storage.download_fileobj(s3_key, fp)
+                fp.flush()
+            except Exception as exc:
+                self._log_failure(exc, job_id, s3_key)
+                fp.close()
+                fp = None
+            with self._condition:
+                self._downloading_job_id = None
+                if fp:
+                    self._job_id_to_file[job_id] = _PrefetchedFile(s3_key, fp, size)
+                    self._num_bytes += size
+                self._condition.notify_all()
+            return fp is not None
+
+        return False
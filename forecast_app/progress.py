@@ -0,0 +1,124 @@
+import json
+import logging
+import time
+
+import django_rq
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+#
+# job events via Redis pub/sub. each UploadFileJob has a channel to which two kinds of events are published as JSON
+# {"event": <kind>, "data": <dict>} messages:
+# - 'status': its status record (see forecast_app.job_status), published whenever that's rewritten
+# - 'progress': published by a ProgressReporter as the job's processing function works through its file
+# views.upload_file_job_events() relays them to browsers as server-sent events via job_event_stream()
+#
+
+JOB_EVENTS_CHANNEL = 'forecast_app:job_events:{}'  # format()ted with the UploadFileJob pk
+LAST_PROGRESS_KEY = 'forecast_app:job_events:last_progress:{}'  # "" the last progress event, for new watchers
+LAST_PROGRESS_TTL = 60 * 60  # seconds
+
+EVENT_STATUS = 'status'
+EVENT_PROGRESS = 'progress'
+
+
+class ProgressReporter:
+    """
+    Passed to processing functions by upload_file_job_s3_file(is_report_progress=True). Call update() as often as
+    convenient (e.g., per line): events are published at most every settings.PROGRESS_MIN_INTERVAL seconds, plus
+    whenever the phase changes.
+    """
+
+
+    def __init__(self, upload_file_job_pk, total_bytes=None):
+        """
+        :param total_bytes: the file's (uncompressed) size, if known, so that events can include 'fraction'
+        """
+        self.upload_file_job_pk = upload_file_job_pk
+        self.total_bytes = total_bytes
+        self.phase = None
+        self._last_publish_time = 0
+
+
+    def update(self, phase=None, is_force=False, **counts):
+        """
+        :param phase: a short description of what the job is doing, e.g., 'downloading' or 'processing'. None keeps the
+            current one
+        :param is_force: True to publish regardless of the rate limit
+        :param counts: JSON-serializable progress values, e.g., num_bytes=..., num_lines=.... num_bytes is used with
+            total_bytes to compute 'fraction'
+        :return: True if an event was published
+        """
+        is_new_phase = (phase is not None) and (phase != self.phase)
+        if is_new_phase:
+            self.phase = phase
+        now = time.time()
+        if not (is_force or is_new_phase or (now - self._last_publish_time >= settings.PROGRESS_MIN_INTERVAL)):
+            return False
+
+        self._last_publish_time = now
+        data = dict(counts, upload_file_job_pk=self.upload_file_job_pk, phase=self.phase, time=now)
+        if self.total_bytes and (counts.get('num_bytes') is not None):
+            data['fraction'] = min(counts['num_bytes'] / self.total_bytes, 1)
+        message = json.dumps({'event': EVENT_PROGRESS, 'data': data})
+        try:
+            with django_rq.get_connection().pipeline(transaction=False) as pipe:
+                pipe.set(LAST_PROGRESS_KEY.format(self.upload_file_job_pk), message, ex=LAST_PROGRESS_TTL)
+                pipe.publish(JOB_EVENTS_CHANNEL.format(self.upload_file_job_pk), message)
+                pipe.execute()
+        except Exception as exc:  # progress is best-effort
+            logger.error("ProgressReporter.update(): Error: {}. upload_file_job_pk={}"
+                         .format(exc, self.upload_file_job_pk))
+        return True
+
+
+def job_event_stream(upload_file_job_pk, status_json_fcn):
+    """
+    A generator of server-sent event strings for an UploadFileJob: its current status and last progress, then events
+    as they're published, until it finishes, settings.PROGRESS_SSE_MAX_DURATION seconds pass, or the client goes away.
+    Comments are sent every settings.PROGRESS_SSE_KEEPALIVE_INTERVAL seconds while idle. NB: browsers' EventSource
+    reconnects automatically, so the duration limit just bounds how long one request holds a web worker.
+
+    :param status_json_fcn: a function of one arg (upload_file_job_pk) that returns the job's current status record as
+        a JSON string, or None if there's no such job. called after subscribing so that no status event is missed
+    """
+    conn = django_rq.get_connection()
+    pubsub = conn.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(JOB_EVENTS_CHANNEL.format(upload_file_job_pk))  # NB: before reading the current state
+    try:
+        yield 'retry: {}\n\n'.format(settings.PROGRESS_SSE_RETRY)
+        status_json = status_json_fcn(upload_file_job_pk)
+        if status_json is None:  # deleted since the caller checked
+            return
+
+        yield _sse(EVENT_STATUS, status_json)
+        if _is_finished(json.loads(status_json)):
+            return
+
+        last_progress = conn.get(LAST_PROGRESS_KEY.format(upload_file_job_pk))
+        if last_progress:
+            yield _sse(EVENT_PROGRESS, json.dumps(json.loads(last_progress.decode('utf-8'))['data']))
+
+        deadline = time.time() + settings.PROGRESS_SSE_MAX_DURATION
+        while time.time() < deadline:
+            message = pubsub.get_message(timeout=settings.PROGRESS_SSE_KEEPALIVE_INTERVAL)
+            if message is None:
+                yield ': keepalive\n\n'
+                continue
+
+            event = json.loads(message['data'].decode('utf-8'))
+            yield _sse(event['event'], json.dumps(event['data']))
+            if (event['event'] == EVENT_STATUS) and _is_finished(event['data']):
+                return
+    finally:
+        pubsub.close()
+
+
+def _sse(event, data_json):
+    return 'event: {}\ndata: {}\n\n'.format(event, data_json)
+
+
+def _is_finished(status_record):
+    return status_record['is_failed'] or (status_record['status'] == 'SUCCESS')
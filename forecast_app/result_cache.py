@@ -0,0 +1,76 @@
+import hashlib
+import json
+import logging
+
+import django_rq
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+#
+# a size-bounded cache of processing results (UploadFileJob.output_json) keyed on (content_digest, input_json), so that
+# resubmitting the same file with the same inputs can finish without reprocessing. kept in Redis (the django_rq
+# connection): a hash of entries plus a list of their fields in insertion order. once there are more than
+# settings.RESULT_CACHE_MAX_ENTRIES, the oldest are evicted (FIFO)
+#
+
+REDIS_RESULT_CACHE_KEY = 'forecast_app:result_cache'  # hash: field -> JSON-encoded output_json
+REDIS_RESULT_CACHE_ORDER_KEY = 'forecast_app:result_cache:order'  # list of fields, newest first
+
+
+def get_cached_result(content_digest, input_json):
+    """
+    :return: a 2-tuple: (is_hit, output_json). output_json is None on a miss, but can also be a cached None
+    """
+    return get_cached_results([(content_digest, input_json)])[0]
+
+
+def get_cached_results(content_digests_and_input_jsons):
+    """
+    get_cached_result() for several (content_digest, input_json) 2-tuples, with one HMGET.
+
+    :return: a list of (is_hit, output_json) 2-tuples, in the same order as content_digests_and_input_jsons
+    """
+    if not content_digests_and_input_jsons:
+        return []
+
+    fields = [_result_field(content_digest, input_json)
+              for content_digest, input_json in content_digests_and_input_jsons]
+    return [(False, None) if cached_json is None
+            else (True, json.loads(cached_json.decode('utf-8') if isinstance(cached_json, bytes) else cached_json))
+            for cached_json in django_rq.get_connection().hmget(REDIS_RESULT_CACHE_KEY, fields)]
+
+
+def put_cached_result(content_digest, input_json, output_json):
+    """
+    Caches output_json for (content_digest, input_json), evicting the oldest entries if the cache is full. Does nothing
+    if output_json's encoding is larger than settings.RESULT_CACHE_MAX_ENTRY_SIZE or the entry is already cached.
+    Errors are logged rather than raised b/c it's called after the job has succeeded, and a missed cache entry just
+    means the next identical upload is processed.
+    """
+    try:
+        output_json_str = json.dumps(output_json)
+        if len(output_json_str) > settings.RESULT_CACHE_MAX_ENTRY_SIZE:
+            return
+
+        conn = django_rq.get_connection()
+        field = _result_field(content_digest, input_json)
+        if not conn.hsetnx(REDIS_RESULT_CACHE_KEY, field, output_json_str):
+            return  # already cached. NB: not re-added to the order list so that each field appears in it once
+
+        with conn.pipeline() as pipe:
+            pipe.lpush(REDIS_RESULT_CACHE_ORDER_KEY, field)
+            pipe.lrange(REDIS_RESULT_CACHE_ORDER_KEY, settings.RESULT_CACHE_MAX_ENTRIES, -1)
+            pipe.ltrim(REDIS_RESULT_CACHE_ORDER_KEY, 0, settings.RESULT_CACHE_MAX_ENTRIES - 1)
+            _, evicted_fields, _ = pipe.execute()
+        if evicted_fields:
+            conn.hdel(REDIS_RESULT_CACHE_KEY, *evicted_fields)
+            logger.debug("put_cached_result(): evicted {} entries".format(len(evicted_fields)))
+    except Exception as exc:
+        logger.error("put_cached_result(): Error: {}. content_digest={}".format(exc, content_digest))
+
+
+def _result_field(content_digest, input_json):
+    input_json_str = json.dumps(input_json, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256('{}:{}'.format(content_digest, input_json_str).encode('utf-8')).hexdigest()
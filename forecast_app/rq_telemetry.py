@@ -0,0 +1,187 @@
+import json
+import logging
+import time
+
+import django_rq
+from django.conf import settings
+from rq import Worker
+from rq.queue import get_failed_queue
+
+
+logger = logging.getLogger(__name__)
+
+#
+# RQ queue and worker telemetry. workers (see worker_pool.PrewarmedWorker) call record_job_telemetry() for each job,
+# which counts it and keeps its wait and run times in bounded per-queue Redis lists. take_sample() periodically
+# records each queue's depth, dequeue count, and worker states in a bounded Redis list of samples (a ring buffer:
+# LPUSH + LTRIM). rq_telemetry() derives rates, percentiles, and busy ratios from those, for views.rq_telemetry_json()
+# and views.metrics() (Prometheus)
+#
+
+RQ_TELEMETRY_DEQUEUED_KEY = 'forecast_app:rq_telemetry:dequeued'  # queue name -> number of jobs run
+RQ_TELEMETRY_WAIT_TIMES_KEY = 'forecast_app:rq_telemetry:wait_times:{}'  # format()ted with the queue name
+RQ_TELEMETRY_RUN_TIMES_KEY = 'forecast_app:rq_telemetry:run_times:{}'  # ""
+RQ_TELEMETRY_SAMPLES_KEY = 'forecast_app:rq_telemetry:samples'  # JSON samples, newest first
+RQ_TELEMETRY_SAMPLE_LOCK_KEY = 'forecast_app:rq_telemetry:sample_lock'  # limits samples to one per interval
+
+PERCENTILES = (50, 90, 99)
+
+
+def record_job_telemetry(queue_name, wait_time, run_time):
+    """
+    Called by workers after each job.
+
+    :param queue_name: the queue the job came from
+    :param wait_time: seconds the job waited in the queue
+    :param run_time: seconds the job ran
+    """
+    max_durations = settings.RQ_TELEMETRY_MAX_DURATIONS
+    try:
+        with django_rq.get_connection().pipeline(transaction=False) as pipe:
+            pipe.hincrby(RQ_TELEMETRY_DEQUEUED_KEY, queue_name, 1)
+            for key, duration in ((RQ_TELEMETRY_WAIT_TIMES_KEY, wait_time), (RQ_TELEMETRY_RUN_TIMES_KEY, run_time)):
+                pipe.lpush(key.format(queue_name), '{:.3f}'.format(duration))
+                pipe.ltrim(key.format(queue_name), 0, max_durations - 1)
+            pipe.execute()
+    except Exception as exc:
+        logger.error("record_job_telemetry(): Error: {}. queue_name={}".format(exc, queue_name))
+
+
+def take_sample(is_force=False):
+    """
+    Records a sample of every queue in settings.RQ_QUEUES unless one was taken in the last
+    settings.RQ_TELEMETRY_SAMPLE_INTERVAL seconds (by any process). Called by WorkerPool's loop and by the telemetry
+    views, so samples are taken while either is running.
+
+    :param is_force: True to take a sample regardless of the interval
+    :return: True if a sample was taken
+    """
+    conn = django_rq.get_connection()
+    if not is_force and not conn.set(RQ_TELEMETRY_SAMPLE_LOCK_KEY, 1, nx=True,
+                                     ex=settings.RQ_TELEMETRY_SAMPLE_INTERVAL):
+        return False
+
+    queue_names = sorted(settings.RQ_QUEUES)
+    with conn.pipeline(transaction=False) as pipe:
+        for queue_name in queue_names:
+            pipe.llen(django_rq.get_queue(queue_name).key)
+        pipe.hgetall(RQ_TELEMETRY_DEQUEUED_KEY)
+        *depths, queue_name_to_dequeued = pipe.execute()
+    queue_name_to_dequeued = {queue_name.decode('utf-8'): int(num_dequeued)
+                              for queue_name, num_dequeued in queue_name_to_dequeued.items()}
+
+    queue_name_to_workers = {queue_name: [0, 0] for queue_name in queue_names}  # [num_workers, num_busy_workers]
+    for worker in Worker.all(connection=conn):
+        is_busy = worker.get_state() == 'busy'
+        for queue_name in worker.queue_names():
+            if queue_name in queue_name_to_workers:
+                queue_name_to_workers[queue_name][0] += 1
+                queue_name_to_workers[queue_name][1] += 1 if is_busy else 0
+
+    sample = {'time': time.time(),
+              'num_failed': get_failed_queue(connection=conn).count,
+              'queues': {queue_name: {'depth': depth,
+                                      'dequeued': queue_name_to_dequeued.get(queue_name, 0),
+                                      'workers': queue_name_to_workers[queue_name][0],
+                                      'busy_workers': queue_name_to_workers[queue_name][1]}
+                         for queue_name, depth in zip(queue_names, depths)}}
+    with conn.pipeline(transaction=False) as pipe:
+        pipe.lpush(RQ_TELEMETRY_SAMPLES_KEY, json.dumps(sample))
+        pipe.ltrim(RQ_TELEMETRY_SAMPLES_KEY, 0, settings.RQ_TELEMETRY_MAX_SAMPLES - 1)
+        pipe.execute()
+    return True
+
+
+def rq_telemetry():
+    """
+    :return: a dict with 'time' and 'window' (seconds covered by the samples used), 'num_failed' (the failed queue's
+        length), and 'queues': a dict that maps each queue name to a dict with:
+        - 'depth': jobs waiting
+        - 'enqueue_rate', 'dequeue_rate': jobs per second over the window. enqueues are inferred from dequeues and the
+          change in depth, so jobs deleted from the queue count as dequeued
+        - 'wait_time', 'run_time': dicts mapping 'p50', 'p90', and 'p99' to seconds over the last
+          settings.RQ_TELEMETRY_MAX_DURATIONS jobs, or None if there are none
+        - 'workers': workers listening on the queue
+        - 'busy_ratio': the mean fraction of them that were busy over the samples, or None if there were none
+        Rates are None until there are two samples.
+    """
+    take_sample()
+    conn = django_rq.get_connection()
+    queue_names = sorted(settings.RQ_QUEUES)
+    with conn.pipeline(transaction=False) as pipe:
+        pipe.lrange(RQ_TELEMETRY_SAMPLES_KEY, 0, -1)
+        for queue_name in queue_names:
+            pipe.lrange(RQ_TELEMETRY_WAIT_TIMES_KEY.format(queue_name), 0, -1)
+            pipe.lrange(RQ_TELEMETRY_RUN_TIMES_KEY.format(queue_name), 0, -1)
+        samples, *durations = pipe.execute()
+    samples = [json.loads(sample.decode('utf-8')) for sample in samples]  # newest first
+    newest, oldest = (samples[0], samples[-1]) if samples else (None, None)
+    window = newest['time'] - oldest['time'] if samples else 0
+
+    queue_name_to_telemetry = {}
+    for queue_idx, queue_name in enumerate(queue_names):
+        telemetry = {'depth': None, 'enqueue_rate': None, 'dequeue_rate': None, 'workers': None, 'busy_ratio': None,
+                     'wait_time': _percentiles(durations[2 * queue_idx]),
+                     'run_time': _percentiles(durations[2 * queue_idx + 1])}
+        queue_samples = [sample['queues'][queue_name] for sample in samples if queue_name in sample['queues']]
+        if queue_samples:
+            telemetry['depth'] = queue_samples[0]['depth']
+            telemetry['workers'] = queue_samples[0]['workers']
+            busy_ratios = [queue_sample['busy_workers'] / queue_sample['workers'] for queue_sample in queue_samples
+                           if queue_sample['workers']]
+            telemetry['busy_ratio'] = sum(busy_ratios) / len(busy_ratios) if busy_ratios else None
+        if (len(queue_samples) > 1) and window:
+            num_dequeued = queue_samples[0]['dequeued'] - queue_samples[-1]['dequeued']
+            depth_change = queue_samples[0]['depth'] - queue_samples[-1]['depth']
+            telemetry['dequeue_rate'] = num_dequeued / window
+            telemetry['enqueue_rate'] = max(num_dequeued + depth_change, 0) / window
+        queue_name_to_telemetry[queue_name] = telemetry
+    return {'time': newest['time'] if newest else None,
+            'window': window,
+            'num_failed': newest['num_failed'] if newest else None,
+            'queues': queue_name_to_telemetry}
+
+
+def _percentiles(durations):
+    if not durations:
+        return None
+
+    durations = sorted(float(duration) for duration in durations)
+    return {'p{}'.format(percentile): durations[min(len(durations) * percentile // 100, len(durations) - 1)]
+            for percentile in PERCENTILES}
+
+
+def rq_telemetry_prometheus_text(telemetry=None):
+    """
+    :return: rq_telemetry() in the Prometheus text exposition format. NB: rates, percentiles, and ratios are exposed
+        as gauges b/c they're computed here from the Redis samples rather than by Prometheus
+    """
+    telemetry = telemetry or rq_telemetry()
+    lines = []
+    for name, help_text, key in (('forecast_app_rq_queue_depth', "Jobs waiting in the queue.", 'depth'),
+                                 ('forecast_app_rq_enqueue_rate', "Jobs enqueued per second.", 'enqueue_rate'),
+                                 ('forecast_app_rq_dequeue_rate', "Jobs dequeued per second.", 'dequeue_rate'),
+                                 ('forecast_app_rq_workers', "Workers listening on the queue.", 'workers'),
+                                 ('forecast_app_rq_worker_busy_ratio', "Mean fraction of the queue's workers busy.",
+                                  'busy_ratio')):
+        lines.extend(['# HELP {} {}'.format(name, help_text), '# TYPE {} gauge'.format(name)])
+        for queue_name, queue_telemetry in sorted(telemetry['queues'].items()):
+            if queue_telemetry[key] is not None:
+                lines.append('{}{{queue="{}"}} {}'.format(name, queue_name, queue_telemetry[key]))
+
+    for name, help_text, key in (('forecast_app_rq_job_wait_seconds', "Time jobs waited in the queue.", 'wait_time'),
+                                 ('forecast_app_rq_job_run_seconds', "Time jobs ran.", 'run_time')):
+        lines.extend(['# HELP {} {}'.format(name, help_text), '# TYPE {} gauge'.format(name)])
+        for queue_name, queue_telemetry in sorted(telemetry['queues'].items()):
+            if queue_telemetry[key] is None:
+                continue
+
+            for percentile in PERCENTILES:
+                value = queue_telemetry[key]['p{}'.format(percentile)]
+                lines.append('{}{{queue="{}",quantile="{}"}} {}'.format(name, queue_name, percentile / 100, value))
+
+    if telemetry['num_failed'] is not None:
+        lines.extend(['# HELP forecast_app_rq_failed_jobs Jobs in the failed queue.',
+                      '# TYPE forecast_app_rq_failed_jobs gauge',
+                      'forecast_app_rq_failed_jobs {}'.format(telemetry['num_failed'])])
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,110 @@
+import logging
+
+from django.conf import settings
+from rq.job import Job
+from rq.utils import utcnow, utcparse
+
+
+logger = logging.getLogger(__name__)
+
+#
+# queue routing. jobs are routed to named queues (see settings.RQ_QUEUES) by type and size so that short jobs aren't
+# stuck behind long ones, and each worker process type drains the queues listed for it in settings.RQ_WORKER_QUEUES
+#
+
+RQ_QUEUE_FAST = 'fast'  # short jobs that need low latency: counter increments and small uploads
+RQ_QUEUE_BULK = 'bulk'  # large uploads
+RQ_QUEUE_MAINTENANCE = 'maintenance'  # housekeeping, e.g., bulk S3 deletes
+
+
+def upload_file_job_queue_name_and_timeout(file_size):
+    """
+    :param file_size: the uploaded file's size in bytes, or None if unknown
+    :return: a 2-tuple: (queue_name, timeout) for processing the file. files up to settings.RQ_FAST_MAX_FILE_SIZE go
+        to RQ_QUEUE_FAST, others to RQ_QUEUE_BULK. the timeout (seconds) allows for processing at
+        settings.RQ_UPLOAD_JOB_BYTES_PER_SECOND, within [RQ_UPLOAD_JOB_MIN_TIMEOUT, RQ_UPLOAD_JOB_MAX_TIMEOUT]
+    """
+    if file_size is None:
+        return RQ_QUEUE_BULK, settings.RQ_UPLOAD_JOB_MAX_TIMEOUT
+
+    queue_name = RQ_QUEUE_FAST if file_size <= settings.RQ_FAST_MAX_FILE_SIZE else RQ_QUEUE_BULK
+    timeout = settings.RQ_UPLOAD_JOB_MIN_TIMEOUT + int(file_size / settings.RQ_UPLOAD_JOB_BYTES_PER_SECOND)
+    return queue_name, min(timeout, settings.RQ_UPLOAD_JOB_MAX_TIMEOUT)
+
+
+# the job hash fields that queue_summary() fetches for each job. NB: 'data' (the pickled function call) is omitted
+QUEUE_SUMMARY_JOB_FIELDS = ('description', 'status', 'created_at', 'enqueued_at', 'timeout')
+
+
+def queue_summary(queue, num_jobs=20):
+    """
+    A bounded alternative to iterating queue.jobs, which fetches and unpickles every job in the queue one at a time.
+
+    :param queue: an rq.Queue
+    :param num_jobs: max number of jobs (from the front of the queue) to return
+    :return: a dict with 'name', 'length' (via LLEN), and 'jobs': a list of up to num_jobs dicts, one per job, with 'id'
+        plus QUEUE_SUMMARY_JOB_FIELDS. Values are None for missing fields, e.g., a job that expired after LRANGE
+    """
+    conn = queue.connection
+    with conn.pipeline(transaction=False) as pipe:
+        pipe.llen(queue.key)
+        pipe.lrange(queue.key, 0, num_jobs - 1)
+        length, job_ids = pipe.execute()
+
+    with conn.pipeline(transaction=False) as pipe:
+        for job_id in job_ids:
+            pipe.hmget(Job.key_for(_as_str(job_id)), QUEUE_SUMMARY_JOB_FIELDS)
+        job_field_values = pipe.execute()
+
+    jobs = []
+    for job_id, field_values in zip(job_ids, job_field_values):
+        job = {'id': _as_str(job_id)}
+        job.update({field: _as_str(value) for field, value in zip(QUEUE_SUMMARY_JOB_FIELDS, field_values)})
+        jobs.append(job)
+    return {'name': queue.name, 'length': length, 'jobs': jobs}
+
+
+def queue_length_and_wait_time(queue):
+    """
+    :param queue: an rq.Queue
+    :return: a 2-tuple: (length, wait_time) where wait_time is how long in seconds the job at the front of the queue
+        (the oldest) has been waiting, or 0 if the queue is empty
+    """
+    conn = queue.connection
+    with conn.pipeline(transaction=False) as pipe:
+        pipe.llen(queue.key)
+        pipe.lindex(queue.key, 0)
+        length, oldest_job_id = pipe.execute()
+    if oldest_job_id is None:
+        return length, 0
+
+    enqueued_at = conn.hget(Job.key_for(_as_str(oldest_job_id)), 'enqueued_at')
+    if not enqueued_at:  # job expired or was deleted since LINDEX
+        return length, 0
+
+    return length, max((utcnow() - utcparse(_as_str(enqueued_at))).total_seconds(), 0)
+
+
+def enqueue_many(queue, func, args_and_job_ids):
+    """
+    Enqueues one job per item of args_and_job_ids, all in a single Redis pipeline (i.e., one round trip) rather than one
+    django_rq.enqueue() call (several round trips) per job.
+
+    :param queue: an rq.Queue
+    :param func: the function to call for each job
+    :param args_and_job_ids: a list of (args, job_id, timeout) 3-tuples. args is a tuple passed to func; job_id and
+        timeout may be None, the latter meaning the queue's default
+    :return: a list of the enqueued rq.job.Jobs, in the same order as args_and_job_ids
+    """
+    rq_jobs = [queue.job_class.create(func, args=args, connection=queue.connection, id=job_id, timeout=timeout,
+                                      origin=queue.name)
+               for args, job_id, timeout in args_and_job_ids]
+    with queue.connection.pipeline() as pipe:
+        for rq_job in rq_jobs:
+            queue.enqueue_job(rq_job, pipeline=pipe)
+        pipe.execute()
+    return rq_jobs
+
+
+def _as_str(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
@@ -0,0 +1,516 @@
+import logging
+import os
+import shutil
+import threading
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+#
+# pluggable storage for uploaded files. settings.UPLOAD_STORAGE_BACKEND names the Storage subclass that get_storage()
+# returns: S3Storage for production, or LocalFileSystemStorage for running (and benchmarking) offline
+#
+
+StorageObject = namedtuple('StorageObject', ['key', 'size', 'last_modified'])
+
+S3_DELETE_OBJECTS_BATCH_SIZE = 1000  # S3's max keys per DeleteObjects request
+
+S3_DELETE_OBJECTS_MAX_CONCURRENCY = 8  # max DeleteObjects requests at once. keep <= settings.S3_MAX_POOL_CONNECTIONS
+
+EMPTY_STORAGE_BATCH_SIZE = 10000  # empty_storage() deletes keys as it lists them, this many at a time
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    """
+    :return: this process's Storage instance, as configured by settings.UPLOAD_STORAGE_BACKEND. thread-safe
+    """
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = import_string(settings.UPLOAD_STORAGE_BACKEND)()
+    return _storage
+
+
+class Storage:
+    """
+    The interface to where uploaded files are kept, addressed by key (see UploadFileJob.s3_key()). Implementations must
+    be safe to share between threads.
+    """
+
+
+    def put_fileobj(self, key, fp):
+        """
+        Stores the contents of the binary file-like fp under key, replacing any existing object.
+        """
+        raise NotImplementedError
+
+
+    def download_fileobj(self, key, fp):
+        """
+        Writes key's contents to the binary file-like fp.
+        """
+        raise NotImplementedError
+
+
+    def open_stream(self, key, byte_range=None):
+        """
+        :param byte_range: optional 2-tuple (first_byte, last_byte), both inclusive. last_byte may be None for "to the
+            end"
+        :return: a binary stream with read(n) and close() over key's contents, limited to byte_range if passed
+        """
+        raise NotImplementedError
+
+
+    def size(self, key):
+        """
+        :return: the size in bytes of key's object. raises if it doesn't exist
+        """
+        raise NotImplementedError
+
+
+    def exists(self, key):
+        """
+        :return: True if key's object exists
+        """
+        raise NotImplementedError
+
+
+    def move(self, src_key, dst_key):
+        """
+        Moves src_key's object to dst_key, replacing any existing object.
+        """
+        raise NotImplementedError
+
+
+    def delete(self, key):
+        """
+        Deletes key's object. not an error if it doesn't exist.
+        """
+        raise NotImplementedError
+
+
+    def delete_many(self, keys):
+        """
+        Deletes the objects for keys. not an error if any don't exist. This default implementation calls delete() once
+        per key.
+
+        :return: a list of (key, error_message) 2-tuples for the keys that could not be deleted
+        """
+        failures = []
+        for key in keys:
+            try:
+                self.delete(key)
+            except Exception as exc:
+                failures.append((key, str(exc)))
+        return failures
+
+
+    def iter_objects(self, prefix=''):
+        """
+        :return: an iterator over StorageObjects for every key that starts with prefix, in key order
+        """
+        raise NotImplementedError
+
+
+    def list_page(self, prefix='', page_size=1000, continuation_token=None):
+        """
+        :param continuation_token: None for the first page, or a next_continuation_token returned by a previous call
+        :return: a 2-tuple: (list of up to page_size StorageObjects for keys that start with prefix, in key order,
+            next_continuation_token). next_continuation_token is None if this is the last page
+        """
+        raise NotImplementedError
+
+
+    def generate_presigned_post(self, key, max_size, expires_in):
+        """
+        :return: a dict with 'url' and 'fields' that lets a client POST up to max_size bytes to key directly, for
+            expires_in seconds
+        """
+        raise NotImplementedError("{} does not support presigned uploads".format(self.__class__.__name__))
+
+
+    #
+    # multipart uploads: create_multipart_upload(), then upload_part() (possibly concurrently), then either
+    # complete_multipart_upload() or abort_multipart_upload()
+    #
+
+    def create_multipart_upload(self, key):
+        """
+        :return: an upload_id for the other multipart methods
+        """
+        raise NotImplementedError
+
+
+    def upload_part(self, key, upload_id, part_number, data):
+        """
+        :param part_number: 1-based
+        :return: an opaque part descriptor to pass to complete_multipart_upload()
+        """
+        raise NotImplementedError
+
+
+    def complete_multipart_upload(self, key, upload_id, parts):
+        """
+        :param parts: the descriptors returned by upload_part(), in part_number order
+        """
+        raise NotImplementedError
+
+
+    def abort_multipart_upload(self, key, upload_id):
+        raise NotImplementedError
+
+
+class S3Storage(Storage):
+    """
+    Stores objects in the settings.S3_UPLOAD_BUCKET_NAME bucket. All threads in a process share one boto3 client (which
+    is thread-safe, unlike boto3 sessions), so its connection pool of settings.S3_MAX_POOL_CONNECTIONS connections is
+    reused across requests and jobs rather than paying for client construction and TLS handshakes every time. A new
+    client is created after a fork b/c pooled connections can't be shared between processes.
+    """
+
+
+    def __init__(self):
+        self.bucket_name = settings.S3_UPLOAD_BUCKET_NAME
+        self._client = None
+        self._client_pid = None
+        self._client_lock = threading.Lock()
+
+
+    def __str__(self):
+        return "S3Storage({})".format(self.bucket_name)
+
+
+    @property
+    def client(self):
+        if self._client_pid != os.getpid():
+            with self._client_lock:
+                if self._client_pid != os.getpid():
+                    session = boto3.session.Session()
+                    self._client = session.client('s3', endpoint_url=settings.S3_ENDPOINT_URL,
+                                                  config=Config(max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS,
+                                                                retries={'max_attempts': 5}))
+                    self._client_pid = os.getpid()
+        return self._client
+
+
+    def put_fileobj(self, key, fp):
+        self.client.upload_fileobj(fp, self.bucket_name, key)  # multipart and multi-threaded for large files
+
+
+    def download_fileobj(self, key, fp):
+        self.client.download_fileobj(self.bucket_name, key, fp)  # multi-threaded for large files
+
+
+    def open_stream(self, key, byte_range=None):
+        if byte_range:
+            first_byte, last_byte = byte_range
+            range_header = 'bytes={}-{}'.format(first_byte, '' if last_byte is None else last_byte)
+            return self.client.get_object(Bucket=self.bucket_name, Key=key, Range=range_header)['Body']
+        else:
+            return self.client.get_object(Bucket=self.bucket_name, Key=key)['Body']
+
+
+    def size(self, key):
+        return self.client.head_object(Bucket=self.bucket_name, Key=key)['ContentLength']
+
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket_name, Key=key)
+            return True
+        except ClientError as exc:
+            if exc.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+
+    def move(self, src_key, dst_key):
+        # a server-side copy, so the data doesn't pass through this process. multipart for large objects
+        self.client.copy({'Bucket': self.bucket_name, 'Key': src_key}, self.bucket_name, dst_key)
+        self.delete(src_key)
+
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket_name, Key=key)
+
+
+    def delete_many(self, keys):
+        """
+        Deletes keys with DeleteObjects requests of up to S3_DELETE_OBJECTS_BATCH_SIZE keys each, up to
+        S3_DELETE_OBJECTS_MAX_CONCURRENCY at a time.
+        """
+        keys = list(keys)
+        batches = [keys[start:start + S3_DELETE_OBJECTS_BATCH_SIZE]
+                   for start in range(0, len(keys), S3_DELETE_OBJECTS_BATCH_SIZE)]
+        failures = []
+        with ThreadPoolExecutor(max_workers=S3_DELETE_OBJECTS_MAX_CONCURRENCY) as executor:
+            for batch_failures in executor.map(self._delete_batch, batches):
+                failures.extend(batch_failures)
+        return failures
+
+
+    def _delete_batch(self, keys):
+        """
+        delete_many() helper that deletes up to S3_DELETE_OBJECTS_BATCH_SIZE keys in one request.
+
+        :return: as for delete_many(). if the request itself fails then all keys are reported as failed
+        """
+        try:
+            response = self.client.delete_objects(Bucket=self.bucket_name,
+                                                  Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+        except Exception as exc:
+            return [(key, str(exc)) for key in keys]
+
+        # in quiet mode the response lists only the failures
+        return [(error['Key'], '{}: {}'.format(error.get('Code'), error.get('Message')))
+                for error in response.get('Errors', [])]
+
+
+    def iter_objects(self, prefix=''):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for s3_object in page.get('Contents', []):
+                yield StorageObject(s3_object['Key'], s3_object['Size'], s3_object['LastModified'])
+
+
+    def list_page(self, prefix='', page_size=1000, continuation_token=None):
+        kwargs = {'Bucket': self.bucket_name, 'Prefix': prefix, 'MaxKeys': page_size}
+        if continuation_token:
+            kwargs['ContinuationToken'] = continuation_token
+        response = self.client.list_objects_v2(**kwargs)
+        storage_objects = [StorageObject(s3_object['Key'], s3_object['Size'], s3_object['LastModified'])
+                           for s3_object in response.get('Contents', [])]
+        return storage_objects, response.get('NextContinuationToken')  # present only if IsTruncated
+
+
+    def generate_presigned_post(self, key, max_size, expires_in):
+        return self.client.generate_presigned_post(self.bucket_name, key,
+                                                   Conditions=[['content-length-range', 0, int(max_size)]],
+                                                   ExpiresIn=expires_in)
+
+
+    def create_multipart_upload(self, key):
+        return self.client.create_multipart_upload(Bucket=self.bucket_name, Key=key)['UploadId']
+
+
+    def upload_part(self, key, upload_id, part_number, data):
+        response = self.client.upload_part(Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                                           PartNumber=part_number, Body=data)
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+
+    def complete_multipart_upload(self, key, upload_id, parts):
+        self.client.complete_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                                              MultipartUpload={'Parts': parts})
+
+
+    def abort_multipart_upload(self, key, upload_id):
+        self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id)
+
+
+class LocalFileSystemStorage(Storage):
+    """
+    Stores objects as files under settings.UPLOAD_STORAGE_LOCAL_ROOT, one per key. Multipart uploads write each part to
+    its own file under MULTIPART_DIR_NAME and concatenate them on completion. Does not support presigned uploads.
+    NB: only shared by processes on the same host.
+    """
+
+    MULTIPART_DIR_NAME = '.multipart'
+
+
+    def __init__(self):
+        self.root = settings.UPLOAD_STORAGE_LOCAL_ROOT
+        os.makedirs(os.path.join(self.root, self.MULTIPART_DIR_NAME), exist_ok=True)
+
+
+    def __str__(self):
+        return "LocalFileSystemStorage({})".format(self.root)
+
+
+    def put_fileobj(self, key, fp):
+        path = self._path(key)
+        temp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        with open(temp_path, 'wb') as out_fp:
+            shutil.copyfileobj(fp, out_fp)
+        os.replace(temp_path, path)  # atomic, so readers never see a partial object
+
+
+    def download_fileobj(self, key, fp):
+        with open(self._path(key), 'rb') as in_fp:
+            shutil.copyfileobj(in_fp, fp)
+
+
+    def open_stream(self, key, byte_range=None):
+        fp = open(self._path(key), 'rb')
+        if not byte_range:
+            return fp
+
+        first_byte, last_byte = byte_range
+        fp.seek(first_byte)
+        return fp if last_byte is None else _LimitedReader(fp, last_byte - first_byte + 1)
+
+
+    def size(self, key):
+        return os.path.getsize(self._path(key))
+
+
+    def exists(self, key):
+        return os.path.isfile(self._path(key))
+
+
+    def move(self, src_key, dst_key):
+        os.replace(self._path(src_key), self._path(dst_key))
+
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+    def iter_objects(self, prefix=''):
+        for dir_entry in sorted(os.scandir(self.root), key=lambda dir_entry: dir_entry.name):
+            if dir_entry.is_file() and dir_entry.name.startswith(prefix) and not dir_entry.name.endswith('.tmp'):
+                stat = dir_entry.stat()
+                yield StorageObject(dir_entry.name, stat.st_size,
+                                    datetime.fromtimestamp(stat.st_mtime, timezone.utc))
+
+
+    def list_page(self, prefix='', page_size=1000, continuation_token=None):
+        """
+        The continuation token is the last key of the previous page.
+        """
+        storage_objects = []
+        for storage_object in self.iter_objects(prefix):
+            if continuation_token and (storage_object.key <= continuation_token):
+                continue
+            elif len(storage_objects) == page_size:
+                return storage_objects, storage_objects[-1].key
+
+            storage_objects.append(storage_object)
+        return storage_objects, None
+
+
+    def create_multipart_upload(self, key):
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self._multipart_dir(upload_id))
+        return upload_id
+
+
+    def upload_part(self, key, upload_id, part_number, data):
+        with open(os.path.join(self._multipart_dir(upload_id), str(part_number)), 'wb') as part_fp:
+            part_fp.write(data)
+        return part_number
+
+
+    def complete_multipart_upload(self, key, upload_id, parts):
+        multipart_dir = self._multipart_dir(upload_id)
+        path = self._path(key)
+        temp_path = '{}.{}.tmp'.format(path, upload_id)
+        with open(temp_path, 'wb') as out_fp:
+            for part_number in parts:
+                with open(os.path.join(multipart_dir, str(part_number)), 'rb') as part_fp:
+                    shutil.copyfileobj(part_fp, out_fp)
+        os.replace(temp_path, path)
+        shutil.rmtree(multipart_dir)
+
+
+    def abort_multipart_upload(self, key, upload_id):
+        shutil.rmtree(self._multipart_dir(upload_id), ignore_errors=True)
+
+
+    def _path(self, key):
+        if (not key) or ('/' in key) or key.startswith('.'):
+            raise ValueError("invalid key: {!r}".format(key))
+
+        return os.path.join(self.root, key)
+
+
+    def _multipart_dir(self, upload_id):
+        return os.path.join(self.root, self.MULTIPART_DIR_NAME, upload_id)
+
+
+class _LimitedReader:
+    """
+    A read(n)/close() stream over at most `limit` bytes of fp, starting at its current position.
+    """
+
+
+    def __init__(self, fp, limit):
+        self._fp = fp
+        self._remaining = limit
+
+
+    def read(self, size=-1):
+        if (size is None) or (size < 0) or (size > self._remaining):
+            size = self._remaining
+        data = self._fp.read(size)
+        self._remaining -= len(data)
+        return data
+
+
+    def close(self):
+        self._fp.close()
+
+
+#
+# RQ enqueue() helper functions for bulk deletes, which can take too long to do in a web request
+#
+
+def delete_storage_objects(keys):
+    """
+    enqueue() helper function. Deletes keys from get_storage().
+
+    :return: a dict with 'num_keys' and 'failures' (see Storage.delete_many()), which is also the RQ job's result
+    """
+    failures = get_storage().delete_many(keys)
+    _log_delete_failures('delete_storage_objects', failures)
+    return {'num_keys': len(keys), 'failures': failures}
+
+
+def empty_storage():
+    """
+    enqueue() helper function. Deletes every object in get_storage(), EMPTY_STORAGE_BATCH_SIZE keys at a time as they're
+    listed, so memory use doesn't grow with the number of objects.
+
+    :return: as for delete_storage_objects()
+    """
+    storage = get_storage()
+    num_keys = 0
+    failures = []
+    batch = []
+    for storage_object in storage.iter_objects():
+        batch.append(storage_object.key)
+        if len(batch) == EMPTY_STORAGE_BATCH_SIZE:
+            failures.extend(storage.delete_many(batch))
+            num_keys += len(batch)
+            batch = []
+    if batch:
+        failures.extend(storage.delete_many(batch))
+        num_keys += len(batch)
+    _log_delete_failures('empty_storage', failures)
+    return {'num_keys': num_keys, 'failures': failures}
+
+
+def _log_delete_failures(caller_name, failures):
+    if failures:
+        logger.error("{}(): {} key(s) could not be deleted. first few: {}"
+                     .format(caller_name, len(failures), failures[:10]))
+    else:
+        logger.debug("{}(): Done".format(caller_name))
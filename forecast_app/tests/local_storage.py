@@ -0,0 +1,26 @@
+import shutil
+import tempfile
+from unittest import mock
+
+from django.test import TestCase, override_settings
+
+from forecast_app import storage
+
+
+class LocalStorageTestCase(TestCase):
+    """
+    A TestCase whose tests use a LocalFileSystemStorage in a temporary directory as get_storage().
+    """
+
+
+    def setUp(self):
+        super().setUp()
+        self.storage_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.storage_root)
+        settings_override = override_settings(UPLOAD_STORAGE_BACKEND='forecast_app.storage.LocalFileSystemStorage',
+                                              UPLOAD_STORAGE_LOCAL_ROOT=self.storage_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        storage_patch = mock.patch.object(storage, '_storage', None)  # get_storage() caches the backend
+        storage_patch.start()
+        self.addCleanup(storage_patch.stop)
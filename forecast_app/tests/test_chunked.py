@@ -0,0 +1,93 @@
+import io
+
+import django_rq
+from django.conf import settings
+from rq.worker import SimpleWorker
+
+from forecast_app.chunked import CHUNKED_FINISHED_KEY, CHUNKED_JOBS_KEY, CHUNKED_PROGRESS_KEY, chunked_progress, \
+    process_upload_file_job_chunked
+from forecast_app.models import UploadFileJob
+from forecast_app.rq_utils import RQ_QUEUE_FAST
+from forecast_app.storage import get_storage
+from forecast_app.tests.local_storage import LocalStorageTestCase
+from forecast_app.views import count_lines__noop, sum_line_counts__noop
+
+
+class ChunkedTestCase(LocalStorageTestCase):
+    """
+    Tests fan-out/fan-in processing of uploads in chunks, using a worker that runs jobs in this process. NB: uses the
+    Redis server in settings.RQ_QUEUES, as the app does.
+    """
+
+
+    def setUp(self):
+        super().setUp()
+        django_rq.get_connection().delete(CHUNKED_JOBS_KEY)
+        for queue_name in settings.RQ_QUEUES:
+            django_rq.get_queue(queue_name).empty()
+        # lines of varying lengths so that chunk boundaries don't fall on line breaks
+        self.file_data = b''.join('line {}: {}\n'.format(idx, 'x' * (idx % 17)).encode() for idx in range(500))
+
+
+    def _uploaded_job(self):
+        upload_file_job = UploadFileJob.objects.create(status=UploadFileJob.S3_FILE_UPLOADED,
+                                                       file_size=len(self.file_data))
+        get_storage().put_fileobj(upload_file_job.s3_key(), io.BytesIO(self.file_data))
+        return upload_file_job
+
+
+    def _process(self, upload_file_job):
+        process_upload_file_job_chunked(upload_file_job.pk, count_lines__noop, sum_line_counts__noop)
+        django_rq.get_worker(*settings.RQ_QUEUES, worker_class=SimpleWorker).work(burst=True)
+        upload_file_job.refresh_from_db()
+        self.assertEqual(UploadFileJob.SUCCESS, upload_file_job.status, upload_file_job.failure_message)
+        self.assertFalse(get_storage().exists(upload_file_job.s3_key()))
+        return upload_file_job.output_json
+
+
+    def test_chunked_equals_single_job(self):
+        with self.settings(CHUNKED_MIN_CHUNK_SIZE=len(self.file_data)):  # too small to split
+            single_output_json = self._process(self._uploaded_job())
+        with self.settings(CHUNKED_MIN_CHUNK_SIZE=1000, CHUNKED_MAX_CHUNKS=4):
+            upload_file_job = self._uploaded_job()
+            chunked_output_json = self._process(upload_file_job)
+        self.assertEqual({'file_size': len(self.file_data), 'num_lines': 500, 'num_chunks': 1}, single_output_json)
+        self.assertEqual(4, chunked_output_json['num_chunks'])
+        self.assertEqual((single_output_json['file_size'], single_output_json['num_lines']),
+                         (chunked_output_json['file_size'], chunked_output_json['num_lines']))
+
+        # the reduce job cleaned up
+        conn = django_rq.get_connection()
+        self.assertFalse(conn.exists(CHUNKED_PROGRESS_KEY.format(upload_file_job.pk)))
+        self.assertFalse(conn.exists(CHUNKED_FINISHED_KEY.format(upload_file_job.pk)))
+        self.assertFalse(conn.sismember(CHUNKED_JOBS_KEY, upload_file_job.pk))
+        self.assertIsNone(chunked_progress(upload_file_job.pk))
+
+
+    def test_rerun_chunk(self):
+        upload_file_job = self._uploaded_job()
+        with self.settings(CHUNKED_MIN_CHUNK_SIZE=1000, CHUNKED_MAX_CHUNKS=3):
+            process_upload_file_job_chunked(upload_file_job.pk, count_lines__noop, sum_line_counts__noop)
+        queue = django_rq.get_queue(RQ_QUEUE_FAST)
+        chunk_jobs = queue.jobs
+        self.assertEqual(3, len(chunk_jobs))
+        self.assertEqual({'num_chunks': 3, 'num_finished': 0, 'failure_message': None},
+                         chunked_progress(upload_file_job.pk))
+
+        # e.g., chunk 0's job is requeued after its worker was killed between finishing and being marked finished
+        for chunk_job in [chunk_jobs[0], chunk_jobs[0], chunk_jobs[1]]:
+            chunk_job.perform()
+        self.assertEqual(2, chunked_progress(upload_file_job.pk)['num_finished'])
+        reduce_job_id = '{}-reduce'.format(upload_file_job.pk)
+        self.assertNotIn(reduce_job_id, queue.job_ids)  # not enqueued early
+
+        chunk_jobs[2].perform()
+        chunk_jobs[0].perform()
+        self.assertEqual(3, chunked_progress(upload_file_job.pk)['num_finished'])
+        self.assertEqual(1, queue.job_ids.count(reduce_job_id))  # enqueued once
+
+        django_rq.get_worker(RQ_QUEUE_FAST, worker_class=SimpleWorker).work(burst=True)
+        upload_file_job.refresh_from_db()
+        self.assertEqual(UploadFileJob.SUCCESS, upload_file_job.status, upload_file_job.failure_message)
+        self.assertEqual({'file_size': len(self.file_data), 'num_lines': 500, 'num_chunks': 3},
+                         upload_file_job.output_json)
@@ -0,0 +1,96 @@
+import importlib.util
+import io
+import unittest
+
+from django.test import SimpleTestCase
+
+from forecast_app.compression import COMPRESSION_GZIP, COMPRESSION_NONE, COMPRESSION_ZSTD, CompressingReader, \
+    compressor, decompressing_reader
+from forecast_app.models import UploadFileJob
+from forecast_app.models.upload_file_job import S3_FILE_MODE_MMAP, S3_FILE_MODE_STREAM, S3_FILE_MODE_TEMPFILE, \
+    upload_file_job_s3_file
+from forecast_app.tests.local_storage import LocalStorageTestCase
+from forecast_app.upload_handlers import S3MultipartUploadHandler
+
+
+IS_ZSTD_INSTALLED = importlib.util.find_spec('zstandard') is not None
+
+FILE_DATA = b''.join('line {},{}\n'.format(idx, idx * idx).encode() for idx in range(2000))
+
+
+class CompressionTestCase(SimpleTestCase):
+    """
+    Tests compressing and decompressing round trips.
+    """
+
+
+    def _round_trip(self, compression):
+        compressobj = compressor(compression)
+        compressed_data = b''.join(compressobj.compress(FILE_DATA[start:start + 1000])
+                                   for start in range(0, len(FILE_DATA), 1000)) + compressobj.flush()
+        self.assertLess(len(compressed_data), len(FILE_DATA))
+        reader = decompressing_reader(io.BytesIO(compressed_data), compression)
+        self.assertEqual(FILE_DATA, b''.join(iter(lambda: reader.read(777), b'')))
+        reader.close()
+
+        compressing_reader = CompressingReader(io.BytesIO(FILE_DATA), compression, chunk_size=1000)
+        compressed_data = b''.join(iter(lambda: compressing_reader.read(500), b''))
+        self.assertEqual(len(compressed_data), compressing_reader.compressed_size)
+        self.assertEqual(FILE_DATA, decompressing_reader(io.BytesIO(compressed_data), compression).read())
+
+
+    def test_gzip(self):
+        self._round_trip(COMPRESSION_GZIP)
+
+
+    @unittest.skipUnless(IS_ZSTD_INSTALLED, "the optional zstandard package isn't installed")
+    def test_zstd(self):
+        self._round_trip(COMPRESSION_ZSTD)
+
+
+    def test_none_and_invalid(self):
+        fp = io.BytesIO(FILE_DATA)
+        self.assertIs(fp, decompressing_reader(fp, COMPRESSION_NONE))
+        with self.assertRaises(ValueError):
+            compressor(COMPRESSION_NONE)
+        with self.assertRaises(ValueError):
+            decompressing_reader(fp, 'lzma')
+
+
+class CompressedUploadTestCase(LocalStorageTestCase):
+    """
+    Tests that an upload stored compressed (settings.UPLOAD_COMPRESSION) is decompressed transparently by
+    upload_file_job_s3_file().
+    """
+
+
+    def _upload(self, compression):
+        with self.settings(UPLOAD_COMPRESSION=compression):
+            handler = S3MultipartUploadHandler()
+            handler.new_file('data_file', 'a.csv', 'text/csv', None)
+            for start in range(0, len(FILE_DATA), 1000):
+                handler.receive_data_chunk(FILE_DATA[start:start + 1000], start)
+            handler.file_complete(len(FILE_DATA))
+        self.assertIsNone(handler.failure_message)
+        upload_file_job = handler.upload_file_job
+        self.assertEqual(compression, upload_file_job.compression)
+        self.assertLess(upload_file_job.compressed_size, len(FILE_DATA))
+        upload_file_job.save()
+        upload_file_job.transition(UploadFileJob.PENDING, UploadFileJob.QUEUED)
+        return upload_file_job
+
+
+    def _assert_round_trip(self, compression):
+        for mode in [S3_FILE_MODE_TEMPFILE, S3_FILE_MODE_STREAM, S3_FILE_MODE_MMAP]:
+            upload_file_job = self._upload(compression)
+            with upload_file_job_s3_file(upload_file_job.pk, mode=mode) as (_, s3_file_fp):
+                self.assertEqual(FILE_DATA, s3_file_fp[:] if mode == S3_FILE_MODE_MMAP else s3_file_fp.read())
+
+
+    def test_gzip(self):
+        self._assert_round_trip(COMPRESSION_GZIP)
+
+
+    @unittest.skipUnless(IS_ZSTD_INSTALLED, "the optional zstandard package isn't installed")
+    def test_zstd(self):
+        self._assert_round_trip(COMPRESSION_ZSTD)
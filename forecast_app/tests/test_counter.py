@@ -0,0 +1,72 @@
+import django_rq
+from django.test import TestCase, override_settings
+
+from forecast_app.models import Counter
+from forecast_app.models.counter import COUNTER_BACKEND_REDIS, COUNTER_BACKEND_SHARDED, CounterShard, \
+    REDIS_COALESCED_DELTA_KEY, REDIS_COALESCED_JOB_KEY, REDIS_FLUSH_INTERVAL_KEY, REDIS_PENDING_COUNT_KEY
+from forecast_app.rq_utils import RQ_QUEUE_FAST
+
+
+class CounterTestCase(TestCase):
+    """
+    Tests the Counter backends and coalesced increment jobs. NB: uses the Redis server in settings.RQ_QUEUES, as the
+    app does.
+    """
+
+
+    def setUp(self):
+        django_rq.get_connection().delete(REDIS_PENDING_COUNT_KEY, REDIS_FLUSH_INTERVAL_KEY, REDIS_COALESCED_DELTA_KEY,
+                                          REDIS_COALESCED_JOB_KEY)
+        django_rq.get_queue(RQ_QUEUE_FAST).empty()
+
+
+    @override_settings(COUNTER_BACKEND=COUNTER_BACKEND_REDIS, COUNTER_FLUSH_THRESHOLD=5, COUNTER_FLUSH_INTERVAL=600)
+    def test_redis_backend(self):
+        Counter.increment_count()  # the first increment does the time-based flush
+        self.assertEqual(1, Counter._get_singleton_record().count)
+        for _ in range(3):
+            Counter.increment_count()
+        self.assertEqual(1, Counter._get_singleton_record().count)  # pending in Redis
+        self.assertEqual(4, Counter.get_count_and_last_update()[0])
+
+        Counter.increment_count(by=2)  # 5 pending reaches the threshold
+        self.assertEqual(6, Counter._get_singleton_record().count)
+        self.assertEqual(6, Counter.get_count_and_last_update()[0])
+
+        Counter.increment_count()
+        self.assertEqual(1, Counter.flush_pending_count())
+        self.assertEqual(0, Counter.flush_pending_count())
+        self.assertEqual(7, Counter._get_singleton_record().count)
+        self.assertEqual(7, Counter.get_count_and_last_update()[0])
+
+
+    @override_settings(COUNTER_BACKEND=COUNTER_BACKEND_SHARDED, COUNTER_NUM_SHARDS=4)
+    def test_sharded_backend(self):
+        self.assertEqual((0, None), Counter.get_count_and_last_update())
+        for _ in range(20):
+            Counter.increment_count()
+        Counter.increment_count(by=5)
+        count, last_update = Counter.get_count_and_last_update()
+        self.assertEqual(25, count)
+        self.assertIsNotNone(last_update)
+        self.assertLessEqual(CounterShard.objects.count(), 4)
+        self.assertEqual(0, Counter._get_singleton_record().count)  # the singleton row isn't used
+
+
+    @override_settings(COUNTER_BACKEND=COUNTER_BACKEND_SHARDED)
+    def test_coalesced_increments(self):
+        queue = django_rq.get_queue(RQ_QUEUE_FAST)
+        rq_jobs = [Counter.enqueue_increment_count() for _ in range(10)]
+        self.assertIsNotNone(rq_jobs[0])
+        self.assertEqual([None] * 9, rq_jobs[1:])  # folded into the first job
+        self.assertEqual(1, queue.count)
+
+        rq_jobs[0].perform()
+        self.assertEqual(10, Counter.get_count_and_last_update()[0])
+
+        # the applied job no longer counts as waiting, so the next increment enqueues a new one
+        self.assertIsNotNone(Counter.enqueue_increment_count(by=3))
+        self.assertEqual(2, queue.count)
+        Counter.apply_coalesced_increments()
+        Counter.apply_coalesced_increments()  # nothing pending: a no-op
+        self.assertEqual(13, Counter.get_count_and_last_update()[0])
@@ -0,0 +1,164 @@
+import io
+from unittest import mock
+
+import django_rq
+from rq.registry import FinishedJobRegistry
+
+from forecast_app.models import UploadFileJob
+from forecast_app.prefetch import Prefetcher
+from forecast_app.rq_utils import RQ_QUEUE_BULK, RQ_QUEUE_FAST
+from forecast_app.storage import get_storage
+from forecast_app.tests.local_storage import LocalStorageTestCase
+from forecast_app.worker_pool import PREFETCH_HEARTBEAT_KEY, PrefetchingWorker, release_reserved_jobs
+
+
+def process_upload_file_job(upload_file_job_pk):
+    """
+    A prefetchable RQ job function.
+    """
+    return upload_file_job_pk
+
+
+class PrefetcherTestCase(LocalStorageTestCase):
+    """
+    Tests Prefetcher's file and byte accounting. Calls _prefetch_next() directly rather than running its thread.
+    """
+
+
+    def setUp(self):
+        super().setUp()
+        self.upcoming_jobs = []  # passed via upcoming_jobs_fcn
+        for job_id, content in [('1', b'1234'), ('2', b'12345'), ('3', b'123'), ('4', b'x' * 20)]:
+            get_storage().put_fileobj('key-' + job_id, io.BytesIO(content))
+            self.upcoming_jobs.append((job_id, 'key-' + job_id))
+        self.prefetcher = Prefetcher(lambda max_jobs: self.upcoming_jobs[:max_jobs], max_files=2, max_bytes=10)
+
+
+    def test_take(self):
+        self.assertTrue(self.prefetcher._prefetch_next())
+        self.assertTrue(self.prefetcher._prefetch_next())
+        self.assertFalse(self.prefetcher._prefetch_next())  # max_files
+        self.assertEqual(['1', '2'], list(self.prefetcher._job_id_to_file))
+        self.assertEqual(9, self.prefetcher._num_bytes)
+
+        fp = self.prefetcher.take('1', 'key-1')
+        self.assertEqual(b'1234', fp.read())
+        fp.close()
+        self.assertEqual(5, self.prefetcher._num_bytes)
+        self.assertIsNone(self.prefetcher.take('1', 'key-1'))  # already taken
+        self.assertIsNone(self.prefetcher.take('2', 'another-key'))  # e.g., moved after prefetching: discarded
+        self.assertEqual(0, self.prefetcher._num_bytes)
+        self.assertFalse(self.prefetcher._job_id_to_file)
+
+
+    def test_max_bytes(self):
+        self.upcoming_jobs = self.upcoming_jobs[1:]  # '2' (5 bytes), '3' (3), '4' (20)
+        self.prefetcher.max_files = 5
+        self.prefetcher.max_bytes = 7
+        self.assertTrue(self.prefetcher._prefetch_next())
+        self.assertFalse(self.prefetcher._prefetch_next())  # '3' doesn't fit yet. NB: '4' isn't considered
+        self.assertEqual(['2'], list(self.prefetcher._job_id_to_file))
+
+        self.upcoming_jobs = self.upcoming_jobs[1:]  # '2' is no longer upcoming, but no job is running
+        self.assertFalse(self.prefetcher._prefetch_next())
+        self.assertEqual(['2'], list(self.prefetcher._job_id_to_file))
+
+        self.prefetcher.set_current_job_id('1')
+        self.assertTrue(self.prefetcher._prefetch_next())  # discards '2' and fetches '3'. '4' would never fit
+        self.assertFalse(self.prefetcher._prefetch_next())
+        self.assertEqual(['3'], list(self.prefetcher._job_id_to_file))
+        self.assertEqual(3, self.prefetcher._num_bytes)
+
+
+    def test_discard(self):
+        self.prefetcher._prefetch_next()
+        self.prefetcher._prefetch_next()
+        self.prefetcher.set_current_job_id('1')  # dequeued, so no longer upcoming, but kept
+        self.upcoming_jobs = self.upcoming_jobs[1:]
+        self.prefetcher._prefetch_next()
+        self.assertEqual(['1', '2'], list(self.prefetcher._job_id_to_file))
+
+        self.prefetcher.set_current_job_id(None)  # '1' finished without taking its file
+        self.assertEqual(['2'], list(self.prefetcher._job_id_to_file))
+        self.assertEqual(5, self.prefetcher._num_bytes)
+        self.prefetcher._discard('2')
+        self.assertEqual(0, self.prefetcher._num_bytes)
+
+
+class PrefetchingWorkerTestCase(LocalStorageTestCase):
+    """
+    Tests PrefetchingWorker's job reservations. NB: uses the Redis server in settings.RQ_QUEUES, as the app does.
+    """
+
+
+    def setUp(self):
+        super().setUp()
+        self.queue = django_rq.get_queue(RQ_QUEUE_FAST)
+        self.bulk_queue = django_rq.get_queue(RQ_QUEUE_BULK)
+        self.queue.empty()
+        self.bulk_queue.empty()
+        self.upload_file_jobs = []
+        for _ in range(4):
+            upload_file_job = UploadFileJob.objects.create(status=UploadFileJob.QUEUED)
+            self.queue.enqueue(process_upload_file_job, upload_file_job.pk, job_id=upload_file_job.rq_job_id())
+            self.upload_file_jobs.append(upload_file_job)
+        self.job_ids = [upload_file_job.rq_job_id() for upload_file_job in self.upload_file_jobs]
+
+
+    def _worker(self, name):
+        worker = PrefetchingWorker([self.queue], name=name, connection=self.queue.connection)
+        self.addCleanup(release_reserved_jobs, self.queue.connection, worker.reserved_queue)
+        return worker
+
+
+    def test_reserve(self):
+        worker_1 = self._worker('worker-1')
+        worker_2 = self._worker('worker-2')
+        self.assertEqual([(job_id, job_id) for job_id in self.job_ids[:2]], worker_1._upcoming_upload_jobs(2))
+        self.assertEqual(self.job_ids[:2], worker_1.reserved_queue.job_ids)
+        self.assertEqual(self.job_ids[2:], self.queue.job_ids)  # no other worker can dequeue them
+
+        self.assertEqual(self.job_ids[2:3], [job_id for job_id, _ in worker_2._upcoming_upload_jobs(1)])
+        self.assertEqual(self.job_ids[:2], [job_id for job_id, _ in worker_1._upcoming_upload_jobs(2)])  # topped up
+        self.assertEqual(self.job_ids[3:], self.queue.job_ids)
+
+        # a reserved job whose UploadFileJob failed is still reserved, but isn't upcoming
+        self.upload_file_jobs[0].fail("failed")
+        self.assertEqual(self.job_ids[1:2], [job_id for job_id, _ in worker_1._upcoming_upload_jobs(2)])
+
+
+    def test_release(self):
+        worker = self._worker('worker-1')
+        worker._upcoming_upload_jobs(3)
+        self.assertEqual(3, release_reserved_jobs(worker.connection, worker.reserved_queue))
+        self.assertEqual(self.job_ids, self.queue.job_ids)  # back at the front, in order
+        self.assertEqual([], worker.reserved_queue.job_ids)
+
+
+    def test_sweep_orphaned_reservations(self):
+        worker_1 = self._worker('worker-1')
+        worker_2 = self._worker('worker-2')
+        worker_1._upcoming_upload_jobs(2)
+        worker_2._upcoming_upload_jobs(1)  # worker_1's heartbeat is live
+        self.assertEqual(self.job_ids[:2], worker_1.reserved_queue.job_ids)
+
+        self.queue.connection.delete(PREFETCH_HEARTBEAT_KEY.format(worker_1.name))  # e.g., worker_1 was killed
+        worker_2._last_sweep_time = 0
+        worker_2._upcoming_upload_jobs(1)
+        self.assertEqual([], worker_1.reserved_queue.job_ids)
+        self.assertEqual(self.job_ids[:2] + self.job_ids[3:], self.queue.job_ids)
+
+
+    def test_work(self):
+        self.bulk_queue.enqueue(process_upload_file_job, -1)  # not an upload job id
+        worker = PrefetchingWorker([self.queue, self.bulk_queue], name='worker-1', connection=self.queue.connection)
+        worker._upcoming_upload_jobs(2)
+        with mock.patch.object(worker.prefetcher, 'start'), \
+                mock.patch.object(worker.prefetcher, 'stop'):  # NB: its thread can't share the test's transaction
+            self.assertTrue(worker.work(burst=True))
+        self.assertEqual(0, self.queue.count + self.bulk_queue.count + worker.reserved_queue.count)
+        finished_job_ids = FinishedJobRegistry(self.queue.name, connection=self.queue.connection).get_job_ids()
+        self.assertLessEqual(set(self.job_ids), set(finished_job_ids))  # registered under their own queue
+        self.assertEqual([], FinishedJobRegistry(worker.reserved_queue.name,
+                                                 connection=self.queue.connection).get_job_ids())
+        self.assertFalse(self.queue.connection.exists(PREFETCH_HEARTBEAT_KEY.format(worker.name)))
@@ -0,0 +1,65 @@
+import json
+
+import django_rq
+from django.test import SimpleTestCase, override_settings
+
+from forecast_app.progress import EVENT_PROGRESS, EVENT_STATUS, JOB_EVENTS_CHANNEL, LAST_PROGRESS_KEY, \
+    ProgressReporter, job_event_stream
+
+
+UPLOAD_FILE_JOB_PK = 987654321  # NB: the stream doesn't touch the database
+
+
+def _status_json(status, is_failed=False):
+    return json.dumps({'id': UPLOAD_FILE_JOB_PK, 'status': status, 'is_failed': is_failed, 'failure_message': '',
+                       'updated_at': None, 'output_json': None})
+
+
+@override_settings(PROGRESS_SSE_KEEPALIVE_INTERVAL=0.01, PROGRESS_SSE_MAX_DURATION=1, PROGRESS_MIN_INTERVAL=60)
+class ProgressTestCase(SimpleTestCase):
+    """
+    Tests job events. NB: uses the Redis server in settings.RQ_QUEUES, as the app does.
+    """
+
+
+    def setUp(self):
+        django_rq.get_connection().delete(LAST_PROGRESS_KEY.format(UPLOAD_FILE_JOB_PK))
+
+
+    def test_progress_reporter_rate_limit(self):
+        progress = ProgressReporter(UPLOAD_FILE_JOB_PK, total_bytes=100)
+        self.assertTrue(progress.update(phase='processing', num_bytes=0))  # a new phase is always published
+        self.assertFalse(progress.update(num_bytes=10))
+        self.assertTrue(progress.update(is_force=True, num_bytes=50))
+        last_progress = json.loads(django_rq.get_connection().get(LAST_PROGRESS_KEY.format(UPLOAD_FILE_JOB_PK))
+                                   .decode('utf-8'))
+        self.assertEqual(EVENT_PROGRESS, last_progress['event'])
+        self.assertEqual(('processing', 50, 0.5), (last_progress['data']['phase'], last_progress['data']['num_bytes'],
+                                                   last_progress['data']['fraction']))
+
+
+    def test_job_event_stream_finished(self):
+        events = list(job_event_stream(UPLOAD_FILE_JOB_PK, lambda upload_file_job_pk: _status_json('SUCCESS')))
+        self.assertEqual(2, len(events))  # retry, then the status. no need to wait for events
+        self.assertEqual('event: {}\ndata: {}\n\n'.format(EVENT_STATUS, _status_json('SUCCESS')), events[1])
+
+
+    def test_job_event_stream_status_race(self):
+        # the job finishes while the stream reads its status: the 'status' event published then isn't missed
+        def status_json_fcn(upload_file_job_pk):
+            status_json = _status_json('S3_FILE_DOWNLOADED')
+            django_rq.get_connection().publish(JOB_EVENTS_CHANNEL.format(upload_file_job_pk),
+                                               json.dumps({'event': EVENT_STATUS,
+                                                           'data': json.loads(_status_json('SUCCESS'))}))
+            return status_json
+
+
+        events = [event for event in job_event_stream(UPLOAD_FILE_JOB_PK, status_json_fcn)
+                  if not event.startswith(': keepalive')]
+        self.assertEqual(3, len(events))
+        self.assertIn('"S3_FILE_DOWNLOADED"', events[1])
+        self.assertIn('"SUCCESS"', events[2])  # and the stream ended there rather than at PROGRESS_SSE_MAX_DURATION
+
+
+    def test_job_event_stream_deleted(self):
+        self.assertEqual(1, len(list(job_event_stream(UPLOAD_FILE_JOB_PK, lambda upload_file_job_pk: None))))
@@ -0,0 +1,56 @@
+import django_rq
+from django.test import SimpleTestCase, override_settings
+
+from forecast_app.result_cache import REDIS_RESULT_CACHE_KEY, REDIS_RESULT_CACHE_ORDER_KEY, get_cached_result, \
+    get_cached_results, put_cached_result
+
+
+class ResultCacheTestCase(SimpleTestCase):
+    """
+    Tests the result cache. NB: uses the Redis server in settings.RQ_QUEUES, as the app does.
+    """
+
+
+    def setUp(self):
+        django_rq.get_connection().delete(REDIS_RESULT_CACHE_KEY, REDIS_RESULT_CACHE_ORDER_KEY)
+
+
+    def test_hit_and_miss(self):
+        self.assertEqual((False, None), get_cached_result('a' * 64, {'model_pk': 1}))
+        put_cached_result('a' * 64, {'model_pk': 1, 'timezero_pk': 2}, {'forecast_pk': 3})
+        self.assertEqual((True, {'forecast_pk': 3}),
+                         get_cached_result('a' * 64, {'timezero_pk': 2, 'model_pk': 1}))  # key order doesn't matter
+        self.assertEqual((False, None), get_cached_result('a' * 64, {'model_pk': 1}))  # different input_json
+        self.assertEqual((False, None), get_cached_result('b' * 64, {'model_pk': 1, 'timezero_pk': 2}))
+
+        put_cached_result('b' * 64, None, None)  # a cached None is a hit
+        self.assertEqual([(True, None), (False, None), (True, {'forecast_pk': 3})],
+                         get_cached_results([('b' * 64, None), ('c' * 64, None),
+                                             ('a' * 64, {'model_pk': 1, 'timezero_pk': 2})]))
+        self.assertEqual([], get_cached_results([]))
+
+
+    def test_put_existing(self):
+        put_cached_result('a' * 64, None, {'forecast_pk': 1})
+        put_cached_result('a' * 64, None, {'forecast_pk': 2})  # the first result is kept
+        self.assertEqual((True, {'forecast_pk': 1}), get_cached_result('a' * 64, None))
+        self.assertEqual(1, django_rq.get_connection().llen(REDIS_RESULT_CACHE_ORDER_KEY))
+
+
+    @override_settings(RESULT_CACHE_MAX_ENTRIES=3)
+    def test_eviction(self):
+        for idx in range(5):
+            put_cached_result(str(idx) * 64, None, {'forecast_pk': idx})
+        self.assertEqual([False, False, True, True, True],
+                         [is_hit for is_hit, _ in get_cached_results([(str(idx) * 64, None) for idx in range(5)])])
+        conn = django_rq.get_connection()
+        self.assertEqual(3, conn.hlen(REDIS_RESULT_CACHE_KEY))
+        self.assertEqual(3, conn.llen(REDIS_RESULT_CACHE_ORDER_KEY))
+
+
+    @override_settings(RESULT_CACHE_MAX_ENTRY_SIZE=20)
+    def test_max_entry_size(self):
+        put_cached_result('a' * 64, None, {'forecast_pk': 1})
+        put_cached_result('b' * 64, None, {'forecast_pk': 'x' * 20})  # too large to cache
+        self.assertEqual([True, False], [is_hit for is_hit, _ in get_cached_results([('a' * 64, None),
+                                                                                     ('b' * 64, None)])])
@@ -0,0 +1,49 @@
+import django_rq
+from django.conf import settings
+from django.test import TestCase, override_settings
+
+from forecast_app.models import UploadFileJob
+from forecast_app.rq_utils import RQ_QUEUE_BULK, RQ_QUEUE_FAST, upload_file_job_queue_name_and_timeout
+from forecast_app.views import _enqueue_upload_file_job, process_upload_file_job__noop
+
+
+@override_settings(RQ_FAST_MAX_FILE_SIZE=1000, RQ_UPLOAD_JOB_BYTES_PER_SECOND=100, RQ_UPLOAD_JOB_MIN_TIMEOUT=60,
+                   RQ_UPLOAD_JOB_MAX_TIMEOUT=600)
+class QueueRoutingTestCase(TestCase):
+    """
+    Tests routing upload jobs to queues by file size, and their timeouts. NB: uses the Redis server in
+    settings.RQ_QUEUES, as the app does.
+    """
+
+
+    def setUp(self):
+        for queue_name in settings.RQ_QUEUES:
+            django_rq.get_queue(queue_name).empty()
+
+
+    def test_upload_file_job_queue_name_and_timeout(self):
+        self.assertEqual((RQ_QUEUE_FAST, 60), upload_file_job_queue_name_and_timeout(0))
+        self.assertEqual((RQ_QUEUE_FAST, 70), upload_file_job_queue_name_and_timeout(1000))  # 60 + 1000 / 100
+        self.assertEqual((RQ_QUEUE_BULK, 70), upload_file_job_queue_name_and_timeout(1001))
+        self.assertEqual((RQ_QUEUE_BULK, 560), upload_file_job_queue_name_and_timeout(50000))
+        self.assertEqual((RQ_QUEUE_BULK, 600), upload_file_job_queue_name_and_timeout(10 ** 9))  # max timeout
+        self.assertEqual((RQ_QUEUE_BULK, 600), upload_file_job_queue_name_and_timeout(None))  # unknown size
+
+
+    def test_enqueue_upload_file_job(self):
+        for file_size, queue_name, timeout in [(500, RQ_QUEUE_FAST, 65), (5000, RQ_QUEUE_BULK, 110)]:
+            upload_file_job = UploadFileJob.objects.create(status=UploadFileJob.S3_FILE_UPLOADED)
+            rq_job, failure_message = _enqueue_upload_file_job(upload_file_job, process_upload_file_job__noop,
+                                                               file_size)
+            self.assertIsNone(failure_message)
+            self.assertEqual(UploadFileJob.QUEUED, upload_file_job.status)
+            self.assertEqual((queue_name, timeout, upload_file_job.rq_job_id()),
+                             (rq_job.origin, rq_job.timeout, rq_job.id))
+            self.assertEqual([rq_job.id], django_rq.get_queue(queue_name).job_ids)
+            django_rq.get_queue(queue_name).empty()
+
+        # not S3_FILE_UPLOADED, e.g., a repeated request: not enqueued
+        rq_job, failure_message = _enqueue_upload_file_job(upload_file_job, process_upload_file_job__noop, 500)
+        self.assertIsNone(rq_job)
+        self.assertIn("FAILED_ENQUEUE", failure_message)
+        self.assertEqual(0, sum(django_rq.get_queue(queue_name).count for queue_name in settings.RQ_QUEUES))
@@ -0,0 +1,46 @@
+import os
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from forecast_app.storage import S3_DELETE_OBJECTS_BATCH_SIZE, S3Storage
+
+
+class S3StorageTestCase(SimpleTestCase):
+    """
+    Tests S3Storage with its boto3 client mocked.
+    """
+
+
+    def setUp(self):
+        self.s3_storage = S3Storage()
+        self.s3_storage._client = mock.MagicMock()
+        self.s3_storage._client_pid = os.getpid()  # i.e., don't create a real client
+
+
+    def test_delete_many_batches(self):
+        self.s3_storage.client.delete_objects.return_value = {}
+        keys = ['key-{}'.format(idx) for idx in range(2 * S3_DELETE_OBJECTS_BATCH_SIZE + 500)]
+        self.assertEqual([], self.s3_storage.delete_many(keys))
+
+        batches = [[s3_object['Key'] for s3_object in call[1]['Delete']['Objects']]
+                   for call in self.s3_storage.client.delete_objects.call_args_list]
+        self.assertEqual([500, 1000, 1000], sorted(len(batch) for batch in batches))  # NB: batches run concurrently
+        self.assertEqual(sorted(keys), sorted(sum(batches, [])))
+
+
+    def test_delete_many_failures(self):
+        def delete_objects(Bucket, Delete):
+            keys = [s3_object['Key'] for s3_object in Delete['Objects']]
+            if 'key-0' in keys:
+                raise RuntimeError("request failed")
+
+            return {'Errors': [{'Key': keys[0], 'Code': 'AccessDenied', 'Message': "Access Denied"}]}
+
+
+        self.s3_storage.client.delete_objects.side_effect = delete_objects
+        keys = ['key-{}'.format(idx) for idx in range(S3_DELETE_OBJECTS_BATCH_SIZE + 1)]
+        failures = self.s3_storage.delete_many(keys)
+        self.assertEqual(S3_DELETE_OBJECTS_BATCH_SIZE + 1, len(failures))  # a whole failed batch plus one error
+        self.assertIn(('key-0', "request failed"), failures)
+        self.assertIn(('key-1000', "AccessDenied: Access Denied"), failures)
@@ -0,0 +1,254 @@
+from unittest import mock
+
+import io
+
+import django_rq
+from django.test import TestCase
+from django.utils import timezone
+
+from forecast_app.job_status import JOB_STATUS_KEY
+from forecast_app.models import UploadFileJob
+from forecast_app.models.upload_file_job import CONTENT_ADDRESSED_KEY_PREFIX, complete_from_result_cache, \
+    delete_upload_file_jobs, parse_upload_file_jobs_cursor, store_content_addressed, upload_file_job_s3_file, \
+    upload_file_jobs_page
+from forecast_app.result_cache import REDIS_RESULT_CACHE_KEY, REDIS_RESULT_CACHE_ORDER_KEY, put_cached_result
+from forecast_app.storage import get_storage
+from forecast_app.tests.local_storage import LocalStorageTestCase
+
+
+class UploadFileJobTransitionTestCase(TestCase):
+    """
+    Tests UploadFileJob's compare-and-set status changes.
+    """
+
+
+    def test_transition(self):
+        upload_file_job = UploadFileJob.objects.create(status=UploadFileJob.S3_FILE_UPLOADED)
+        self.assertTrue(upload_file_job.transition(UploadFileJob.S3_FILE_UPLOADED, UploadFileJob.S3_FILE_DOWNLOADED))
+        self.assertEqual(UploadFileJob.S3_FILE_DOWNLOADED, upload_file_job.status)
+        self.assertIsNotNone(upload_file_job.started_at)  # STATUS_TIMESTAMP_FIELDS
+        upload_file_job.refresh_from_db()
+        self.assertEqual(UploadFileJob.S3_FILE_DOWNLOADED, upload_file_job.status)
+        self.assertIsNotNone(upload_file_job.started_at)
+
+
+    def test_transition_lost_race(self):
+        # two copies of the same row, as two workers would have. only the first transition applies
+        upload_file_job_1 = UploadFileJob.objects.create(status=UploadFileJob.S3_FILE_UPLOADED)
+        upload_file_job_2 = UploadFileJob.objects.get(pk=upload_file_job_1.pk)
+        self.assertTrue(upload_file_job_1.transition(UploadFileJob.S3_FILE_UPLOADED, UploadFileJob.S3_FILE_DOWNLOADED))
+        self.assertFalse(upload_file_job_2.transition(UploadFileJob.S3_FILE_UPLOADED, UploadFileJob.QUEUED,
+                                                      output_json={'lost': True}))
+
+        # the loser's in-memory copy and the row are both unchanged by the lost transition
+        self.assertEqual(UploadFileJob.S3_FILE_UPLOADED, upload_file_job_2.status)
+        self.assertIsNone(upload_file_job_2.output_json)
+        upload_file_job_2.refresh_from_db()
+        self.assertEqual(UploadFileJob.S3_FILE_DOWNLOADED, upload_file_job_2.status)
+        self.assertIsNone(upload_file_job_2.output_json)
+        self.assertIsNone(upload_file_job_2.queued_at)
+
+
+    def test_transition_failed_job(self):
+        upload_file_job = UploadFileJob.objects.create(status=UploadFileJob.S3_FILE_UPLOADED)
+        UploadFileJob.objects.get(pk=upload_file_job.pk).fail("failed elsewhere")
+        self.assertFalse(upload_file_job.transition(UploadFileJob.S3_FILE_UPLOADED, UploadFileJob.SUCCESS))
+        upload_file_job.refresh_from_db()
+        self.assertEqual(UploadFileJob.S3_FILE_UPLOADED, upload_file_job.status)
+        self.assertTrue(upload_file_job.is_failed)
+        self.assertEqual("failed elsewhere", upload_file_job.failure_message)
+
+
+    def test_upload_file_job_s3_file_already_claimed(self):
+        upload_file_job = UploadFileJob.objects.create(status=UploadFileJob.S3_FILE_DOWNLOADED)
+        with self.assertRaises(RuntimeError):
+            with upload_file_job_s3_file(upload_file_job.pk):
+                self.fail("claimed a job that another job is processing")
+        upload_file_job.refresh_from_db()
+        self.assertEqual(UploadFileJob.S3_FILE_DOWNLOADED, upload_file_job.status)
+        self.assertFalse(upload_file_job.is_failed)  # the job that did claim it is still processing it
+
+
+    def test_transition_many(self):
+        pending_job = UploadFileJob.objects.create(status=UploadFileJob.PENDING)
+        uploaded_job = UploadFileJob.objects.create(status=UploadFileJob.S3_FILE_UPLOADED)
+        failed_job = UploadFileJob.objects.create(status=UploadFileJob.PENDING)
+        UploadFileJob.objects.get(pk=failed_job.pk).fail("failed elsewhere")
+        with self.assertNumQueries(2):  # the UPDATE, plus the re-SELECT b/c some didn't apply
+            transitioned_jobs = UploadFileJob.transition_many([pending_job, uploaded_job, failed_job],
+                                                              UploadFileJob.PENDING, UploadFileJob.S3_FILE_UPLOADED)
+        self.assertEqual([pending_job], transitioned_jobs)
+        self.assertIsNotNone(pending_job.uploaded_at)
+        self.assertEqual(UploadFileJob.PENDING, failed_job.status)  # not updated in memory
+        failed_job.refresh_from_db()
+        self.assertEqual(UploadFileJob.PENDING, failed_job.status)
+        self.assertTrue(failed_job.is_failed)
+
+        # none left to transition
+        self.assertEqual([], UploadFileJob.transition_many([pending_job, uploaded_job], UploadFileJob.PENDING,
+                                                           UploadFileJob.S3_FILE_UPLOADED))
+
+
+    def test_fail_many(self):
+        upload_file_jobs = [UploadFileJob.objects.create(status=status)
+                            for status in (UploadFileJob.PENDING, UploadFileJob.QUEUED)]
+        with self.assertNumQueries(1):
+            UploadFileJob.fail_many(upload_file_jobs, 'x' * 3000)
+        for upload_file_job in upload_file_jobs:
+            upload_file_job.refresh_from_db()
+            self.assertTrue(upload_file_job.is_failed)
+            self.assertEqual(2000, len(upload_file_job.failure_message))  # truncated to the field's max_length
+            self.assertIsNotNone(upload_file_job.finished_at)
+
+
+class UploadFileJobsPageTestCase(TestCase):
+    """
+    Tests keyset pagination of UploadFileJobs.
+    """
+
+
+    def test_upload_file_jobs_page(self):
+        upload_file_jobs = [UploadFileJob.objects.create(filename='file-{}.csv'.format(idx)) for idx in range(7)]
+        # give most of them the same updated_at so that pages have to be split on the pk tie-breaker
+        UploadFileJob.objects.filter(pk__in=[upload_file_job.pk for upload_file_job in upload_file_jobs[:5]]) \
+            .update(updated_at=timezone.now())
+
+        page_pks = []
+        cursor = None
+        for _ in range(len(upload_file_jobs)):
+            page, cursor = upload_file_jobs_page(cursor, page_size=3)
+            page_pks.append([upload_file_job.pk for upload_file_job in page])
+            if cursor is None:
+                break
+        self.assertEqual([3, 3, 1], [len(pks) for pks in page_pks])
+        expected_pks = list(UploadFileJob.objects.order_by('-updated_at', '-id').values_list('id', flat=True))
+        self.assertEqual(expected_pks, sum(page_pks, []))  # every job once, in order
+
+
+    def test_upload_file_jobs_page_last_page(self):
+        UploadFileJob.objects.create()
+        page, cursor = upload_file_jobs_page(page_size=1)
+        self.assertEqual(1, len(page))
+        self.assertIsNone(cursor)
+
+
+    def test_bad_cursor(self):
+        for bad_cursor in ['garbage', '2019-13-45T00:00:00,1', 'not a date,1', '2019-01-01T00:00:00+00:00,x']:
+            with self.assertRaises(ValueError):
+                upload_file_jobs_page(bad_cursor)
+
+        updated_at, pk = parse_upload_file_jobs_cursor('2019-01-01T12:34:56.789000+00:00,42')
+        self.assertEqual(42, pk)
+        self.assertEqual(56, updated_at.second)
+
+
+    def test_index_bad_cursor(self):
+        response = self.client.get('/?cursor=garbage')
+        self.assertEqual(302, response.status_code)  # redirected to the first page with a message
+
+
+class DeleteUploadFileJobsTestCase(TestCase):
+    """
+    Tests bulk deletes of UploadFileJobs.
+    """
+
+
+    def test_delete_upload_file_jobs(self):
+        shared_job_1 = UploadFileJob.objects.create(content_digest='a' * 64)
+        shared_job_2 = UploadFileJob.objects.create(content_digest='a' * 64)
+        other_job = UploadFileJob.objects.create()
+        conn = django_rq.get_connection()
+        self.assertTrue(conn.exists(JOB_STATUS_KEY.format(other_job.pk)))  # written by post_save
+        with mock.patch('forecast_app.models.upload_file_job.get_storage') as get_storage_mock, \
+                mock.patch('forecast_app.models.upload_file_job.invalidate_upload_file_jobs_cache') as invalidate_mock:
+            s3_keys = delete_upload_file_jobs(UploadFileJob.objects.all())
+        get_storage_mock.assert_not_called()  # the caller deletes the keys
+        invalidate_mock.assert_called_once_with()  # not once per row
+        self.assertEqual(0, UploadFileJob.objects.count())
+        self.assertEqual(shared_job_1.s3_key(), shared_job_2.s3_key())
+        self.assertEqual(sorted([shared_job_1.s3_key(), other_job.s3_key()]), sorted(s3_keys))  # deduplicated
+        for upload_file_job in [shared_job_1, shared_job_2, other_job]:
+            self.assertFalse(conn.exists(JOB_STATUS_KEY.format(upload_file_job.pk)))
+
+
+    def test_delete_one(self):
+        upload_file_job = UploadFileJob.objects.create()
+        upload_file_job_pk = upload_file_job.pk
+        with mock.patch('forecast_app.models.upload_file_job.get_storage') as get_storage_mock:
+            upload_file_job.delete()
+        get_storage_mock.return_value.delete.assert_called_once_with(str(upload_file_job_pk))  # by pre_delete
+        self.assertFalse(django_rq.get_connection().exists(JOB_STATUS_KEY.format(upload_file_job_pk)))
+
+
+class ContentAddressedTestCase(LocalStorageTestCase):
+    """
+    Tests content-addressed storage of uploads and completing jobs from the result cache.
+    """
+
+
+    def setUp(self):
+        super().setUp()
+        django_rq.get_connection().delete(REDIS_RESULT_CACHE_KEY, REDIS_RESULT_CACHE_ORDER_KEY)
+
+
+    def _uploaded_job(self, content):
+        upload_file_job = UploadFileJob.objects.create()
+        get_storage().put_fileobj(upload_file_job.s3_key(), io.BytesIO(content))  # at its per-job key
+        return upload_file_job
+
+
+    def test_store_content_addressed(self):
+        storage = get_storage()
+        upload_file_job_1 = self._uploaded_job(b'a,b\n')
+        staging_key_1 = upload_file_job_1.s3_key()
+        store_content_addressed(upload_file_job_1, 'a' * 64)
+        self.assertEqual(CONTENT_ADDRESSED_KEY_PREFIX + 'a' * 64, upload_file_job_1.s3_key())
+        self.assertTrue(storage.exists(upload_file_job_1.s3_key()))
+        self.assertFalse(storage.exists(staging_key_1))
+
+        # a duplicate is stored once: its per-job object is deleted
+        upload_file_job_2 = self._uploaded_job(b'a,b\n')
+        staging_key_2 = upload_file_job_2.s3_key()
+        store_content_addressed(upload_file_job_2, 'a' * 64)
+        self.assertEqual(upload_file_job_1.s3_key(), upload_file_job_2.s3_key())
+        self.assertFalse(storage.exists(staging_key_2))
+        self.assertEqual([upload_file_job_1.s3_key()],
+                         [storage_object.key for storage_object in storage.iter_objects()])
+
+        # the shared object outlives one of its jobs finishing
+        UploadFileJob.objects.filter(pk=upload_file_job_1.pk).update(status=UploadFileJob.SUCCESS)
+        upload_file_job_1.delete_s3_object()
+        self.assertTrue(storage.exists(upload_file_job_2.s3_key()))
+        upload_file_job_2.delete_s3_object()
+        self.assertFalse(storage.exists(upload_file_job_2.s3_key()))
+
+
+    def test_store_content_addressed_move_fails(self):
+        upload_file_job = self._uploaded_job(b'a,b\n')
+        staging_key = upload_file_job.s3_key()
+        with mock.patch.object(get_storage(), 'move', side_effect=OSError("move failed")):
+            store_content_addressed(upload_file_job, 'a' * 64)
+        upload_file_job.refresh_from_db()
+        self.assertEqual('', upload_file_job.content_digest)  # falls back to the per-job object
+        self.assertEqual(staging_key, upload_file_job.s3_key())
+        self.assertTrue(get_storage().exists(staging_key))
+
+
+    def test_complete_from_result_cache(self):
+        upload_file_jobs = [self._uploaded_job(b'a,b\n') for _ in range(3)]
+        for upload_file_job in upload_file_jobs:
+            store_content_addressed(upload_file_job, 'a' * 64)
+            upload_file_job.transition(UploadFileJob.PENDING, UploadFileJob.S3_FILE_UPLOADED)
+        self.assertFalse(complete_from_result_cache(upload_file_jobs[0]))  # a miss
+        self.assertEqual(UploadFileJob.S3_FILE_UPLOADED, upload_file_jobs[0].status)
+
+        put_cached_result('a' * 64, None, {'forecast_pk': 1})
+        self.assertTrue(complete_from_result_cache(upload_file_jobs[0]))
+        self.assertTrue(get_storage().exists(upload_file_jobs[0].s3_key()))  # still shared with in-progress jobs
+        self.assertTrue(complete_from_result_cache(upload_file_jobs[1]))
+        self.assertTrue(complete_from_result_cache(upload_file_jobs[2]))
+        self.assertFalse(get_storage().exists(upload_file_jobs[2].s3_key()))
+        for upload_file_job in upload_file_jobs:
+            upload_file_job.refresh_from_db()
+            self.assertEqual(UploadFileJob.SUCCESS, upload_file_job.status)
+            self.assertEqual({'forecast_pk': 1}, upload_file_job.output_json)
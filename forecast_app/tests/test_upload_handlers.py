@@ -0,0 +1,86 @@
+import hashlib
+import os
+from unittest import mock
+
+from django.core.files.uploadhandler import StopUpload
+
+from forecast_app.models import UploadFileJob
+from forecast_app.storage import LocalFileSystemStorage, get_storage
+from forecast_app.tests.local_storage import LocalStorageTestCase
+from forecast_app.upload_handlers import S3MultipartUploadHandler
+
+
+class S3MultipartUploadHandlerTestCase(LocalStorageTestCase):
+    """
+    Tests S3MultipartUploadHandler by calling its FileUploadHandler methods as Django's MultiPartParser does.
+    """
+
+
+    def _start(self, handler):
+        handler.new_file('data_file', 'a.csv', 'text/csv', None)
+        return handler.upload_file_job
+
+
+    def _multipart_dirs(self):
+        return os.listdir(os.path.join(self.storage_root, LocalFileSystemStorage.MULTIPART_DIR_NAME))
+
+
+    def test_upload(self):
+        handler = S3MultipartUploadHandler()
+        upload_file_job = self._start(handler)
+        self.assertEqual(UploadFileJob.PENDING, upload_file_job.status)
+        handler.receive_data_chunk(b'a,b\n', 0)
+        handler.receive_data_chunk(b'1,2\n', 4)
+        uploaded_file = handler.file_complete(8)
+        self.assertIsNone(handler.failure_message)
+        self.assertEqual(8, uploaded_file.size)
+        self.assertEqual(hashlib.sha256(b'a,b\n1,2\n').hexdigest(), uploaded_file.content_digest)
+        with get_storage().open_stream(upload_file_job.s3_key()) as fp:
+            self.assertEqual(b'a,b\n1,2\n', fp.read())
+        self.assertEqual([], self._multipart_dirs())
+
+
+    def test_max_size(self):
+        handler = S3MultipartUploadHandler(max_size=10)
+        upload_file_job = self._start(handler)
+        handler.receive_data_chunk(b'x' * 8, 0)
+        with self.assertRaises(StopUpload):
+            handler.receive_data_chunk(b'x' * 8, 8)
+        self.assertIn("too large", handler.failure_message)
+        self.assertIsNone(handler.receive_data_chunk(b'x' * 8, 16))  # the rest is dropped
+        self.assertIsNone(handler.file_complete(24))
+        self.assertFalse(get_storage().exists(upload_file_job.s3_key()))
+        self.assertEqual([], self._multipart_dirs())  # the multipart upload was aborted
+
+
+    def test_part_upload_error(self):
+        handler = S3MultipartUploadHandler()
+        upload_file_job = self._start(handler)
+        storage = get_storage()
+        with mock.patch.object(storage, 'upload_part', side_effect=OSError("part failed")), \
+                mock.patch.object(storage, 'abort_multipart_upload',
+                                  wraps=storage.abort_multipart_upload) as abort_mock:
+            handler.receive_data_chunk(b'a,b\n', 0)
+            self.assertIsNone(handler.file_complete(4))
+        self.assertIn("part failed", handler.failure_message)
+        abort_mock.assert_called_once_with(upload_file_job.s3_key(), mock.ANY)
+        self.assertFalse(storage.exists(upload_file_job.s3_key()))
+        self.assertEqual([], self._multipart_dirs())
+
+
+    def test_incomplete_upload(self):
+        handler = S3MultipartUploadHandler()
+        self._start(handler)
+        handler.receive_data_chunk(b'a,b\n', 0)
+        handler.upload_complete()  # e.g., the client disconnected before the file ended
+        self.assertEqual("The upload was incomplete.", handler.failure_message)
+        self.assertEqual([], self._multipart_dirs())
+
+
+    def test_other_fields(self):
+        handler = S3MultipartUploadHandler()
+        handler.new_file('other_file', 'b.csv', 'text/csv', None)
+        self.assertIsNone(handler.upload_file_job)
+        self.assertIsNone(handler.receive_data_chunk(b'b\n', 0))
+        self.assertIsNone(handler.file_complete(2))
+        self.assertEqual(0, UploadFileJob.objects.count())
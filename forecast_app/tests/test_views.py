@@ -0,0 +1,165 @@
+import datetime
+import io
+from unittest import mock
+
+import django_rq
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase
+from django.utils import timezone
+
+from forecast_app.job_status import JOB_STATUS_KEY
+from forecast_app.models import UploadFileJob
+from forecast_app.result_cache import REDIS_RESULT_CACHE_KEY, REDIS_RESULT_CACHE_ORDER_KEY, put_cached_result
+from forecast_app.storage import get_storage
+from forecast_app.tests.local_storage import LocalStorageTestCase
+from forecast_app.views import PRESIGNED_JOBS_KEY, PRESIGNED_UPLOAD_REAP_AFTER, reap_expired_presigned_jobs
+
+
+class UploadFilesTestCase(LocalStorageTestCase):
+    """
+    Tests views.upload_files(). NB: uses the Redis server in settings.RQ_QUEUES, as the app does.
+    """
+
+
+    def setUp(self):
+        super().setUp()
+        django_rq.get_connection().delete(REDIS_RESULT_CACHE_KEY, REDIS_RESULT_CACHE_ORDER_KEY)
+        for queue_name in settings.RQ_QUEUES:
+            django_rq.get_queue(queue_name).empty()
+
+
+    def test_upload_files(self):
+        cached_digest = 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'  # sha256 of b''
+        put_cached_result(cached_digest, None, {'cached': True})
+        data_files = [SimpleUploadedFile('a.csv', b'a\n'), SimpleUploadedFile('a-again.csv', b'a\n'),
+                      SimpleUploadedFile('b.csv', b'b\nb\n'), SimpleUploadedFile('empty-1.csv', b''),
+                      SimpleUploadedFile('empty-2.csv', b'')]
+        response = self.client.post('/upload_files/', {'data_files': data_files})
+        self.assertEqual(302, response.status_code)
+
+        filename_to_upload_file_job = {upload_file_job.filename: upload_file_job
+                                       for upload_file_job in UploadFileJob.objects.all()}
+        self.assertEqual(5, len(filename_to_upload_file_job))
+        for filename in ['empty-1.csv', 'empty-2.csv']:  # completed from the result cache, without processing
+            upload_file_job = filename_to_upload_file_job[filename]
+            self.assertEqual(UploadFileJob.SUCCESS, upload_file_job.status)
+            self.assertEqual({'cached': True}, upload_file_job.output_json)
+        self.assertFalse(get_storage().exists(filename_to_upload_file_job['empty-1.csv'].s3_key()))
+
+        queued_jobs = [filename_to_upload_file_job[filename] for filename in ['a.csv', 'a-again.csv', 'b.csv']]
+        for upload_file_job in queued_jobs:
+            self.assertEqual(UploadFileJob.QUEUED, upload_file_job.status)
+            self.assertFalse(upload_file_job.is_failed)
+            self.assertTrue(get_storage().exists(upload_file_job.s3_key()))
+        self.assertEqual(queued_jobs[0].s3_key(), queued_jobs[1].s3_key())  # identical files are stored once
+        queued_job_ids = {job_id for queue_name in settings.RQ_QUEUES
+                          for job_id in django_rq.get_queue(queue_name).job_ids}
+        self.assertEqual({upload_file_job.rq_job_id() for upload_file_job in queued_jobs}, queued_job_ids)
+
+
+class PresignedUploadTestCase(LocalStorageTestCase):
+    """
+    Tests direct-to-S3 uploads, with LocalFileSystemStorage standing in for S3's presigned POSTs.
+    """
+
+
+    def setUp(self):
+        super().setUp()
+        django_rq.get_connection().delete(PRESIGNED_JOBS_KEY)
+        presigned_post_patch = mock.patch.object(get_storage(), 'generate_presigned_post',
+                                                 return_value={'url': 'https://s3/bucket', 'fields': {}})
+        presigned_post_patch.start()
+        self.addCleanup(presigned_post_patch.stop)
+
+
+    def _presigned_job(self, age):
+        response = self.client.post('/upload_file_presigned/', {'filename': 'a.csv'})
+        self.assertEqual(200, response.status_code)
+        upload_file_job = UploadFileJob.objects.get(pk=response.json()['upload_file_job_pk'])
+        UploadFileJob.objects.filter(pk=upload_file_job.pk) \
+            .update(created_at=timezone.now() - datetime.timedelta(seconds=age))
+        return upload_file_job
+
+
+    def test_reap_expired_presigned_jobs(self):
+        expired_job = self._presigned_job(PRESIGNED_UPLOAD_REAP_AFTER + 1)
+        get_storage().put_fileobj(expired_job.s3_key(), io.BytesIO(b'a\n'))  # uploaded, but never completed
+        waiting_job = self._presigned_job(PRESIGNED_UPLOAD_REAP_AFTER - 60)
+        completed_job = self._presigned_job(PRESIGNED_UPLOAD_REAP_AFTER + 1)
+        get_storage().put_fileobj(completed_job.s3_key(), io.BytesIO(b'b\n'))
+        response = self.client.post('/upload_file_complete/{}/'.format(completed_job.pk))
+        self.assertEqual(200, response.status_code)
+        conn = django_rq.get_connection()
+        self.assertEqual({expired_job.pk, waiting_job.pk},
+                         {int(upload_file_job_pk) for upload_file_job_pk in conn.smembers(PRESIGNED_JOBS_KEY)})
+
+        self.assertEqual(1, reap_expired_presigned_jobs())
+        expired_job.refresh_from_db()
+        self.assertTrue(expired_job.is_failed)
+        self.assertFalse(get_storage().exists(expired_job.s3_key()))
+        for upload_file_job in [waiting_job, completed_job]:
+            upload_file_job.refresh_from_db()
+            self.assertFalse(upload_file_job.is_failed)
+        self.assertEqual({waiting_job.pk},
+                         {int(upload_file_job_pk) for upload_file_job_pk in conn.smembers(PRESIGNED_JOBS_KEY)})
+        self.assertEqual(0, reap_expired_presigned_jobs())
+
+
+class JobStatusTestCase(TestCase):
+    """
+    Tests the JSON job status endpoints and their ETags. NB: uses the Redis server in settings.RQ_QUEUES, as the app
+    does.
+    """
+
+
+    def test_upload_file_job_status(self):
+        upload_file_job = UploadFileJob.objects.create(filename='a.csv')
+        url = '/jobs/{}/status/'.format(upload_file_job.pk)
+        with self.assertNumQueries(0):  # served from Redis
+            response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('PENDING', response.json()['status'])
+        etag = response['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(b'', response.content)
+
+        upload_file_job.transition(UploadFileJob.PENDING, UploadFileJob.S3_FILE_UPLOADED)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)  # changed
+        self.assertEqual('S3_FILE_UPLOADED', response.json()['status'])
+        self.assertNotEqual(etag, response['ETag'])
+
+        # an expired record is read from the database and re-cached, with the same ETag
+        django_rq.get_connection().delete(JOB_STATUS_KEY.format(upload_file_job.pk))
+        etag = response['ETag']
+        self.assertEqual(304, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+        self.assertTrue(django_rq.get_connection().exists(JOB_STATUS_KEY.format(upload_file_job.pk)))
+
+        django_rq.get_connection().delete(JOB_STATUS_KEY.format(upload_file_job.pk + 1))  # e.g., from another test
+        self.assertEqual(404, self.client.get('/jobs/{}/status/'.format(upload_file_job.pk + 1)).status_code)
+
+
+    def test_upload_file_job_statuses(self):
+        upload_file_jobs = [UploadFileJob.objects.create(filename='a.csv') for _ in range(2)]
+        missing_pk = upload_file_jobs[-1].pk + 1
+        django_rq.get_connection().delete(JOB_STATUS_KEY.format(missing_pk))  # e.g., from another test
+        url = '/jobs/status/?ids={},{},{}'.format(upload_file_jobs[0].pk, upload_file_jobs[1].pk, missing_pk)
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        jobs_json = response.json()['jobs']
+        self.assertEqual(['PENDING', 'PENDING', None],
+                         [jobs_json[str(pk)] and jobs_json[str(pk)]['status']
+                          for pk in [upload_file_jobs[0].pk, upload_file_jobs[1].pk, missing_pk]])
+        etag = response['ETag']
+        self.assertEqual(304, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+
+        upload_file_jobs[1].fail("failed")
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.json()['jobs'][str(upload_file_jobs[1].pk)]['is_failed'])
+
+        for bad_ids in ['', 'x', '1,,x', ','.join(['1'] * 1000)]:
+            self.assertEqual(400, self.client.get('/jobs/status/?ids=' + bad_ids).status_code)
@@ -0,0 +1,58 @@
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from forecast_app.worker_pool import WorkerPool
+
+
+@override_settings(RQ_POOL_SCALE_INTERVAL=0, RQ_POOL_JOBS_PER_WORKER=10, RQ_POOL_MAX_WAIT_TIME=5,
+                   RQ_POOL_SCALE_DOWN_DELAY=60)
+class WorkerPoolTestCase(SimpleTestCase):
+    """
+    Tests WorkerPool's scaling decisions, with the queues' lengths and wait times mocked.
+    """
+
+
+    def _autoscale(self, worker_pool, lengths_and_wait_times):
+        with mock.patch('forecast_app.worker_pool.queue_length_and_wait_time', side_effect=lengths_and_wait_times):
+            worker_pool._autoscale()
+        return worker_pool.num_workers
+
+
+    def test_scale_up(self):
+        worker_pool = WorkerPool(['fast', 'bulk'], min_workers=1, max_workers=8, max_jobs=None)
+        self.assertEqual(3, self._autoscale(worker_pool, [(25, 0), (0, 0)]))  # 25 jobs / 10 per worker
+        self.assertEqual(8, self._autoscale(worker_pool, [(500, 0), (500, 0)]))  # capped at max_workers
+
+        # a long wait adds a worker even if the queues are short
+        worker_pool = WorkerPool(['fast'], min_workers=1, max_workers=8, max_jobs=None)
+        self.assertEqual(2, self._autoscale(worker_pool, [(1, 10)]))
+        self.assertEqual(3, self._autoscale(worker_pool, [(1, 10)]))
+
+
+    def test_scale_down(self):
+        worker_pool = WorkerPool(['fast'], min_workers=1, max_workers=8, max_jobs=None)
+        self.assertEqual(5, self._autoscale(worker_pool, [(50, 0)]))
+        self.assertEqual(5, self._autoscale(worker_pool, [(0, 0)]))  # not idle for long enough yet
+
+        worker_pool._last_busy_time = time.time() - 61
+        self.assertEqual(4, self._autoscale(worker_pool, [(0, 0)]))  # one at a time
+        self.assertEqual(3, self._autoscale(worker_pool, [(0, 0)]))
+        worker_pool.num_workers = 1
+        self.assertEqual(1, self._autoscale(worker_pool, [(0, 0)]))  # not below min_workers
+
+
+    def test_scale_interval(self):
+        worker_pool = WorkerPool(['fast'], min_workers=1, max_workers=8, max_jobs=None)
+        with self.settings(RQ_POOL_SCALE_INTERVAL=60):
+            self.assertEqual(3, self._autoscale(worker_pool, [(30, 0)]))
+            self.assertEqual(3, self._autoscale(worker_pool, [(80, 0)]))  # too soon to rescale
+
+
+    def test_retiring_processes_count_against_max_workers(self):
+        worker_pool = WorkerPool(['fast'], min_workers=1, max_workers=3, max_jobs=None)
+        worker_pool.processes = [mock.Mock()]
+        self.assertTrue(worker_pool._is_below_max_workers())
+        worker_pool.retiring_processes = [mock.Mock(), mock.Mock()]  # still finishing their jobs
+        self.assertFalse(worker_pool._is_below_max_workers())
@@ -0,0 +1,173 @@
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+from forecast_app.compression import compressor
+from forecast_app.models import UploadFileJob
+from forecast_app.storage import get_storage
+
+
+logger = logging.getLogger(__name__)
+
+S3_MULTIPART_PART_SIZE = 8 * 1024 * 1024  # S3 requires >= 5 MB for all parts except the last
+
+S3_MULTIPART_MAX_CONCURRENCY = 4  # max parts uploading at once. bounds memory to ~(this + 1) * S3_MULTIPART_PART_SIZE
+
+
+class S3UploadedFile(UploadedFile):
+    """
+    An UploadedFile whose data was streamed to S3 by S3MultipartUploadHandler, and so has no local data. content_digest
+    is the hex SHA-256 of the data.
+    """
+
+
+    def __init__(self, upload_file_job, content_digest, name, content_type, size, charset, content_type_extra=None):
+        super().__init__(None, name, content_type, size, charset, content_type_extra)
+        self.upload_file_job = upload_file_job
+        self.content_digest = content_digest
+
+
+    def close(self):
+        pass  # nothing local to close
+
+
+class S3MultipartUploadHandler(FileUploadHandler):
+    """
+    A FileUploadHandler that streams the file posted as `field_name` directly into an S3 multipart upload as the request
+    body arrives, rather than having Django buffer it in memory or a temporary file first. Parts are uploaded in
+    parallel by a small thread pool. Creates the corresponding UploadFileJob (status PENDING) when the file starts so
+    that its s3_key() is known. Also computes the data's SHA-256 as it passes through, for content addressing, and
+    compresses it on the way to S3 if settings.UPLOAD_COMPRESSION is set, recording UploadFileJob.compression and
+    compressed_size (the caller saves them).
+
+    After request.FILES has been accessed, callers check:
+    - upload_file_job: the UploadFileJob, or None if no file was posted (or creating it failed)
+    - failure_message: non-None if the upload was aborted, e.g., b/c it exceeded max_size. any partial multipart upload
+      has been aborted
+
+    NB: Must be installed before anything reads request.POST or request.FILES, including CsrfViewMiddleware - see
+    views._upload_file().
+    """
+
+
+    def __init__(self, request=None, max_size=None, field_name='data_file'):
+        super().__init__(request)
+        self.max_size = max_size
+        self.upload_field_name = field_name  # NB: not self.field_name, which FileUploadHandler.new_file() overwrites
+        self.upload_file_job = None
+        self.failure_message = None
+        self._is_active = False  # True while receiving field_name's data
+        self._storage = None
+        self._upload_id = None
+        self._size = 0
+        self._stored_size = 0  # bytes sent to S3, i.e., after compression
+        self._sha256 = hashlib.sha256()
+        self._compressor = None
+        self._part_buffer = bytearray()
+        self._part_futures = []
+        self._executor = None
+        self._part_semaphore = None
+
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        if field_name != self.upload_field_name or self.upload_file_job:  # ignore other fields and all but the first
+            return
+
+        try:
+            compression = settings.UPLOAD_COMPRESSION
+            self._compressor = compressor(compression) if compression else None
+            self.upload_file_job = UploadFileJob.objects.create(filename=file_name,  # status = PENDING
+                                                                compression=compression)
+            self._storage = get_storage()
+            self._upload_id = self._storage.create_multipart_upload(self.upload_file_job.s3_key())
+        except Exception as exc:
+            self._abort("Error starting the S3 upload: {}".format(exc))
+            raise StopUpload(connection_reset=True)
+
+        self._executor = ThreadPoolExecutor(max_workers=S3_MULTIPART_MAX_CONCURRENCY)
+        self._part_semaphore = BoundedSemaphore(S3_MULTIPART_MAX_CONCURRENCY)
+        self._is_active = True
+        logger.debug("S3MultipartUploadHandler.new_file(): started. upload_file_job={}".format(self.upload_file_job))
+
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self._is_active:
+            return None  # NB: drops other files' data
+
+        self._size += len(raw_data)
+        if (self.max_size is not None) and (self._size > self.max_size):
+            self._abort("File was too large. size>{}, max={}.".format(self._size, self.max_size))
+            raise StopUpload(connection_reset=True)
+
+        self._sha256.update(raw_data)
+        self._part_buffer.extend(self._compressor.compress(raw_data) if self._compressor else raw_data)
+        while len(self._part_buffer) >= S3_MULTIPART_PART_SIZE:
+            self._submit_part(self._part_buffer[:S3_MULTIPART_PART_SIZE])
+            del self._part_buffer[:S3_MULTIPART_PART_SIZE]
+        return None
+
+
+    def file_complete(self, file_size):
+        if not self._is_active:
+            return None
+
+        self._is_active = False
+        try:
+            if self._compressor:
+                self._part_buffer.extend(self._compressor.flush())
+            if self._part_buffer or not self._part_futures:  # S3 requires at least one (possibly empty) part
+                self._submit_part(self._part_buffer)
+                self._part_buffer = bytearray()
+            parts = [part_future.result() for part_future in self._part_futures]
+            self._storage.complete_multipart_upload(self.upload_file_job.s3_key(), self._upload_id, parts)
+        except Exception as exc:
+            self._abort("Error uploading the file to S3: {}".format(exc))
+            return None
+        finally:
+            self._executor.shutdown(wait=False)
+
+        if self._compressor:
+            self.upload_file_job.compressed_size = self._stored_size
+        logger.debug("S3MultipartUploadHandler.file_complete(): done. size={}, stored_size={}, parts={}, "
+                     "upload_file_job={}".format(self._size, self._stored_size, len(parts), self.upload_file_job))
+        return S3UploadedFile(self.upload_file_job, self._sha256.hexdigest(), self.file_name, self.content_type,
+                              self._size, self.charset, self.content_type_extra)
+
+
+    def upload_complete(self):
+        if self._is_active:  # the request ended before file_complete(), e.g., the client disconnected
+            self._abort("The upload was incomplete.")
+
+
+    def _submit_part(self, data):
+        self._part_semaphore.acquire()  # released when the part finishes, so at most N parts are held in memory
+        part_number = len(self._part_futures) + 1
+        self._stored_size += len(data)
+        part_future = self._executor.submit(self._upload_part, part_number, bytes(data))
+        part_future.add_done_callback(lambda _: self._part_semaphore.release())
+        self._part_futures.append(part_future)
+
+
+    def _upload_part(self, part_number, data):
+        return self._storage.upload_part(self.upload_file_job.s3_key(), self._upload_id, part_number, data)
+
+
+    def _abort(self, failure_message):
+        self._is_active = False
+        self.failure_message = failure_message
+        logger.debug("S3MultipartUploadHandler._abort(): {}. upload_file_job={}"
+                     .format(failure_message, self.upload_file_job))
+        if self._executor:
+            self._executor.shutdown(wait=True)  # let in-flight parts finish so the abort cleans them up
+        if self._upload_id:
+            try:
+                self._storage.abort_multipart_upload(self.upload_file_job.s3_key(), self._upload_id)
+            except Exception as exc:
+                logger.error("S3MultipartUploadHandler._abort(): Error aborting the S3 upload: {}".format(exc))
+            self._upload_id = None
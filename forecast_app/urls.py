@@ -10,9 +10,19 @@ urlpatterns = [
     url(r'^empty_rq/$', views.empty_rq, name='empty-rq'),
 
     url(r'^upload_file/$', views.upload_file, name='upload-file'),
+    url(r'^upload_files/$', views.upload_files, name='upload-files'),
+    url(r'^upload_file_presigned/$', views.upload_file_presigned, name='upload-file-presigned'),
+    url(r'^upload_file_complete/(?P<upload_file_job_pk>\d+)/$', views.upload_file_complete,
+        name='upload-file-complete'),
     url(r'^delete_file_jobs/$', views.delete_file_jobs, name='delete-file-jobs'),
+    url(r'^jobs/(?P<upload_file_job_pk>\d+)/status/$', views.upload_file_job_status, name='upload-file-job-status'),
+    url(r'^jobs/status/$', views.upload_file_job_statuses, name='upload-file-job-statuses'),
+    url(r'^jobs/(?P<upload_file_job_pk>\d+)/events/$', views.upload_file_job_events, name='upload-file-job-events'),
 
     url(r'^s3_bucket/$', views.list_s3_bucket_info, name='s3-bucket'),
     url(r'^empty_s3_bucket/$', views.empty_s3_bucket, name='empty-s3-bucket'),
 
+    url(r'^metrics/$', views.metrics, name='metrics'),
+    url(r'^rq_telemetry/$', views.rq_telemetry_json, name='rq-telemetry'),
+
 ]
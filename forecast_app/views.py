@@ -1,42 +1,119 @@
+import datetime
+import hashlib
+import json
 import logging
 import time
-from io import SEEK_END
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
 
-import boto3
 import django_rq
+from django.conf import settings
 from django.contrib import messages
-from django.shortcuts import render, redirect
-
+from django.db import connection
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, render, redirect
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.decorators.http import require_GET, require_POST
+
+from forecast_app.caching import cached_count_and_last_update, cached_upload_file_jobs_summary, \
+    invalidate_upload_file_jobs_cache
+from forecast_app.chunked import process_upload_file_job_chunked
+from forecast_app.compression import CompressingReader
+from forecast_app.job_status import cache_job_statuses, cached_job_status_jsons, job_status_record
+from forecast_app.metrics import PROMETHEUS_CONTENT_TYPE, prometheus_text
 from forecast_app.models import Counter, UploadFileJob
-from forecast_app.models.upload_file_job import S3_UPLOAD_BUCKET_NAME, upload_file_job_s3_file
+from forecast_app.models.upload_file_job import S3_FILE_MODE_STREAM, complete_from_result_cache, \
+    complete_many_from_result_cache, delete_upload_file_jobs, store_content_addressed, upload_file_job_s3_file, \
+    upload_file_jobs_page
+from forecast_app.prefetch import no_prefetch
+from forecast_app.progress import job_event_stream
+from forecast_app.rq_telemetry import rq_telemetry, rq_telemetry_prometheus_text
+from forecast_app.rq_utils import RQ_QUEUE_MAINTENANCE, enqueue_many, queue_summary, \
+    upload_file_job_queue_name_and_timeout
+from forecast_app.storage import delete_storage_objects, empty_storage, get_storage
+from forecast_app.upload_handlers import S3MultipartUploadHandler
 
 
 logger = logging.getLogger(__name__)
 
 
 def index(request):
-    count, last_update = Counter.get_count_and_last_update()
-    queue = django_rq.get_queue()  # name='default'
+    count, last_update = cached_count_and_last_update(Counter.get_count_and_last_update)
+    cursor = request.GET.get('cursor')
+    if cursor:  # only the first page is cached
+        try:
+            upload_file_jobs_summary = _upload_file_jobs_summary(cursor)
+        except ValueError as exc:
+            save_message_and_log_debug(request, "index(): {}".format(exc), is_failure=True)
+            return redirect('index')
+    else:
+        upload_file_jobs_summary = cached_upload_file_jobs_summary(_upload_file_jobs_summary)
     conn = django_rq.get_connection()  # name='default'
     # todo xx maybe show if queue is busy?
     return render(request,
                   'index.html',
                   context={'count': count,
-                           'updated_at': last_update,
-                           'queue': queue,
+                           'last_update': last_update,
+                           'queue_summaries': [queue_summary(django_rq.get_queue(queue_name),
+                                                             settings.INDEX_QUEUE_SUMMARY_NUM_JOBS)
+                                               for queue_name in sorted(settings.RQ_QUEUES)],
                            'conn': conn,
-                           'upload_file_jobs': UploadFileJob.objects.all().order_by('-updated_at'),
+                           'cursor': cursor,
+                           'num_upload_file_jobs': upload_file_jobs_summary['num_upload_file_jobs'],
+                           'upload_file_jobs_html': upload_file_jobs_summary['upload_file_jobs_html'],
                            }
                   )
 
 
+def _upload_file_jobs_summary(cursor=None):
+    """
+    :param cursor: passed to upload_file_jobs_page()
+    :return: a dict that's cached by cached_upload_file_jobs_summary() for index() (first page only)
+    :raises ValueError: if cursor is malformed
+    """
+    upload_file_jobs, next_cursor = upload_file_jobs_page(cursor, settings.UPLOAD_FILE_JOBS_PAGE_SIZE)
+    return {'num_upload_file_jobs': UploadFileJob.approximate_count(),
+            'upload_file_jobs_html': render_to_string('upload_file_jobs_snippet.html',
+                                                      context={'upload_file_jobs': upload_file_jobs,
+                                                               'next_cursor': next_cursor})}
+
+
+S3_BUCKET_PAGE_SIZE = 100  # list_s3_bucket_info()'s default page_size
+S3_BUCKET_MAX_PAGE_SIZE = 1000  # S3's max keys per ListObjectsV2 request
+
+
 def list_s3_bucket_info(request):
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(S3_UPLOAD_BUCKET_NAME)
-    s3_objects = []
-    for s3_object in bucket.objects.all():
-        s3_objects.append(s3_object)
-    return render(request, 's3.html', context={'s3_objects': s3_objects})
+    """
+    Lists one page of objects in storage, optionally filtered by key prefix. GET params:
+    - prefix: only list keys starting with this
+    - page_size: objects per page (max S3_BUCKET_MAX_PAGE_SIZE)
+    - token: continuation token for the page after the first
+    - num_objects, num_bytes: totals for the preceding pages. they're carried in the next page link so that the totals
+      are accumulated a page at a time rather than by listing the whole bucket
+    """
+    try:
+        prefix = request.GET.get('prefix', '')
+        page_size = min(int(request.GET.get('page_size', S3_BUCKET_PAGE_SIZE)), S3_BUCKET_MAX_PAGE_SIZE)
+        prev_num_objects = int(request.GET.get('num_objects', 0))
+        prev_num_bytes = int(request.GET.get('num_bytes', 0))
+    except ValueError as exc:
+        save_message_and_log_debug(request, "list_s3_bucket_info(): Invalid parameter: {}".format(exc), is_failure=True)
+        return redirect('s3-bucket')
+
+    s3_objects, next_token = get_storage().list_page(prefix, max(page_size, 1), request.GET.get('token'))
+    num_objects = prev_num_objects + len(s3_objects)
+    num_bytes = prev_num_bytes + sum(s3_object.size for s3_object in s3_objects)
+    next_page_query = urlencode({'prefix': prefix, 'page_size': page_size, 'token': next_token,
+                                 'num_objects': num_objects, 'num_bytes': num_bytes}) if next_token else None
+    return render(request, 's3.html', context={'s3_objects': s3_objects,
+                                               'prefix': prefix,
+                                               'page_size': page_size,
+                                               'num_objects': num_objects,
+                                               'num_bytes': num_bytes,
+                                               'next_page_query': next_page_query})
 
 
 #
@@ -44,14 +121,126 @@ def list_s3_bucket_info(request):
 #
 
 def empty_s3_bucket(request):
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(S3_UPLOAD_BUCKET_NAME)
-    for s3_object in bucket.objects.all():
-        s3_object.delete()
-    save_message_and_log_debug(request, "empty_s3_bucket(): All objects deleted.")
+    rq_job = django_rq.get_queue(RQ_QUEUE_MAINTENANCE).enqueue(empty_storage)
+    save_message_and_log_debug(request, "empty_s3_bucket(): Enqueued deleting all objects: {}".format(rq_job))
     return redirect('s3-bucket')
 
 
+#
+# metrics
+#
+
+def metrics(request):
+    """
+    Upload pipeline metrics (see forecast_app.metrics) and RQ telemetry (see forecast_app.rq_telemetry) in the
+    Prometheus text exposition format.
+    """
+    return HttpResponse(prometheus_text() + rq_telemetry_prometheus_text(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+
+def rq_telemetry_json(request):
+    """
+    RQ telemetry (see forecast_app.rq_telemetry.rq_telemetry()) as JSON.
+    """
+    return JsonResponse(rq_telemetry())
+
+
+#
+# job status polling. responses are built from the status records cached in Redis (see forecast_app.job_status) and
+# carry an ETag, so a client that sends If-None-Match gets a bodiless 304 until the job changes
+#
+
+MAX_JOB_STATUS_IDS = 100  # max ids per upload_file_job_statuses() request
+
+
+@require_GET
+def upload_file_job_status(request, upload_file_job_pk):
+    """
+    :return: JSON: the UploadFileJob's status record, or 404 if it doesn't exist
+    """
+    upload_file_job_pk = int(upload_file_job_pk)
+    status_json = _job_status_json(upload_file_job_pk)
+    if status_json is None:
+        return JsonResponse({'error': "UploadFileJob not found. upload_file_job_pk={}".format(upload_file_job_pk)},
+                            status=404)
+
+    return _etag_json_response(request, status_json)
+
+
+@require_GET
+def upload_file_job_statuses(request):
+    """
+    Takes a comma-separated 'ids' query parameter of up to MAX_JOB_STATUS_IDS UploadFileJob pks.
+
+    :return: JSON: {"jobs": {"<pk>": <status record or null if not found>, ...}}
+    """
+    try:
+        upload_file_job_pks = [int(pk) for pk in request.GET.get('ids', '').split(',') if pk.strip()]
+    except ValueError:
+        return JsonResponse({'error': "ids must be comma-separated integers"}, status=400)
+
+    if not upload_file_job_pks or (len(upload_file_job_pks) > MAX_JOB_STATUS_IDS):
+        return JsonResponse({'error': "pass between 1 and {} ids".format(MAX_JOB_STATUS_IDS)}, status=400)
+
+    pk_to_status_json = _job_status_jsons(upload_file_job_pks)
+    jobs_json = ', '.join('"{}": {}'.format(pk, status_json or 'null') for pk, status_json in pk_to_status_json.items())
+    return _etag_json_response(request, '{"jobs": {' + jobs_json + '}}')
+
+
+@require_GET
+def upload_file_job_events(request, upload_file_job_pk):
+    """
+    A server-sent events stream of the UploadFileJob's 'status' and 'progress' events - see forecast_app.progress. For
+    browsers: new EventSource('/jobs/<pk>/events/').
+
+    NB: Each open stream holds a web worker for up to settings.PROGRESS_SSE_MAX_DURATION seconds, so with gunicorn's
+    default sync workers, watchers are limited by the number of workers. An async worker class (e.g., gevent) avoids
+    that
+    """
+    upload_file_job_pk = int(upload_file_job_pk)
+    if _job_status_json(upload_file_job_pk) is None:
+        return JsonResponse({'error': "UploadFileJob not found. upload_file_job_pk={}".format(upload_file_job_pk)},
+                            status=404)
+
+    # NB: the stream re-reads the status record itself, after subscribing to the job's events
+    response = StreamingHttpResponse(job_event_stream(upload_file_job_pk, _job_status_json),
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # don't let proxies buffer the stream
+    return response
+
+
+def _job_status_json(upload_file_job_pk):
+    """
+    :return: the status record of one UploadFileJob as a JSON string, or None if there's no such UploadFileJob. see
+        _job_status_jsons()
+    """
+    return _job_status_jsons([upload_file_job_pk])[upload_file_job_pk]
+
+
+def _job_status_jsons(upload_file_job_pks):
+    """
+    :return: a dict that maps each of upload_file_job_pks to its status record as a JSON string, or None if there's no
+        such UploadFileJob. records are read from Redis. NB: missing ones (e.g., expired) are read from the database
+        with one query and re-cached
+    """
+    pk_to_status_json = cached_job_status_jsons(upload_file_job_pks)
+    missing_pks = [pk for pk, status_json in pk_to_status_json.items() if status_json is None]
+    if missing_pks:
+        upload_file_jobs = list(UploadFileJob.objects.filter(pk__in=missing_pks).defer('input_json'))
+        cache_job_statuses(upload_file_jobs)
+        for upload_file_job in upload_file_jobs:
+            pk_to_status_json[upload_file_job.pk] = json.dumps(job_status_record(upload_file_job))
+    return pk_to_status_json
+
+
+def _etag_json_response(request, body):
+    response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = '"{}"'.format(hashlib.md5(body.encode('utf-8')).hexdigest())
+    response['Cache-Control'] = 'no-cache'  # i.e., clients must revalidate, which is what the ETag makes cheap
+    return get_conditional_response(request, etag=response['ETag'], response=response)
+
+
 #
 # utilities
 #
@@ -71,8 +260,11 @@ def save_message_and_log_debug(request, message, is_failure=False):
 
 def increment_counter(request, **kwargs):
     if kwargs['is_rq']:
-        django_rq.enqueue(Counter.increment_count)  # name="default"
-        save_message_and_log_debug(request, "increment_counter(): Incremented the count - enqueued.")
+        rq_job = Counter.enqueue_increment_count()
+        if rq_job:
+            save_message_and_log_debug(request, "increment_counter(): Incremented the count - enqueued.")
+        else:
+            save_message_and_log_debug(request, "increment_counter(): Incremented the count - coalesced.")
     else:
         Counter.increment_count()
         save_message_and_log_debug(request, "increment_counter(): Incremented the count - immediate.")
@@ -84,9 +276,10 @@ def increment_counter(request, **kwargs):
 #
 
 def empty_rq(request):
-    queue = django_rq.get_queue()  # name='default'
-    queue.empty()
-    save_message_and_log_debug(request, "empty_rq(): Emptied the queue.")
+    for queue_name in settings.RQ_QUEUES:
+        django_rq.get_queue(queue_name).empty()
+    Counter.forget_coalesced_job()  # its job was just emptied
+    save_message_and_log_debug(request, "empty_rq(): Emptied the queues.")
     return redirect('index')
 
 
@@ -94,100 +287,445 @@ def empty_rq(request):
 # file upload-related functions
 #
 
-MAX_UPLOAD_FILE_SIZE = 5E+06
+MAX_UPLOAD_FILE_SIZE = 500E+06  # enforced by S3MultipartUploadHandler while streaming
 
 
 def delete_file_jobs(request):
     save_message_and_log_debug(request, "delete_file_jobs(): Deleting all UploadFileJobs")
-    UploadFileJob.objects.all().delete()  # pre_delete() signal deletes corresponding S3 object (the uploaded file)
-    save_message_and_log_debug(request, "delete_file_jobs(): Done")
+    s3_keys = delete_upload_file_jobs(UploadFileJob.objects.all())
+    # delete the corresponding S3 objects (the uploaded files) in bulk, outside this request
+    rq_job = django_rq.get_queue(RQ_QUEUE_MAINTENANCE).enqueue(delete_storage_objects, s3_keys)
+    save_message_and_log_debug(request, "delete_file_jobs(): Done. Enqueued deleting {} S3 object(s): {}"
+                               .format(len(s3_keys), rq_job))
     return redirect('index')
 
 
+@csrf_exempt  # NB: _upload_file() does the CSRF check
 def upload_file(request):  # no-op implementation for testing
     return _upload_file(request, input_json_for_request__noop, process_upload_file_job__noop)
 
 
 def _upload_file(request, input_json_for_request_fcn, process_upload_file_job_fcn):
     """
-    Accepts a file uploaded to this app by the user, saves it in an S3 bucket, then enqueues process_upload_file_job_fcn
-    to process the file by an RQ worker.
+    Accepts a file uploaded to this app by the user, streaming it into an S3 bucket as it arrives (see
+    S3MultipartUploadHandler), then enqueues process_upload_file_job_fcn to process the file by an RQ worker.
+
+    NB: Callers must be @csrf_exempt views. This is b/c the upload handler has to be installed before anything reads
+    the request body, and CsrfViewMiddleware would otherwise read it first. The CSRF check is done here instead, after
+    installing the handler.
     :param input_json_for_request_fcn: a function of one arg (request) that returns a dict used to initialize the new
         UploadFileJob's input_json
     :param process_upload_file_job_fcn: a function of one arg (upload_file_job_pk) that is passed to
         django_rq.enqueue(). NB: It MUST use this wrapper in order to work have access to the file that was uploaded to
         S3:
             with upload_file_job_s3_file() as s3_file_fp: ...
-        NB: If it needs to save upload_file_job.output_json, make sure to call save(), e.g.,
+        NB: If it needs to save upload_file_job.output_json, make sure to save just that field, e.g.,
             upload_file_job.output_json = {'forecast_pk': new_forecast.pk}
-            upload_file_job.save()
+            upload_file_job.save(update_fields=['output_json', 'updated_at'])
+        (status is managed by upload_file_job_s3_file() - see UploadFileJob.transition())
+    """
+    upload_handler = S3MultipartUploadHandler(request, MAX_UPLOAD_FILE_SIZE)
+    request.upload_handlers = [upload_handler]
+    response = csrf_protect(_upload_file_streamed)(request, upload_handler, input_json_for_request_fcn,
+                                                   process_upload_file_job_fcn)
+    if (response.status_code == 403) and upload_handler.upload_file_job:  # CSRF failure after the file was streamed
+        upload_handler.upload_file_job.delete()  # pre_delete() signal deletes the S3 object
+    return response
+
+
+def _upload_file_streamed(request, upload_handler, input_json_for_request_fcn, process_upload_file_job_fcn):
+    """
+    _upload_file() helper that runs after the CSRF check.
     """
-    if 'data_file' not in request.FILES:  # user submitted without specifying a file to upload
+    # NB: accessing request.FILES is what runs upload_handler (if nothing read the request body yet, e.g., if
+    # CsrfViewMiddleware didn't), so this must come before checking its state
+    data_file = request.FILES.get('data_file')  # S3UploadedFile
+    upload_file_job = upload_handler.upload_file_job  # set by the handler when the file started to arrive
+    if upload_handler.failure_message:
+        failure_message = "upload_file(): FAILED_S3_FILE_UPLOAD: {} upload_file_job={}" \
+            .format(upload_handler.failure_message, upload_file_job)
+        if upload_file_job:
+            upload_file_job.fail(failure_message)
+        save_message_and_log_debug(request, failure_message, is_failure=True)
+        return redirect('index')
+
+    if data_file is None:  # user submitted without specifying a file to upload
         save_message_and_log_debug(request, "upload_file(): No file selected to upload.", is_failure=True)
         return redirect('index')
 
-    data_file = request.FILES['data_file']  # UploadedFile (InMemoryUploadedFile or TemporaryUploadedFile)
     logger.debug("upload_file(): Got data_file: name={!r}, size={}, content_type={}"
                  .format(data_file.name, data_file.size, data_file.content_type))
-    if data_file.size > MAX_UPLOAD_FILE_SIZE:
-        save_message_and_log_debug(request, "upload_file(): File was too large. size={}, max={}."
-                                   .format(data_file.size, MAX_UPLOAD_FILE_SIZE),
-                                   is_failure=True)
-        return redirect('index')
 
-    # create the UploadFileJob
+    # save the request's inputs to the UploadFileJob (created by the handler), plus the compression details the handler
+    # set on it
     try:
-        upload_file_job = UploadFileJob.objects.create(filename=data_file.name)  # status = PENDING
         upload_file_job.input_json = input_json_for_request_fcn(request)
-        upload_file_job.save()
+        upload_file_job.save(update_fields=['input_json', 'compression', 'compressed_size', 'updated_at'])
         save_message_and_log_debug(request, "upload_forecast_file(): 1/3 Created the UploadFileJob: {}"
                                    .format(upload_file_job))
     except Exception as exc:
-        save_message_and_log_debug(request, "upload_forecast_file(): Error creating the UploadFileJob: {}".format(exc),
-                                   is_failure=True)
+        failure_message = "upload_forecast_file(): Error creating the UploadFileJob: {}".format(exc)
+        upload_file_job.fail(failure_message)
+        upload_file_job.delete_s3_object()  # NB: in current thread
+        save_message_and_log_debug(request, failure_message, is_failure=True)
         return redirect('index')
 
-    # upload the file to S3
+    # the file was uploaded to S3 by the handler. move it to its content-addressed key
     try:
-        s3 = boto3.resource('s3')
-        bucket = s3.Bucket(S3_UPLOAD_BUCKET_NAME)
-        # todo use chunks? for chunk in data_file.chunks(): print(chunk):
-        bucket.put_object(Key=upload_file_job.s3_key(), Body=data_file)
-        upload_file_job.status = UploadFileJob.S3_FILE_UPLOADED
-        upload_file_job.save()
-        save_message_and_log_debug(request, "upload_file(): 2/3 Uploaded the file to S3: {}, {}. upload_file_job={}"
-                                   .format(S3_UPLOAD_BUCKET_NAME, upload_file_job.s3_key(), upload_file_job))
+        store_content_addressed(upload_file_job, data_file.content_digest)
     except Exception as exc:
-        failure_message = "upload_file(): FAILED_S3_FILE_UPLOAD: Error uploading file to S3: {}. upload_file_job={}" \
-            .format(exc, upload_file_job)
-        upload_file_job.is_failed = True
-        upload_file_job.failure_message = failure_message
-        upload_file_job.save()
+        failure_message = "upload_file(): FAILED_S3_FILE_UPLOAD: Error storing the file by content: {}. " \
+                          "upload_file_job={}".format(exc, upload_file_job)
+        upload_file_job.fail(failure_message)
+        upload_file_job.delete_s3_object()  # NB: in current thread
         save_message_and_log_debug(request, failure_message, is_failure=True)
         return redirect('index')
 
+    if not upload_file_job.transition(UploadFileJob.PENDING, UploadFileJob.S3_FILE_UPLOADED, file_size=data_file.size):
+        save_message_and_log_debug(request, "upload_file(): UploadFileJob is no longer pending. upload_file_job={}"
+                                   .format(upload_file_job), is_failure=True)
+        return redirect('index')
+
+    save_message_and_log_debug(request, "upload_file(): 2/3 Uploaded the file to S3: {}, {}. upload_file_job={}"
+                               .format(get_storage(), upload_file_job.s3_key(), upload_file_job))
+
+    # skip processing if the same file was already processed with the same inputs
+    if complete_from_result_cache(upload_file_job):
+        save_message_and_log_debug(request, "upload_file(): 3/3 Completed from cached result. upload_file_job={}"
+                                   .format(upload_file_job))
+        return redirect('index')
+
     # enqueue a worker
+    rq_job, failure_message = _enqueue_upload_file_job(upload_file_job, process_upload_file_job_fcn, data_file.size)
+    if failure_message:
+        save_message_and_log_debug(request, failure_message, is_failure=True)
+        return redirect('index')
+
+    save_message_and_log_debug(request, "upload_file(): 3/3 Enqueued the job: {}. upload_file_job={}"
+                               .format(rq_job, upload_file_job))
+    logger.debug("upload_file(): Done")
+    return redirect('index')
+
+
+def _enqueue_upload_file_job(upload_file_job, process_upload_file_job_fcn, file_size):
+    """
+    Sets upload_file_job's status from S3_FILE_UPLOADED to QUEUED and then enqueues process_upload_file_job_fcn for it.
+    NB: QUEUED is set first so that it can't overwrite the status set by a worker that's quick to run the job. The queue
+    and timeout depend on file_size - see upload_file_job_queue_name_and_timeout(). On failure, marks upload_file_job as
+    failed and deletes its S3 object.
+
+    :return: a 2-tuple: (rq_job, failure_message). exactly one is None
+    """
+    if not upload_file_job.transition(UploadFileJob.S3_FILE_UPLOADED, UploadFileJob.QUEUED):
+        return None, "upload_file(): FAILED_ENQUEUE: UploadFileJob is not awaiting enqueuing. upload_file_job={}" \
+            .format(upload_file_job)
+
     try:
-        rq_job = django_rq.enqueue(process_upload_file_job_fcn, upload_file_job.pk,
-                                   job_id=upload_file_job.rq_job_id())  # name="default"
-        upload_file_job.status = UploadFileJob.QUEUED
-        upload_file_job.save()
-        save_message_and_log_debug(request, "upload_file(): 3/3 Enqueued the job: {}. upload_file_job={}"
-                                   .format(rq_job, upload_file_job))
+        queue_name, timeout = upload_file_job_queue_name_and_timeout(file_size)
+        rq_job = django_rq.get_queue(queue_name).enqueue(process_upload_file_job_fcn, upload_file_job.pk,
+                                                         job_id=upload_file_job.rq_job_id(), timeout=timeout)
+        return rq_job, None
     except Exception as exc:
         failure_message = "upload_file(): FAILED_ENQUEUE: Error enqueuing the job: {}. upload_file_job={}" \
             .format(exc, upload_file_job)
-        upload_file_job.is_failed = True
-        upload_file_job.failure_message = failure_message
-        upload_file_job.save()
+        upload_file_job.fail(failure_message)
         upload_file_job.delete_s3_object()  # NB: in current thread
+        return None, failure_message
+
+
+#
+# batch upload-related functions. a multi-file alternative to upload_file() that does a fixed number of DB and Redis
+# round trips per batch rather than several per file
+#
+
+MAX_BATCH_UPLOAD_FILES = 100
+
+BATCH_UPLOAD_MAX_CONCURRENCY = 8  # max files uploading to storage at once. keep <= settings.S3_MAX_POOL_CONNECTIONS
+
+
+def upload_files(request):  # no-op implementation for testing
+    return _upload_files(request, input_json_for_request__noop, process_upload_file_job__noop)
+
+
+def _upload_files(request, input_json_for_request_fcn, process_upload_file_job_fcn):
+    """
+    Like _upload_file(), but accepts up to MAX_BATCH_UPLOAD_FILES files posted as 'data_files'. The UploadFileJobs are
+    created with one bulk_create(), the files are uploaded to storage concurrently, and the RQ jobs are enqueued in one
+    Redis pipeline. Status changes are single UPDATEs across the batch. NB: Files are buffered by Django's default
+    upload handlers, i.e., not streamed as by _upload_file().
+
+    :param input_json_for_request_fcn: as passed to _upload_file(). called once, and its result is shared by all files
+    :param process_upload_file_job_fcn: as passed to _upload_file()
+    """
+    data_files = request.FILES.getlist('data_files')
+    if not data_files:
+        save_message_and_log_debug(request, "upload_files(): No files selected to upload.", is_failure=True)
+        return redirect('index')
+    elif len(data_files) > MAX_BATCH_UPLOAD_FILES:
+        save_message_and_log_debug(request, "upload_files(): Too many files. num={}, max={}."
+                                   .format(len(data_files), MAX_BATCH_UPLOAD_FILES), is_failure=True)
+        return redirect('index')
+
+    too_large_files = [data_file.name for data_file in data_files if data_file.size > MAX_UPLOAD_FILE_SIZE]
+    if too_large_files:
+        save_message_and_log_debug(request, "upload_files(): File(s) were too large: {}. max={}."
+                                   .format(too_large_files, MAX_UPLOAD_FILE_SIZE), is_failure=True)
+        return redirect('index')
+
+    # create the UploadFileJobs. NB: their content digests are computed first so that their s3_key()s are
+    # content-addressed
+    try:
+        input_json = input_json_for_request_fcn(request)
+        upload_file_jobs = [UploadFileJob(filename=data_file.name, input_json=input_json, file_size=data_file.size,
+                                          content_digest=_content_digest(data_file),
+                                          compression=settings.UPLOAD_COMPRESSION)
+                            for data_file in data_files]
+        if connection.features.can_return_ids_from_bulk_insert:
+            upload_file_jobs = UploadFileJob.objects.bulk_create(upload_file_jobs)  # sets pks
+        else:  # e.g., SQLite, where bulk_create() can't set pks
+            for upload_file_job in upload_file_jobs:
+                upload_file_job.save()
+        invalidate_upload_file_jobs_cache()  # NB: bulk_create() doesn't send post_save
+        save_message_and_log_debug(request, "upload_files(): 1/3 Created {} UploadFileJobs".format(len(data_files)))
+    except Exception as exc:
+        save_message_and_log_debug(request, "upload_files(): Error creating the UploadFileJobs: {}".format(exc),
+                                   is_failure=True)
+        return redirect('index')
+
+    # upload the files to storage. identical files (in this batch or already stored) are uploaded at most once
+    storage = get_storage()
+    key_to_data_file = {}
+    for upload_file_job, data_file in zip(upload_file_jobs, data_files):
+        key_to_data_file.setdefault(upload_file_job.s3_key(), data_file)
+
+    def upload_data_file(key_and_data_file):  # returns a 2-tuple: (compressed_size or None, error message or None)
+        key, data_file = key_and_data_file
+        try:
+            if storage.exists(key):
+                return (storage.size(key) if settings.UPLOAD_COMPRESSION else None), None
+
+            if settings.UPLOAD_COMPRESSION:
+                compressing_reader = CompressingReader(data_file, settings.UPLOAD_COMPRESSION)
+                storage.put_fileobj(key, compressing_reader)
+                return compressing_reader.compressed_size, None
+
+            storage.put_fileobj(key, data_file)
+            return None, None
+        except Exception as exc:
+            return None, "Error uploading file to S3: {}".format(exc)
+
+    with ThreadPoolExecutor(max_workers=BATCH_UPLOAD_MAX_CONCURRENCY) as executor:
+        key_to_size_and_error = dict(zip(key_to_data_file.keys(),
+                                         executor.map(upload_data_file, key_to_data_file.items())))
+    key_to_error = {key: error for key, (_, error) in key_to_size_and_error.items()}
+    uploaded_jobs = []
+    for upload_file_job in upload_file_jobs:
+        if key_to_error[upload_file_job.s3_key()]:
+            failure_message = "upload_files(): FAILED_S3_FILE_UPLOAD: {}. upload_file_job={}" \
+                .format(key_to_error[upload_file_job.s3_key()], upload_file_job)
+            UploadFileJob.fail_many([upload_file_job], failure_message)
+            save_message_and_log_debug(request, failure_message, is_failure=True)
+        else:
+            uploaded_jobs.append(upload_file_job)
+    if not uploaded_jobs:
+        return redirect('index')
+
+    if settings.UPLOAD_COMPRESSION:  # one UPDATE per distinct stored file
+        for key, (compressed_size, error) in key_to_size_and_error.items():
+            if not error:
+                UploadFileJob.objects.filter(pk__in=[upload_file_job.pk for upload_file_job in uploaded_jobs
+                                                     if upload_file_job.s3_key() == key]) \
+                    .update(compressed_size=compressed_size)
+    uploaded_jobs = UploadFileJob.transition_many(uploaded_jobs, UploadFileJob.PENDING, UploadFileJob.S3_FILE_UPLOADED)
+    if not uploaded_jobs:  # e.g., they were failed meanwhile
+        save_message_and_log_debug(request, "upload_files(): No UploadFileJobs were still pending", is_failure=True)
+        return redirect('index')
+
+    save_message_and_log_debug(request, "upload_files(): 2/3 Uploaded {} file(s) to S3: {}"
+                               .format(len(key_to_data_file), storage))
+
+    # skip processing files that were already processed with the same inputs
+    completed_job_pks = {upload_file_job.pk for upload_file_job in complete_many_from_result_cache(uploaded_jobs)}
+    uploaded_jobs = [upload_file_job for upload_file_job in uploaded_jobs
+                     if upload_file_job.pk not in completed_job_pks]
+    if not uploaded_jobs:
+        save_message_and_log_debug(request, "upload_files(): 3/3 Completed all jobs from cached results")
+        return redirect('index')
+
+    # enqueue the workers. NB: QUEUED is set first, as in _enqueue_upload_file_job()
+    uploaded_jobs = UploadFileJob.transition_many(uploaded_jobs, UploadFileJob.S3_FILE_UPLOADED, UploadFileJob.QUEUED)
+    try:
+        queue_name_to_enqueue_items = {}  # one pipeline per queue
+        uploaded_job_pks = {upload_file_job.pk for upload_file_job in uploaded_jobs}
+        for upload_file_job, data_file in zip(upload_file_jobs, data_files):
+            if upload_file_job.pk in uploaded_job_pks:
+                queue_name, timeout = upload_file_job_queue_name_and_timeout(data_file.size)
+                queue_name_to_enqueue_items.setdefault(queue_name, []) \
+                    .append(((upload_file_job.pk,), upload_file_job.rq_job_id(), timeout))
+        for queue_name, enqueue_items in queue_name_to_enqueue_items.items():
+            enqueue_many(django_rq.get_queue(queue_name), process_upload_file_job_fcn, enqueue_items)
+    except Exception as exc:
+        failure_message = "upload_files(): FAILED_ENQUEUE: Error enqueuing the jobs: {}".format(exc)
+        UploadFileJob.fail_many(uploaded_jobs, failure_message)
+        for upload_file_job in uploaded_jobs:
+            upload_file_job.delete_s3_object()  # NB: leaves objects that other in-progress jobs share
         save_message_and_log_debug(request, failure_message, is_failure=True)
         return redirect('index')
 
-    logger.debug("upload_file(): Done")
+    save_message_and_log_debug(request, "upload_files(): 3/3 Enqueued {} job(s)".format(len(uploaded_jobs)))
     return redirect('index')
 
 
+def _content_digest(data_file):
+    """
+    :return: the hex SHA-256 of data_file's contents, read a chunk at a time. leaves data_file at its start
+    """
+    sha256 = hashlib.sha256()
+    for chunk in data_file.chunks():
+        sha256.update(chunk)
+    data_file.seek(0)
+    return sha256.hexdigest()
+
+
+#
+# direct-to-S3 (presigned) upload-related functions. a two-phase alternative to upload_file() in which the client
+# uploads the file directly to S3 rather than through this app:
+# 1) POST filename to upload-file-presigned -> creates the UploadFileJob and returns a presigned POST for its s3_key()
+# 2) the client POSTs the file to S3 using the returned 'url' and 'fields'
+# 3) POST to upload-file-complete -> checks the S3 object, sets status to S3_FILE_UPLOADED, and enqueues the job
+# UploadFileJobs whose client never does 3) are failed by reap_expired_presigned_jobs()
+#
+
+PRESIGNED_UPLOAD_EXPIRES_IN = 3600  # seconds
+
+# UploadFileJobs that are awaiting phase 3 are failed by reap_expired_presigned_jobs() this long after being created.
+# NB: longer than PRESIGNED_UPLOAD_EXPIRES_IN b/c an upload that S3 accepted just before its POST expired may still be
+# in progress
+PRESIGNED_UPLOAD_REAP_AFTER = 2 * PRESIGNED_UPLOAD_EXPIRES_IN  # seconds
+
+PRESIGNED_JOBS_KEY = 'forecast_app:presigned:jobs'  # set of the pks of UploadFileJobs awaiting phase 3
+
+
+@require_POST
+def upload_file_presigned(request):  # no-op implementation for testing
+    return _upload_file_presigned(request, input_json_for_request__noop)
+
+
+@require_POST
+def upload_file_complete(request, upload_file_job_pk):  # no-op implementation for testing
+    return _upload_file_complete(request, upload_file_job_pk, process_upload_file_job__noop_chunked)
+
+
+def _upload_file_presigned(request, input_json_for_request_fcn):
+    """
+    Phase 1 of a direct-to-S3 upload: creates an UploadFileJob for the POSTed 'filename' and returns JSON with its
+    'upload_file_job_pk' and a presigned POST ('url' and 'fields') that allows uploading up to MAX_UPLOAD_FILE_SIZE
+    bytes to its s3_key() for PRESIGNED_UPLOAD_EXPIRES_IN seconds.
+
+    :param input_json_for_request_fcn: as passed to _upload_file()
+    """
+    filename = request.POST.get('filename')
+    if not filename:
+        return JsonResponse({'error': "No filename specified."}, status=400)
+
+    try:
+        upload_file_job = UploadFileJob.objects.create(filename=filename,  # status = PENDING
+                                                       input_json=input_json_for_request_fcn(request))
+        django_rq.get_connection().sadd(PRESIGNED_JOBS_KEY, upload_file_job.pk)  # NB: before anything else can fail
+        presigned_post = get_storage().generate_presigned_post(upload_file_job.s3_key(), MAX_UPLOAD_FILE_SIZE,
+                                                               PRESIGNED_UPLOAD_EXPIRES_IN)
+    except Exception as exc:
+        logger.error("upload_file_presigned(): Error creating the UploadFileJob: {}".format(exc))
+        return JsonResponse({'error': "Error creating the UploadFileJob: {}".format(exc)}, status=500)
+
+    logger.debug("upload_file_presigned(): Created the UploadFileJob: {}".format(upload_file_job))
+    return JsonResponse({'upload_file_job_pk': upload_file_job.pk,
+                         'url': presigned_post['url'],
+                         'fields': presigned_post['fields']})
+
+
+def _upload_file_complete(request, upload_file_job_pk, process_upload_file_job_fcn):
+    """
+    Phase 3 of a direct-to-S3 upload: checks that the client's file is in S3, then enqueues
+    process_upload_file_job_fcn as _upload_file() does. Returns JSON with 'upload_file_job_pk' and 'status', or 'error'.
+
+    :param process_upload_file_job_fcn: as passed to _upload_file()
+    """
+    upload_file_job = get_object_or_404(UploadFileJob, pk=upload_file_job_pk)
+    if (upload_file_job.status != UploadFileJob.PENDING) or upload_file_job.is_failed:
+        return JsonResponse({'error': "UploadFileJob is not awaiting its upload. upload_file_job={}"
+                            .format(upload_file_job)}, status=409)
+
+    try:
+        s3_object_size = get_storage().size(upload_file_job.s3_key())
+    except Exception as exc:
+        return JsonResponse({'error': "File not found in S3: {}. upload_file_job={}".format(exc, upload_file_job)},
+                            status=400)
+
+    if s3_object_size > MAX_UPLOAD_FILE_SIZE:  # NB: S3 enforces the policy's limit, so this is just a backstop
+        failure_message = "upload_file_complete(): FAILED_S3_FILE_UPLOAD: File was too large. size={}, max={}. " \
+                          "upload_file_job={}".format(s3_object_size, MAX_UPLOAD_FILE_SIZE, upload_file_job)
+        upload_file_job.fail(failure_message)
+        upload_file_job.delete_s3_object()  # NB: in current thread
+        return JsonResponse({'error': failure_message}, status=400)
+
+    if not upload_file_job.transition(UploadFileJob.PENDING, UploadFileJob.S3_FILE_UPLOADED,  # fails on a repeated POST
+                                      file_size=s3_object_size):
+        return JsonResponse({'error': "UploadFileJob is not awaiting its upload. upload_file_job={}"
+                            .format(upload_file_job)}, status=409)
+
+    try:
+        django_rq.get_connection().srem(PRESIGNED_JOBS_KEY, upload_file_job.pk)
+    except Exception as exc:  # reap_expired_presigned_jobs() will remove it instead
+        logger.error("upload_file_complete(): Error removing the UploadFileJob from PRESIGNED_JOBS_KEY: {}. "
+                     "upload_file_job={}".format(exc, upload_file_job))
+
+    rq_job, failure_message = _enqueue_upload_file_job(upload_file_job, process_upload_file_job_fcn, s3_object_size)
+    if failure_message:
+        return JsonResponse({'error': failure_message}, status=500)
+
+    logger.debug("upload_file_complete(): Enqueued the job: {}. upload_file_job={}".format(rq_job, upload_file_job))
+    return JsonResponse({'upload_file_job_pk': upload_file_job.pk, 'status': upload_file_job.status_as_str()})
+
+
+def reap_expired_presigned_jobs():
+    """
+    Fails the direct-to-S3 UploadFileJobs that are still PENDING PRESIGNED_UPLOAD_REAP_AFTER seconds after being
+    created, i.e., whose client never called upload-file-complete, and deletes any objects their clients uploaded.
+    Without this they'd stay PENDING forever. Intended to be run on a schedule - see the reap_presigned_jobs management
+    command. NB: a client that completes its upload while this runs can have its job failed after it was enqueued.
+    that's unlikely given PRESIGNED_UPLOAD_REAP_AFTER, and the job then fails to claim it (see
+    upload_file_job_s3_file()).
+
+    :return: the number of UploadFileJobs failed
+    """
+    conn = django_rq.get_connection()
+    upload_file_job_pks = [int(upload_file_job_pk) for upload_file_job_pk in conn.smembers(PRESIGNED_JOBS_KEY)]
+    if not upload_file_job_pks:
+        return 0
+
+    created_before = timezone.now() - datetime.timedelta(seconds=PRESIGNED_UPLOAD_REAP_AFTER)
+    pending_jobs = UploadFileJob.objects.filter(pk__in=upload_file_job_pks, status=UploadFileJob.PENDING,
+                                                is_failed=False)
+    expired_jobs = list(pending_jobs.filter(created_at__lt=created_before))
+    if expired_jobs:
+        UploadFileJob.fail_many(expired_jobs, "reap_expired_presigned_jobs(): FAILED_S3_FILE_UPLOAD: Upload not "
+                                              "completed within {} seconds".format(PRESIGNED_UPLOAD_REAP_AFTER))
+        for s3_key, error_message in get_storage().delete_many([upload_file_job.s3_key()
+                                                                for upload_file_job in expired_jobs]):
+            logger.error("reap_expired_presigned_jobs(): Error deleting: {}. s3_key={}".format(error_message, s3_key))
+
+    # NB: this also removes jobs that were deleted, or completed while the key couldn't be updated
+    awaiting_pks = set(pending_jobs.values_list('id', flat=True))  # NB: re-evaluated, so excludes expired_jobs
+    finished_pks = [upload_file_job_pk for upload_file_job_pk in upload_file_job_pks
+                    if upload_file_job_pk not in awaiting_pks]
+    if finished_pks:
+        conn.srem(PRESIGNED_JOBS_KEY, *finished_pks)
+    logger.debug("reap_expired_presigned_jobs(): Failed {} jobs. upload_file_jobs={}"
+                 .format(len(expired_jobs), expired_jobs))
+    return len(expired_jobs)
+
+
 #
 # no-op RQ enqueue() helper functions for testing
 #
@@ -199,18 +737,47 @@ def input_json_for_request__noop(request):
 
 def process_upload_file_job__noop(upload_file_job_pk):
     logger.debug("process_upload_file_job__noop(): Loading forecast. upload_file_job_pk={}".format(upload_file_job_pk))
-    with upload_file_job_s3_file(upload_file_job_pk) as (upload_file_job, s3_file_fp):
-        # show that we can access the file's data
-        file_size = s3_file_fp.seek(0, SEEK_END)
-        s3_file_fp.seek(0)
-        lines = s3_file_fp.readlines()
+    with upload_file_job_s3_file(upload_file_job_pk, mode=S3_FILE_MODE_STREAM, is_report_progress=True) \
+            as (upload_file_job, s3_file_fp, progress):
+        # show that we can access the file's data, one line at a time as it streams from S3
+        file_size, num_lines, first_line = 0, 0, None
+        for line in s3_file_fp:
+            if first_line is None:
+                first_line = line
+            file_size += len(line)
+            num_lines += 1
+            progress.update(num_bytes=file_size, num_lines=num_lines)  # rate-limited
+        progress.update(is_force=True, num_bytes=file_size, num_lines=num_lines)
         logger.debug("process_upload_file_job__noop(): upload_file_job={}.\n\t-> from s3_file_fp: {}, {}, {}"
-                     .format(upload_file_job, file_size, len(lines), repr(lines[0])))
+                     .format(upload_file_job, file_size, num_lines, repr(first_line)))
 
         # simulate a long-running operation
         time.sleep(5)
 
 
+@no_prefetch
+def process_upload_file_job__noop_chunked(upload_file_job_pk):
+    # like process_upload_file_job__noop(), but processes large files in parallel chunks. used for direct-to-S3 uploads,
+    # which are how large files arrive
+    process_upload_file_job_chunked(upload_file_job_pk, count_lines__noop, sum_line_counts__noop)
+
+
+def count_lines__noop(upload_file_job, s3_file_fp):
+    file_size, num_lines = 0, 0
+    for line in s3_file_fp:
+        file_size += len(line)
+        num_lines += 1
+    return {'file_size': file_size, 'num_lines': num_lines}
+
+
+def sum_line_counts__noop(upload_file_job, results):
+    output_json = {'file_size': sum(result['file_size'] for result in results),
+                   'num_lines': sum(result['num_lines'] for result in results),
+                   'num_chunks': len(results)}
+    logger.debug("sum_line_counts__noop(): upload_file_job={}. -> {}".format(upload_file_job, output_json))
+    return output_json
+
+
 #
 # app-specific RQ enqueue() helper functions: ForecastModel.load_forecast()
 #
@@ -0,0 +1,433 @@
+import logging
+import math
+import multiprocessing
+import os
+import signal
+import time
+import zlib
+
+import django_rq
+from django.conf import settings
+from django.db import close_old_connections, connection, connections
+from rq.job import Job, unpickle
+from rq.utils import utcnow
+from rq.worker import SimpleWorker
+
+from forecast_app.models import UploadFileJob
+from forecast_app.prefetch import Prefetcher, is_prefetchable
+from forecast_app.rq_telemetry import record_job_telemetry, take_sample
+from forecast_app.rq_utils import queue_length_and_wait_time
+from forecast_app.storage import get_storage
+
+
+logger = logging.getLogger(__name__)
+
+# the rq queue of upcoming jobs that a PrefetchingWorker has reserved for itself, and its heartbeat key. both are
+# format()ted with the worker's name. a reservation queue whose heartbeat has expired (e.g., b/c its worker was killed)
+# is returned to the shared queues by the other PrefetchingWorkers
+PREFETCH_RESERVED_QUEUE_NAME = 'forecast_app:prefetch:{}'
+PREFETCH_HEARTBEAT_KEY = 'forecast_app:prefetch_heartbeat:{}'
+PREFETCH_HEARTBEAT_TTL = 60  # seconds. also the interval between orphaned reservation sweeps
+
+# atomically moves a job id (ARGV[1]) from a shared queue (KEYS[1]) to the end of a reservation queue (KEYS[2]), if
+# it's still in the shared one. returns 1 if it was moved
+PREFETCH_RESERVE_SCRIPT = """
+if redis.call('lrem', KEYS[1], 1, ARGV[1]) == 1 then
+    redis.call('rpush', KEYS[2], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+MAX_CRASH_BACKOFF = 60  # seconds. WorkerPool waits 2, 4, 8, ... seconds before replacing consecutively crashed workers
+
+
+#
+# a pool of long-lived, non-forking RQ workers. the stock rqworker forks a work horse per job, which then has to open
+# its own DB connection, Redis connection, and S3 client - often costing more than short jobs themselves. here each
+# pool process runs jobs in-process and keeps those between jobs, and is recycled after max_jobs jobs to bound leaks
+#
+
+class PrewarmedWorker(SimpleWorker):
+    """
+    A SimpleWorker (jobs run in this process - no fork) that keeps its DB connection (subject to the database's
+    CONN_MAX_AGE), Redis connection, and storage client between jobs, and stops after max_jobs jobs so that its process
+    can be replaced. Job timeouts are still enforced, by SimpleWorker's SIGALRM-based death penalty.
+    """
+
+
+    def __init__(self, *args, max_jobs=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_jobs = max_jobs
+        self.num_jobs = 0
+
+
+    def prewarm(self):
+        """
+        Opens the connections that jobs will use, so that the first job doesn't pay for them.
+        """
+        connection.ensure_connection()
+        self.connection.ping()
+        storage = get_storage()
+        getattr(storage, 'client', None)  # S3Storage creates its client lazily
+        logger.debug("PrewarmedWorker.prewarm(): Done. pid={}".format(os.getpid()))
+
+
+    def execute_job(self, job, queue):
+        close_old_connections()  # drops the DB connection only if it's past CONN_MAX_AGE or broken
+        wait_time = (utcnow() - job.enqueued_at).total_seconds() if job.enqueued_at else 0
+        start_time = time.time()
+        try:
+            return super().execute_job(job, queue)
+        finally:
+            record_job_telemetry(queue.name, max(wait_time, 0), time.time() - start_time)
+            close_old_connections()
+            self.num_jobs += 1
+            if self.max_jobs and (self.num_jobs >= self.max_jobs):
+                logger.info("PrewarmedWorker.execute_job(): Recycling after {} jobs. pid={}"
+                            .format(self.num_jobs, os.getpid()))
+                self._stop_requested = True  # checked by work()'s loop before dequeuing the next job
+
+
+    def request_force_stop(self, signum, frame):
+        """
+        Overrides rq's cold shutdown on a second SIGTERM or SIGINT, which would abort the current job: on Heroku every
+        process in the dyno is sent SIGTERM, so a pool process gets one from the platform and then another from
+        WorkerPool._stop_processes(). Killing a worker that won't finish is left to the WorkerPool.
+        """
+        logger.debug("PrewarmedWorker.request_force_stop(): Already stopping. ignoring signal {}. pid={}"
+                     .format(signum, os.getpid()))
+
+
+class PrefetchingWorker(PrewarmedWorker):
+    """
+    A PrewarmedWorker that runs a forecast_app.prefetch.Prefetcher, which downloads the files of upcoming upload jobs
+    while the current job runs. Upload jobs are recognized by their ids, which are UploadFileJob pks (see
+    UploadFileJob.rq_job_id()). So that no other worker runs a job whose file I prefetched, I first reserve it: its id
+    is moved from the front of its queue to my own reservation queue (see PREFETCH_RESERVED_QUEUE_NAME), which I dequeue
+    from before my other queues. NB: this means that up to settings.PREFETCH_MAX_FILES reserved jobs run before any
+    higher-priority jobs that are enqueued after they were reserved. Reserved jobs are returned to the front of their
+    queues when I stop.
+    """
+
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shared_queues = list(self.queues)
+        self.reserved_queue = self.queue_class(PREFETCH_RESERVED_QUEUE_NAME.format(self.name),
+                                               connection=self.connection, job_class=self.job_class)
+        self.queues.insert(0, self.reserved_queue)
+        self.prefetcher = Prefetcher(self._upcoming_upload_jobs, settings.PREFETCH_MAX_FILES,
+                                     settings.PREFETCH_MAX_BYTES)
+        self._reserve_script = self.connection.register_script(PREFETCH_RESERVE_SCRIPT)
+        self._last_sweep_time = 0
+
+
+    def work(self, *args, **kwargs):
+        self.prefetcher.start()
+        try:
+            return super().work(*args, **kwargs)
+        finally:
+            self.prefetcher.stop()
+            release_reserved_jobs(self.connection, self.reserved_queue)
+            self.connection.delete(PREFETCH_HEARTBEAT_KEY.format(self.name))
+
+
+    def execute_job(self, job, queue):
+        if queue == self.reserved_queue:  # so that rq's job registries and our telemetry use the job's own queue
+            queue = self.queue_class(job.origin, connection=self.connection, job_class=self.job_class)
+        self.prefetcher.set_current_job_id(job.id)
+        try:
+            return super().execute_job(job, queue)
+        finally:
+            self.prefetcher.set_current_job_id(None)
+
+
+    def _upcoming_upload_jobs(self, max_jobs):
+        """
+        Prefetcher upcoming_jobs_fcn. Tops up my reservations to max_jobs, and returns orphaned reservations (see
+        PREFETCH_HEARTBEAT_TTL) to their queues.
+
+        :return: a list of (job_id, s3_key) 2-tuples for the first max_jobs upload jobs that I've reserved, in the order
+            I'll run them
+        """
+        self._heartbeat_and_sweep()
+        job_ids = [job_id.decode('utf-8') for job_id in self.connection.lrange(self.reserved_queue.key, 0, -1)]
+        if len(job_ids) < max_jobs:
+            job_ids.extend(self._reserve_upload_jobs(max_jobs - len(job_ids)))
+        if not job_ids:
+            return []
+
+        pk_to_upload_file_job = UploadFileJob.objects \
+            .filter(pk__in=[int(job_id) for job_id in job_ids], is_failed=False,
+                    status__in=[UploadFileJob.S3_FILE_UPLOADED, UploadFileJob.QUEUED]) \
+            .only('id', 'content_digest', 'compression') \
+            .in_bulk()
+        return [(job_id, pk_to_upload_file_job[int(job_id)].s3_key()) for job_id in job_ids
+                if int(job_id) in pk_to_upload_file_job][:max_jobs]
+
+
+    def _reserve_upload_jobs(self, max_jobs):
+        """
+        Moves up to max_jobs upload jobs from the front of my shared queues to my reservation queue. jobs that don't
+        read their whole file are skipped - see is_prefetchable().
+
+        :return: a list of the reserved job ids, in the order I'll run them
+        """
+        with self.connection.pipeline(transaction=False) as pipe:
+            for queue in self.shared_queues:  # NB: in priority order, like dequeuing
+                pipe.lrange(queue.key, 0, max_jobs - 1)
+            queues_and_job_ids = [(queue, job_id.decode('utf-8'))
+                                  for queue, queue_job_ids in zip(self.shared_queues, pipe.execute())
+                                  for job_id in queue_job_ids]
+        queues_and_job_ids = [(queue, job_id) for queue, job_id in queues_and_job_ids
+                              if job_id.isdigit()]  # other jobs' ids are uuids or chunk ids
+        if not queues_and_job_ids:
+            return []
+
+        with self.connection.pipeline(transaction=False) as pipe:
+            for _, job_id in queues_and_job_ids:
+                pipe.hget(Job.key_for(job_id), 'data')
+            queues_and_job_ids = [(queue, job_id) for (queue, job_id), data in zip(queues_and_job_ids, pipe.execute())
+                                  if data and _is_prefetchable_job_data(data)]
+
+        reserved_job_ids = []
+        for queue, job_id in queues_and_job_ids:
+            if len(reserved_job_ids) >= max_jobs:
+                break
+
+            if self._reserve_script(keys=[queue.key, self.reserved_queue.key], args=[job_id]):  # else dequeued
+                reserved_job_ids.append(job_id)
+        return reserved_job_ids
+
+
+    def _heartbeat_and_sweep(self):
+        """
+        Refreshes my heartbeat and, at most every PREFETCH_HEARTBEAT_TTL seconds, returns the jobs reserved by workers
+        whose heartbeats have expired to their queues.
+        """
+        self.connection.set(PREFETCH_HEARTBEAT_KEY.format(self.name), 1, ex=PREFETCH_HEARTBEAT_TTL)
+        now = time.time()
+        if now - self._last_sweep_time < PREFETCH_HEARTBEAT_TTL:
+            return
+
+        self._last_sweep_time = now
+        reserved_queue_key_prefix = self.queue_class.redis_queue_namespace_prefix + PREFETCH_RESERVED_QUEUE_NAME \
+            .format('')
+        for reserved_queue_key in self.connection.scan_iter(match=reserved_queue_key_prefix + '*'):
+            worker_name = reserved_queue_key.decode('utf-8')[len(reserved_queue_key_prefix):]
+            if not self.connection.exists(PREFETCH_HEARTBEAT_KEY.format(worker_name)):
+                logger.warning("PrefetchingWorker._heartbeat_and_sweep(): Releasing the jobs reserved by {}"
+                               .format(worker_name))
+                release_reserved_jobs(self.connection, self.queue_class.from_queue_key(
+                    reserved_queue_key.decode('utf-8'), connection=self.connection, job_class=self.job_class))
+
+
+def release_reserved_jobs(connection, reserved_queue):
+    """
+    Returns the jobs in a PrefetchingWorker's reservation queue to the front of their own queues, in order. Safe to
+    call while the worker is still dequeuing from it: each job is popped atomically, so it goes to exactly one place.
+    Jobs that no longer exist are dropped, as rq does when dequeuing them.
+
+    :return: the number of jobs returned
+    """
+    num_jobs = 0
+    while True:
+        job_id = connection.rpop(reserved_queue.key)  # NB: from the end so that LPUSHing keeps the order
+        if job_id is None:
+            return num_jobs
+
+        origin = connection.hget(Job.key_for(job_id.decode('utf-8')), 'origin')
+        if origin:
+            connection.lpush(reserved_queue.redis_queue_namespace_prefix + origin.decode('utf-8'), job_id)
+            num_jobs += 1
+
+
+def _is_prefetchable_job_data(data):
+    """
+    :param data: an RQ job hash's 'data' field: its pickled (func_name, instance, args, kwargs), zlib-compressed by
+        rq's Job.save()
+    """
+    try:
+        data = zlib.decompress(data)
+    except zlib.error:
+        pass  # uncompressed, as rq also allows
+    try:
+        func_name, _, _, kwargs = unpickle(data)
+    except Exception:
+        return False
+
+    return is_prefetchable(func_name, kwargs)
+
+
+def run_prewarmed_worker(queue_names, max_jobs, worker_class=PrewarmedWorker):
+    """
+    WorkerPool child process entry point: runs a worker_class on queue_names until it stops.
+    """
+    os.setpgrp()  # so that a terminal's Ctrl+C goes only to the WorkerPool, which forwards it
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)  # undo WorkerPool's handlers. the worker installs its own
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    connections.close_all()  # don't touch any DB connection inherited from the parent
+    queues = [django_rq.get_queue(queue_name) for queue_name in queue_names]
+    worker = worker_class(queues, connection=queues[0].connection, max_jobs=max_jobs)
+    worker.prewarm()
+    worker.work()
+
+
+class WorkerPool:
+    """
+    Runs between min_workers and max_workers processes, each running run_prewarmed_worker(), until SIGTERM or SIGINT,
+    at which point it asks them to finish their current jobs and waits up to stop_timeout seconds for them before
+    killing them (or kills them right away on a second signal). Processes that exit (recycled or crashed) are
+    replaced, with exponential backoff after crashes.
+
+    If max_workers > min_workers then the number of processes follows the queues: every settings.RQ_POOL_SCALE_INTERVAL
+    seconds it targets settings.RQ_POOL_JOBS_PER_WORKER queued jobs per process, adds one if the oldest queued job has
+    waited more than RQ_POOL_MAX_WAIT_TIME seconds, and retires one (warm shutdown) once the queues have been empty for
+    RQ_POOL_SCALE_DOWN_DELAY seconds.
+    """
+
+
+    def __init__(self, queue_names, min_workers, max_workers, max_jobs, worker_class=PrewarmedWorker, poll_interval=1,
+                 stop_timeout=25):
+        self.queue_names = queue_names
+        self.min_workers = min_workers
+        self.max_workers = max(min_workers, max_workers)
+        self.max_jobs = max_jobs
+        self.worker_class = worker_class
+        self.poll_interval = poll_interval
+        self.stop_timeout = stop_timeout  # NB: Heroku sends SIGKILL 30 seconds after SIGTERM
+        self.num_workers = min_workers  # target
+        self.processes = []  # running
+        self.retiring_processes = []  # sent SIGTERM by _retire_process(), finishing their current job
+        self._is_stop_requested = False
+        self._num_consecutive_crashes = 0
+        self._start_not_before = 0  # time.time() before which no process is started. set after crashes
+        self._last_scale_time = 0
+        self._last_busy_time = time.time()
+
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        logger.info("WorkerPool.run(): Starting {}-{} workers on {}"
+                    .format(self.min_workers, self.max_workers, self.queue_names))
+        while not self._is_stop_requested:
+            self._reap_processes()
+            if self.max_workers > self.min_workers:
+                self._autoscale()
+            while (len(self.processes) < self.num_workers) and self._is_below_max_workers() \
+                    and (time.time() >= self._start_not_before):
+                self._start_process()
+            while len(self.processes) > self.num_workers:
+                self._retire_process()
+            try:
+                take_sample()  # rate-limited across processes
+            except Exception as exc:
+                logger.error("WorkerPool.run(): Error sampling telemetry: {}".format(exc))
+            time.sleep(self.poll_interval)
+        self._stop_processes()
+
+
+    def _request_stop(self, signum, frame):
+        logger.info("WorkerPool._request_stop(): Got signal {}".format(signum))
+        if self._is_stop_requested:  # a second Ctrl+C: don't wait for the current jobs
+            for process in self.processes + self.retiring_processes:
+                if process.is_alive():
+                    os.kill(process.pid, signal.SIGKILL)
+        self._is_stop_requested = True
+
+
+    def _is_below_max_workers(self):
+        """
+        :return: True if another process can be started. retiring processes count b/c they're still running a job
+        """
+        return len(self.processes) + len(self.retiring_processes) < self.max_workers
+
+
+    def _autoscale(self):
+        """
+        Sets self.num_workers from the queues' lengths and wait times. Scales up immediately but down one process at a
+        time, and only after the queues have been empty for settings.RQ_POOL_SCALE_DOWN_DELAY seconds.
+        """
+        now = time.time()
+        if now - self._last_scale_time < settings.RQ_POOL_SCALE_INTERVAL:
+            return
+
+        self._last_scale_time = now
+        lengths_and_wait_times = [queue_length_and_wait_time(django_rq.get_queue(queue_name))
+                                  for queue_name in self.queue_names]
+        total_length = sum(length for length, _ in lengths_and_wait_times)
+        max_wait_time = max(wait_time for _, wait_time in lengths_and_wait_times)
+        if total_length:
+            self._last_busy_time = now
+
+        num_workers = math.ceil(total_length / settings.RQ_POOL_JOBS_PER_WORKER)
+        if max_wait_time > settings.RQ_POOL_MAX_WAIT_TIME:
+            num_workers = max(num_workers, self.num_workers + 1)
+        if num_workers < self.num_workers:
+            is_idle = now - self._last_busy_time >= settings.RQ_POOL_SCALE_DOWN_DELAY
+            num_workers = self.num_workers - 1 if is_idle else self.num_workers
+        num_workers = min(max(num_workers, self.min_workers), self.max_workers)
+        if num_workers != self.num_workers:
+            logger.info("WorkerPool._autoscale(): {} -> {} workers. total_length={}, max_wait_time={:.1f}"
+                        .format(self.num_workers, num_workers, total_length, max_wait_time))
+            self.num_workers = num_workers
+
+
+    def _start_process(self):
+        connections.close_all()  # so the child doesn't inherit (and share) an open DB connection
+        process = multiprocessing.Process(target=run_prewarmed_worker,
+                                          args=(self.queue_names, self.max_jobs, self.worker_class))
+        process.start()
+        self.processes.append(process)
+        logger.debug("WorkerPool._start_process(): Started pid={}".format(process.pid))
+        return process
+
+
+    def _retire_process(self):
+        process = self.processes.pop()
+        os.kill(process.pid, signal.SIGTERM)  # warm shutdown: rq finishes the current job first
+        self.retiring_processes.append(process)
+        logger.debug("WorkerPool._retire_process(): Retiring pid={}".format(process.pid))
+
+
+    def _reap_processes(self):
+        """
+        Forgets processes that have exited, backing off further process starts if any crashed.
+        """
+        for process in [process for process in self.retiring_processes if not process.is_alive()]:
+            process.join()
+            self.retiring_processes.remove(process)
+        for process in [process for process in self.processes if not process.is_alive()]:
+            process.join()
+            self.processes.remove(process)
+            if process.exitcode == 0:  # recycled after max_jobs
+                self._num_consecutive_crashes = 0
+                logger.info("WorkerPool._reap_processes(): pid={} exited".format(process.pid))
+            else:
+                self._num_consecutive_crashes += 1
+                backoff = min(2 ** self._num_consecutive_crashes, MAX_CRASH_BACKOFF)
+                self._start_not_before = time.time() + backoff
+                logger.error("WorkerPool._reap_processes(): pid={} crashed. exitcode={}, restarting in {} seconds"
+                             .format(process.pid, process.exitcode, backoff))
+
+
+    def _stop_processes(self):
+        processes = self.processes + self.retiring_processes
+        logger.info("WorkerPool._stop_processes(): Stopping {} workers".format(len(processes)))
+        for process in self.processes:  # retiring_processes have already been sent SIGTERM
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)  # warm shutdown: rq finishes the current job first
+        deadline = time.time() + self.stop_timeout
+        for process in processes:
+            process.join(max(deadline - time.time(), 0))
+            if process.is_alive():
+                logger.error("WorkerPool._stop_processes(): Killing pid={}".format(process.pid))
+                if hasattr(process, 'kill'):  # python 3.7+
+                    process.kill()
+                else:
+                    process.terminate()
+                process.join()
+        self.processes = []
+        self.retiring_processes = []
@@ -102,7 +102,8 @@ USE_TZ = True
 STATIC_URL = '/static/'
 
 #
-# set up logging - https://stackoverflow.com/questions/5137042/how-can-i-get-django-to-print-the-debug-information-to-the-console
+# set up logging -
+# https://stackoverflow.com/questions/5137042/how-can-i-get-django-to-print-the-debug-information-to-the-console
 # note: According to docs, I should not have to specify this - default should be to log everything INFO and higher to
 # console - https://docs.djangoproject.com/en/1.11/topics/logging/#default-logging-configuration
 #
@@ -136,3 +137,123 @@ LOGGING = {
 
 # Redirect to home URL after login (Default redirects to /accounts/profile/)
 LOGIN_REDIRECT_URL = '/'
+
+#
+# ---- counter config ----
+#
+
+# how Counter.increment_count() records increments: 'db' (read-modify-write the singleton row), 'redis' (atomic
+# INCRBY in Redis, flushed to the singleton row by Counter.flush_pending_count()), or 'sharded' (atomic UPDATE of one
+# of COUNTER_NUM_SHARDS CounterShard rows, summed on read)
+COUNTER_BACKEND = os.environ.get('COUNTER_BACKEND', 'db')
+
+# 'redis' backend: flush once this many increments are pending, or once this many seconds have passed since the last
+# flush, whichever comes first. `python3 manage.py flush_counter` can also be run on a schedule
+COUNTER_FLUSH_THRESHOLD = 1000
+COUNTER_FLUSH_INTERVAL = 10
+
+# 'sharded' backend: number of CounterShard rows to spread increments across. roughly the expected number of concurrent
+# writers. NB: changing it doesn't lose counts - rows beyond it are still summed but no longer incremented
+COUNTER_NUM_SHARDS = 16
+
+# Counter.enqueue_increment_count(): seconds after which the "coalesced job is waiting" marker expires. should exceed
+# the longest expected queue wait
+COUNTER_COALESCED_JOB_TTL = 600
+
+#
+# ---- cache config ----
+#
+
+# seconds that views.index()'s cached counter and job summary live before expiring. they're also invalidated by the
+# writes that change them, so this is only a backstop - see forecast_app/caching.py
+INDEX_CACHE_TIMEOUT = 60
+
+#
+# ---- UploadFileJob config ----
+#
+
+# the forecast_app.storage.Storage subclass that holds uploaded files: 'forecast_app.storage.S3Storage' or
+# 'forecast_app.storage.LocalFileSystemStorage' (e.g., for running offline)
+UPLOAD_STORAGE_BACKEND = os.environ.get('UPLOAD_STORAGE_BACKEND', 'forecast_app.storage.S3Storage')
+
+# LocalFileSystemStorage: directory holding the files
+UPLOAD_STORAGE_LOCAL_ROOT = os.environ.get('UPLOAD_STORAGE_LOCAL_ROOT', os.path.join(BASE_DIR, 'upload_storage'))
+
+# compression applied to uploaded files on their way to storage: '' (none), 'gzip', or 'zstd' (requires the
+# `zstandard` package). see forecast_app/compression.py
+UPLOAD_COMPRESSION = os.environ.get('UPLOAD_COMPRESSION', '')
+
+# S3Storage: the bucket, and the size of the per-process client's connection pool. the pool should be at least as large
+# as the number of threads using it at once, e.g., S3_MULTIPART_MAX_CONCURRENCY per concurrent upload
+S3_UPLOAD_BUCKET_NAME = os.environ.get('S3_UPLOAD_BUCKET_NAME', 'mc.zoltarapp.sandbox')
+S3_MAX_POOL_CONNECTIONS = 20
+
+# S3Storage: None for AWS S3, or the URL of a local S3 stand-in, e.g., 'http://localhost:9000' for MinIO or
+# 'http://localhost:5000' for `moto_server s3`
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL') or None
+
+# number of UploadFileJobs per page of views.index()'s keyset-paginated listing
+UPLOAD_FILE_JOBS_PAGE_SIZE = 50
+
+#
+# ---- RQ config ----
+#
+
+# number of jobs from the front of each queue that views.index() lists
+INDEX_QUEUE_SUMMARY_NUM_JOBS = 20
+
+# queue routing (see forecast_app/rq_utils.py). uploads up to RQ_FAST_MAX_FILE_SIZE bytes go to the 'fast' queue and
+# larger ones to 'bulk'. upload job timeouts (seconds) assume processing at RQ_UPLOAD_JOB_BYTES_PER_SECOND, clamped to
+# [RQ_UPLOAD_JOB_MIN_TIMEOUT, RQ_UPLOAD_JOB_MAX_TIMEOUT]
+RQ_FAST_MAX_FILE_SIZE = 10E+06
+RQ_UPLOAD_JOB_BYTES_PER_SECOND = 1E+06
+RQ_UPLOAD_JOB_MIN_TIMEOUT = 60
+RQ_UPLOAD_JOB_MAX_TIMEOUT = 3600
+
+# the queues that each worker process type drains, in priority order - see `manage.py rqworker_pool --role` and the
+# Procfile. bulk workers also take fast jobs when they have no bulk work, but fast workers never take bulk jobs
+RQ_WORKER_QUEUES = {
+    'worker': ['fast', 'default'],
+    'bulkworker': ['bulk', 'maintenance', 'fast', 'default'],
+}
+
+# `manage.py rqworker_pool --max-workers` autoscaling (see forecast_app/worker_pool.py). every
+# RQ_POOL_SCALE_INTERVAL seconds the pool targets RQ_POOL_JOBS_PER_WORKER queued jobs per worker, adds a worker if the
+# oldest queued job has waited more than RQ_POOL_MAX_WAIT_TIME seconds, and removes one once its queues have been empty
+# for RQ_POOL_SCALE_DOWN_DELAY seconds
+RQ_POOL_SCALE_INTERVAL = 5
+RQ_POOL_JOBS_PER_WORKER = 10
+RQ_POOL_MAX_WAIT_TIME = 5
+RQ_POOL_SCALE_DOWN_DELAY = 60
+
+# `manage.py rqworker_pool --prefetch` (see forecast_app/prefetch.py): the max number of upcoming jobs' files each
+# worker process downloads ahead of time, and the max total bytes of them that it keeps on local disk
+PREFETCH_MAX_FILES = 2
+PREFETCH_MAX_BYTES = 500E+06
+
+# forecast_app.chunked: uploads are split into at most CHUNKED_MAX_CHUNKS chunk jobs of at least CHUNKED_MIN_CHUNK_SIZE
+# bytes each. an upload is failed by `manage.py reap_chunked_jobs` if no chunk job finishes for CHUNKED_STALL_TIMEOUT
+# seconds. NB: that should allow for chunk jobs' queue wait time plus RQ_UPLOAD_JOB_MAX_TIMEOUT
+CHUNKED_MAX_CHUNKS = 16
+CHUNKED_MIN_CHUNK_SIZE = 25 * 1000 * 1000
+CHUNKED_STALL_TIMEOUT = 3 * 60 * 60
+
+# forecast_app.rq_telemetry: a sample of the queues is taken at most every RQ_TELEMETRY_SAMPLE_INTERVAL seconds and the
+# last RQ_TELEMETRY_MAX_SAMPLES are kept (i.e., an hour's worth). wait and run time percentiles are over the last
+# RQ_TELEMETRY_MAX_DURATIONS jobs per queue
+RQ_TELEMETRY_SAMPLE_INTERVAL = 10
+RQ_TELEMETRY_MAX_SAMPLES = 360
+RQ_TELEMETRY_MAX_DURATIONS = 1000
+
+# forecast_app.progress: ProgressReporter publishes at most every PROGRESS_MIN_INTERVAL seconds. event streams send a
+# keepalive comment after PROGRESS_SSE_KEEPALIVE_INTERVAL idle seconds and end after PROGRESS_SSE_MAX_DURATION seconds
+# (under gunicorn's default 30 second worker timeout), after which browsers reconnect in PROGRESS_SSE_RETRY milliseconds
+PROGRESS_MIN_INTERVAL = 1
+PROGRESS_SSE_KEEPALIVE_INTERVAL = 10
+PROGRESS_SSE_MAX_DURATION = 25
+PROGRESS_SSE_RETRY = 1000
+
+# forecast_app.result_cache: max number of cached (content_digest, input_json) -> output_json results, and the max
+# size in characters of a cached output_json (larger ones aren't cached)
+RESULT_CACHE_MAX_ENTRIES = 10000
+RESULT_CACHE_MAX_ENTRY_SIZE = 64 * 1024
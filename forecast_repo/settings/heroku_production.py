@@ -42,10 +42,33 @@ if not redis_url:
     raise RuntimeError('heroku_production.py: REDIS_URL not configured!')
 
 RQ_QUEUES = {
-    'default': {
+    'default': {  # NB: no longer enqueued to, but still drained so that jobs enqueued before the routing change run
+        'URL': redis_url,
+        'DEFAULT_TIMEOUT': 500,
+    },
+    'fast': {
         'URL': redis_url,
         'DEFAULT_TIMEOUT': 500,
     },
+    'bulk': {
+        'URL': redis_url,
+        'DEFAULT_TIMEOUT': 3600,
+    },
+    'maintenance': {
+        'URL': redis_url,
+        'DEFAULT_TIMEOUT': 3600,
+    },
+}
+
+#
+# ---- cache config ----
+#
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': redis_url,
+    },
 }
 
 #
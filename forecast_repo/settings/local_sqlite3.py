@@ -15,8 +15,31 @@ DATABASES = {
 #
 
 RQ_QUEUES = {
-    'default': {
+    'default': {  # NB: no longer enqueued to, but still drained so that jobs enqueued before the routing change run
+        'URL': 'redis://localhost:6379/0',
+        'DEFAULT_TIMEOUT': 360,
+    },
+    'fast': {
         'URL': 'redis://localhost:6379/0',
         'DEFAULT_TIMEOUT': 360,
     },
+    'bulk': {
+        'URL': 'redis://localhost:6379/0',
+        'DEFAULT_TIMEOUT': 3600,
+    },
+    'maintenance': {
+        'URL': 'redis://localhost:6379/0',
+        'DEFAULT_TIMEOUT': 3600,
+    },
+}
+
+#
+# ---- cache config ----
+#
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://localhost:6379/1',
+    },
 }
@@ -3,9 +3,6 @@ import django
 
 
 # set up django. must be done before loading models. NB: requires DJANGO_SETTINGS_MODULE to be set
-import django_rq
-
-
 django.setup()
 
 from forecast_app.models import Counter
@@ -14,7 +11,7 @@ from forecast_app.models import Counter
 @click.command()
 def increment_counter_app():
     count, last_update = Counter.get_count_and_last_update()
-    job = django_rq.enqueue(Counter.increment_count)
+    job = Counter.enqueue_increment_count()  # None if coalesced into an already-waiting job
     click.echo("* increment_counter_app(): start: count={}, updated_at={}. job={}".format(count, last_update, job))
 
 